@@ -9,6 +9,13 @@ const apiHeaders = {
   'X-CSRFToken': csrfToken
 }
 
+// When the server is still rendering, it responds `{"pending": true}` (HTTP
+// 202). We ask again after this many milliseconds, doubling each time up to
+// MaxRenderRetryDelay. After MaxRenderRetries, we give up.
+const RenderRetryDelay = 250
+const MaxRenderRetryDelay = 4000
+const MaxRenderRetries = 10
+
 // All API calls which fetch data return a promise which returns JSON
 class WorkbenchAPI {
   // We send at most one data-modification request at a time, to avoid races.
@@ -44,6 +51,28 @@ class WorkbenchAPI {
       })
   }
 
+  /**
+   * Like _fetch(), but waits out `{"pending": true}` responses.
+   *
+   * Render endpoints respond that way while the server renders. We poll until
+   * the render is done, backing off, so callers get rendered data. The
+   * Promise fails with RangeError if the render is still pending after
+   * MaxRenderRetries retries.
+   */
+  _fetchRendered(url, delay=RenderRetryDelay, nRetries=0) {
+    return this._fetch(url)
+      .then(json => {
+        if (json && json.pending === true) {
+          if (nRetries >= MaxRenderRetries) {
+            throw new RangeError(`Render still pending after ${nRetries} retries`)
+          }
+          return new Promise(resolve => setTimeout(resolve, delay))
+            .then(() => this._fetchRendered(url, Math.min(delay * 2, MaxRenderRetryDelay), nRetries + 1))
+        }
+        return json
+      })
+  }
+
   _submit(method, url, body, options) {
     const realOptions = Object.assign(
       { method: method, headers: apiHeaders },
@@ -123,11 +152,11 @@ class WorkbenchAPI {
       }
     }
 
-    return this._fetch(url)
+    return this._fetchRendered(url)
   }
 
   valueCounts(wfModuleId, column) {
-    return this._fetch(`/api/wfmodules/${wfModuleId}/value-counts?column=${encodeURIComponent(column)}`)
+    return this._fetchRendered(`/api/wfmodules/${wfModuleId}/value-counts?column=${encodeURIComponent(column)}`)
       .catch(err => {
         if (err instanceof RangeError) {
           return { values: {} }
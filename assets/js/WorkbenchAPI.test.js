@@ -0,0 +1,51 @@
+import api from './WorkbenchAPI'
+
+describe('WorkbenchAPI', () => {
+  const jsonResponse = (status, json) => ({
+    ok: true,
+    status: status,
+    headers: { get: () => 'application/json' },
+    json: () => Promise.resolve(json)
+  })
+
+  afterEach(() => {
+    delete global.fetch
+  })
+
+  it('waits out pending renders', () => {
+    global.fetch = jest.fn()
+      .mockReturnValueOnce(Promise.resolve(jsonResponse(202, { pending: true })))
+      .mockReturnValueOnce(Promise.resolve(jsonResponse(200, { total_rows: 2 })))
+
+    return api._fetchRendered('/api/wfmodules/1/render', 0)
+      .then(json => {
+        expect(json).toEqual({ total_rows: 2 })
+        expect(global.fetch).toHaveBeenCalledTimes(2)
+      })
+  })
+
+  it('gives up on a render that stays pending', () => {
+    global.fetch = jest.fn()
+      .mockImplementation(() => Promise.resolve(jsonResponse(202, { pending: true })))
+
+    return api._fetchRendered('/api/wfmodules/1/render', 0)
+      .then(
+        () => { throw new Error('expected failure') },
+        err => {
+          expect(err).toBeInstanceOf(RangeError)
+          expect(global.fetch).toHaveBeenCalledTimes(11)
+        }
+      )
+  })
+
+  it('returns value counts after a pending render', () => {
+    global.fetch = jest.fn()
+      .mockReturnValueOnce(Promise.resolve(jsonResponse(202, { pending: true })))
+      .mockReturnValueOnce(Promise.resolve(jsonResponse(200, { values: { a: 1 } })))
+
+    return api.valueCounts(1, 'A')
+      .then(values => {
+        expect(values).toEqual({ a: 1 })
+      })
+  })
+})
@@ -1,17 +1,21 @@
 """
 ASGI config for cjworkbench project.
 
-Used for websockets
+Used for websockets and render workers
 """
 
-from channels.routing import ProtocolTypeRouter, URLRouter
+from channels.routing import ChannelNameRouter, ProtocolTypeRouter, \
+        URLRouter
 from channels.auth import AuthMiddlewareStack
+import django
 from django.conf.urls import url
 import os
 
-from server.websockets import WorkflowConsumer
-
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "cjworkbench.settings")
+django.setup()  # renderqueue imports models
+
+from server.renderqueue import RenderChannel, RenderConsumer
+from server.websockets import WorkflowConsumer
 
 def create_url_router() -> AuthMiddlewareStack:
     return AuthMiddlewareStack(URLRouter([
@@ -22,6 +26,9 @@ def create_application() -> ProtocolTypeRouter:
     """Create an ASGI application."""
     return ProtocolTypeRouter({
         'websocket': AuthMiddlewareStack(create_url_router()),
+        'channel': ChannelNameRouter({
+            RenderChannel: RenderConsumer,
+        }),
     })
 
 application = create_application()
@@ -36,12 +36,64 @@ SCRAPER_TIMEOUT = 30 # seconds
 # Chunk size for chardet file encoding detection
 CHARDET_CHUNK_SIZE = 1024*1024
 
+# Downloads (say, LoadURL's) are spooled to a temporary file before parsing:
+# in memory up to SPOOL_MAX_MEMORY_BYTES, then on disk. We stop downloading
+# and report an error after DOWNLOAD_MAX_BYTES.
+SPOOL_MAX_MEMORY_BYTES = 10*1024*1024
+DOWNLOAD_MAX_BYTES = 2*1024*1024*1024
+
 # Chunk size for separator detection
 SEP_DETECT_CHUNK_SIZE = 1024*1024
 
 # Use categories if file over this size
 CATEGORY_FILE_SIZE_MIN = 250*1024*1024
 
+# Rows per chunk when we ingest CSV, TSV and TXT files. We parse one chunk at
+# a time and write it to the fetched table's Parquet file, so this bounds
+# memory use.
+INGEST_CHUNK_SIZE = 64*1024
+
+# Most distinct values we'll collect per text column when we ingest a file
+# over CATEGORY_FILE_SIZE_MIN in chunks. Columns with more stay str.
+INGEST_MAX_CATEGORIES = 64*1024
+
+# Maximum rows per Parquet row group, for cached render results and fetched
+# data. Smaller groups make paging cheaper; None means one group per file.
+PARQUET_ROW_GROUP_SIZE = 64*1024
+
+# How much memory may each process spend caching decoded render results?
+RENDER_CACHE_MAX_BYTES = 512*1024*1024
+
+# How much disk may the shared render cache spend on results nobody links to?
+SHARED_RENDER_CACHE_MAX_BYTES = 5*1024*1024*1024
+
+# How many earlier render results do we keep per WfModule, for undo/redo? And
+# how much disk may each workflow spend on them?
+RENDER_HISTORY_N_GENERATIONS = 5
+RENDER_HISTORY_MAX_BYTES_PER_WORKFLOW = 200*1024*1024
+
+# Where do renders happen? 'local' runs them in a thread pool in each web
+# process; 'channels' sends them to `./manage.py runworker render`.
+RENDER_QUEUE_BACKEND = os.getenv('CJW_RENDER_QUEUE_BACKEND', 'local')
+
+# How many renders may run at once in each process, with the 'local' backend?
+RENDER_QUEUE_N_WORKERS = 4
+
+# How long may an HTTP request wait for a render before we say it's pending?
+RENDER_WAIT_TIMEOUT = 30 # seconds
+
+# How long may browsers and CDNs reuse a public WfModule's output without
+# revalidating? (Revalidating with If-None-Match is cheap: see views.)
+RENDER_OUTPUT_MAX_AGE = 0 # seconds
+
+# How many scheduled fetches may each `./manage.py run-background-loop` run at
+# once? To fetch more, run more loops: they never claim the same WfModule.
+FETCH_N_WORKERS = 4
+
+# If a fetch worker claims a queued fetch and doesn't finish it within this
+# time, we assume the worker died and let another worker claim it.
+FETCH_JOB_TIMEOUT = 3600 # seconds
+
 # ----- App Boilerplate -----
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
@@ -409,4 +461,18 @@ if I_AM_TESTING:
 # (This is handy when developing modules.)
 CACHE_MODULES = os.getenv('CACHE_MODULES', 'true').upper() != 'FALSE'
 
+# RENDER_AFTER_DELTA: if true, re-render in the background after each change.
+# Tests turn it off, so they control when renders happen.
+RENDER_AFTER_DELTA = (
+    os.getenv('RENDER_AFTER_DELTA', 'true').upper() != 'FALSE'
+    and not I_AM_TESTING
+)
+
+# SHARED_RENDER_CACHE: if true, reuse identical renders from any workflow.
+# Tests turn it off, so each test renders what it expects to render.
+SHARED_RENDER_CACHE = (
+    os.getenv('SHARED_RENDER_CACHE', 'true').upper() != 'FALSE'
+    and not I_AM_TESTING
+)
+
 TEST_RUNNER = 'server.tests.runner.TimeLoggingDiscoverRunner'
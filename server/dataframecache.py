@@ -0,0 +1,156 @@
+"""
+In-process cache of decoded DataFrames, so cache hits skip Parquet decoding.
+
+Keys are `(wf_module_id, delta_id)`: a WfModule's render result at a given
+delta. Each process has its own cache; nothing is shared between web workers.
+"""
+
+from collections import OrderedDict
+import threading
+from typing import Dict, Optional, Tuple
+from django.conf import settings
+import pandas
+
+
+Key = Tuple[int, int]
+
+
+def _dataframe_size(dataframe: pandas.DataFrame) -> int:
+    return int(dataframe.memory_usage(index=True, deep=True).sum())
+
+
+class DataFrameCache:
+    """
+    Thread-safe LRU cache of DataFrames, bounded by a total byte size.
+
+    Callers may mutate what they get and what they put: we store a copy on
+    put() and hand out a copy on get(). (Modules such as Formula modify their
+    input tables in place.) Copying is far cheaper than decoding Parquet.
+
+    A DataFrame larger than the whole budget is never cached.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # Key => (DataFrame, n_bytes)
+        self._n_bytes = 0
+        self.n_hits = 0
+        self.n_misses = 0
+        self.n_evictions = 0
+
+    @property
+    def n_bytes(self) -> int:
+        """Total size of cached DataFrames."""
+        return self._n_bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: Key) -> bool:
+        return key in self._entries
+
+    def get(self, key: Key) -> Optional[pandas.DataFrame]:
+        """Return a copy of the cached DataFrame, or None on cache miss."""
+        with self._lock:
+            try:
+                dataframe, _ = self._entries[key]
+            except KeyError:
+                self.n_misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.n_hits += 1
+
+        return dataframe.copy()
+
+    def get_slice(self, key: Key, start_row: int,
+                  end_row: int) -> Optional[pandas.DataFrame]:
+        """
+        Return a copy of rows [start_row, end_row), or None on cache miss.
+
+        This copies only the requested rows.
+        """
+        with self._lock:
+            try:
+                dataframe, _ = self._entries[key]
+            except KeyError:
+                self.n_misses += 1
+                return None
+
+            self._entries.move_to_end(key)
+            self.n_hits += 1
+
+        return dataframe[max(0, start_row):end_row].copy()
+
+    def put(self, key: Key, dataframe: pandas.DataFrame) -> None:
+        """
+        Store a copy of `dataframe`, evicting least-recently-used entries.
+        """
+        n_bytes = _dataframe_size(dataframe)
+        if n_bytes > self.max_bytes:
+            self.discard(key)
+            return
+
+        dataframe = dataframe.copy()
+
+        with self._lock:
+            self._pop(key)
+            self._entries[key] = (dataframe, n_bytes)
+            self._n_bytes += n_bytes
+
+            while self._n_bytes > self.max_bytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._n_bytes -= evicted_bytes
+                self.n_evictions += 1
+
+    def rekey(self, old_key: Key, new_key: Key) -> None:
+        """Move the entry at `old_key`, if there is one, to `new_key`."""
+        with self._lock:
+            try:
+                entry = self._entries.pop(old_key)
+            except KeyError:
+                return
+            self._pop(new_key)
+            self._entries[new_key] = entry
+
+    def discard(self, key: Key) -> None:
+        """Remove `key`, if it is cached."""
+        with self._lock:
+            self._pop(key)
+
+    def discard_wf_module(self, wf_module_id: int) -> None:
+        """Remove all of `wf_module_id`'s entries, whatever their delta."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == wf_module_id]:
+                self._pop(key)
+
+    def clear(self) -> None:
+        """Remove all entries and reset counters."""
+        with self._lock:
+            self._entries.clear()
+            self._n_bytes = 0
+            self.n_hits = 0
+            self.n_misses = 0
+            self.n_evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'n_entries': len(self._entries),
+            'n_bytes': self._n_bytes,
+            'max_bytes': self.max_bytes,
+            'n_hits': self.n_hits,
+            'n_misses': self.n_misses,
+            'n_evictions': self.n_evictions,
+        }
+
+    def _pop(self, key: Key) -> None:
+        # Call with self._lock held
+        try:
+            _, n_bytes = self._entries.pop(key)
+        except KeyError:
+            return
+        self._n_bytes -= n_bytes
+
+
+cache = DataFrameCache(settings.RENDER_CACHE_MAX_BYTES)
@@ -1,4 +1,9 @@
 # Module dispatch table and implementations
+from functools import lru_cache
+import glob
+import hashlib
+import inspect
+import os
 import pandas as pd
 from typing import Optional
 from server.models import WfModule
@@ -105,6 +110,59 @@ def module_dispatch_render(wf_module: WfModule,
     return result
 
 
+# Code outside the modules themselves that shapes every render's output:
+# helpers the modules share, sanitizing, and the Parquet writer. Paths are
+# relative to this directory.
+_SharedRenderSources = [
+    'modules/*.py',
+    'dispatch.py',
+    'dynamicdispatch.py',
+    'pandas_util.py',
+    'parquet.py',
+    'sanitizedataframe.py',
+]
+
+
+@lru_cache()
+def _internal_module_source_hash(dispatch: str) -> str:
+    """Hash the source file of an internal module, once per process."""
+    path = inspect.getsourcefile(module_dispatch_tbl[dispatch])
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+@lru_cache()
+def _shared_render_source_hash() -> str:
+    """Hash the files in _SharedRenderSources, once per process."""
+    dirname = os.path.dirname(os.path.abspath(__file__))
+    sha1 = hashlib.sha1()
+    for pattern in _SharedRenderSources:
+        for path in sorted(glob.glob(os.path.join(dirname, pattern))):
+            sha1.update(os.path.relpath(path, dirname).encode('utf-8'))
+            with open(path, 'rb') as f:
+                sha1.update(hashlib.sha1(f.read()).digest())
+    return sha1.hexdigest()
+
+
+def module_dispatch_version(wf_module: WfModule) -> str:
+    """
+    Identify the code that renders `wf_module`.
+
+    Internal modules are all version "1.0", so we hash their source instead.
+    Either way, we mix in a hash of the code every module's output passes
+    through (see _SharedRenderSources): a fix there changes every version,
+    so cached results from the old code never match.
+    """
+    dispatch = wf_module.module_version.module.dispatch
+    if dispatch in module_dispatch_tbl:
+        module_version = _internal_module_source_hash(dispatch)
+    else:
+        module_version = wf_module.module_version.source_version_hash
+
+    key = f'{module_version}:{_shared_render_source_hash()}'
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
 def module_dispatch_event(wf_module, **kwargs):
     dispatch = wf_module.module_version.module.dispatch
     if dispatch in module_dispatch_tbl:
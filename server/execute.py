@@ -1,41 +1,511 @@
+from contextlib import contextmanager
+import logging
+import os
+from typing import Callable, List, Optional, Tuple
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Prefetch, prefetch_related_objects
 from server.modules.types import ProcessResult
-from server import dispatch
-from server.models import CachedRenderResult, WfModule
+from server import dataframecache, dispatch, parquet, renderhistory, \
+        sharedrendercache
+from server.models import CachedRenderResult, ParameterVal, WfModule, \
+        Workflow
+from server.pandas_util import hash_table_with_schema
 
 
-def _get_render_cache(wf_module: WfModule) -> CachedRenderResult:
+logger = logging.getLogger(__name__)
+
+
+class RenderReport:
+    """
+    What a call to `execute_wfmodule_with_report()` did.
+
+    `cached_result` is the requested WfModule's fresh CachedRenderResult.
+    `n_queries` and `n_renders` count the database queries and module renders
+    it took to produce it. `n_skipped` counts the renders we skipped because
+    a WfModule's inputs had not changed since its last render, or because we
+    restored its result from history.
+    """
+    def __init__(self, cached_result: CachedRenderResult, n_queries: int,
+                 n_renders: int, n_skipped: int=0):
+        self.cached_result = cached_result
+        self.n_queries = n_queries
+        self.n_renders = n_renders
+        self.n_skipped = n_skipped
+
+    @property
+    def result(self) -> ProcessResult:
+        return self.cached_result.result
+
+    def __repr__(self):
+        return 'RenderReport' + repr((self.cached_result, self.n_queries,
+                                      self.n_renders, self.n_skipped))
+
+
+class _QueryCounter:
+    def __init__(self):
+        self.n_queries = 0
+
+
+class _CountingCursor:
+    """
+    Cursor wrapper that counts executed queries, and nothing else.
+
+    Unlike Django's debug cursor, this neither formats nor stores SQL.
+    """
+    def __init__(self, cursor, counter: _QueryCounter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return self._cursor.__exit__(*exc_info)
+
+    def execute(self, sql, params=None):
+        self._counter.n_queries += 1
+        return self._cursor.execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self._counter.n_queries += 1
+        return self._cursor.executemany(sql, param_list)
+
+
+# DatabaseWrapper methods that wrap each new cursor
+_CursorFactories = ['make_cursor', 'make_debug_cursor']
+
+
+@contextmanager
+def _count_queries():
+    """
+    Yield a _QueryCounter that counts queries until the block exits.
+
+    We wrap this thread's database connection's cursors in _CountingCursor.
+    Connections are per-thread, so this does not affect other threads.
+    """
+    counter = _QueryCounter()
+    db = connections[DEFAULT_DB_ALIAS]  # this thread's DatabaseWrapper
+    saved = {name: db.__dict__.get(name) for name in _CursorFactories}
+
+    def wrap(make):
+        return lambda cursor: _CountingCursor(make(cursor), counter)
+
+    for name in _CursorFactories:
+        setattr(db, name, wrap(getattr(db, name)))
+    try:
+        yield counter
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                del db.__dict__[name]  # back to the class's method
+            else:
+                setattr(db, name, value)  # we're nested
+
+
+def _load_wf_modules(wf_module: WfModule) -> List[WfModule]:
+    """
+    Load all WfModules in `wf_module`'s workflow, in order.
+
+    This costs two queries: one for the WfModules (with their ModuleVersions
+    and Modules) and one for all their ParameterVals (with ParameterSpecs).
+
+    `wf_module` itself is in the returned list, in place of the copy we read
+    from the database. That way, the caller sees the cache fields we write.
+    """
+    wf_modules = list(
+        WfModule.objects
+        .filter(workflow_id=wf_module.workflow_id)
+        .select_related('module_version__module')
+    )
+
+    for i, loaded in enumerate(wf_modules):
+        if loaded.id == wf_module.id:
+            if wf_module.module_version_id == loaded.module_version_id:
+                # Avoid lazy-loading the ModuleVersion (and Module) again
+                wf_module.module_version = loaded.module_version
+            wf_modules[i] = wf_module
+            break
+    else:
+        raise ValueError('WfModule is not in its workflow')
+
+    prefetch_related_objects(wf_modules, Prefetch(
+        'parameter_vals',
+        queryset=ParameterVal.objects.select_related('parameter_spec')
+    ))
+
+    return wf_modules
+
+
+def is_cache_fresh(wf_module: WfModule) -> bool:
+    """Return True if `wf_module`'s cached render result is up to date."""
     revision = wf_module.last_relevant_delta_id or 0
-    cached_result = wf_module.get_cached_render_result()
-    if cached_result and cached_result.delta_id == revision:
-        return cached_result
+    return wf_module.cached_render_result_delta_id == revision
+
+
+class _RenderStep:
+    """
+    A WfModule we must render, and what we need to render it.
+
+    Rendering may happen outside of any transaction. Modules may still query
+    the database (fetch modules read their StoredObjects), so the result can
+    be stale by the time we store it: the caller must re-check.
+
+    To render without the workflow's lock, call snapshot_input() while you
+    hold it. Other renders may replace the input's Parquet file after we
+    release the lock; the snapshot still reads the file we saw.
+    """
+    def __init__(self, wf_module: WfModule, delta_id: int,
+                 fingerprint: Optional[str],
+                 input_result: Optional[CachedRenderResult]):
+        self.wf_module = wf_module
+        self.delta_id = delta_id
+        self.fingerprint = fingerprint
+        self.input_result = input_result
+        self._input_table = None
+        self._input_snapshot = None
+
+    def snapshot_input(self) -> None:
+        """
+        Pin the input table. Call within the workflow's cooperative_lock().
+
+        Call close() after render().
+        """
+        if self.input_result is None:
+            return
+
+        # A cache hit is a copy of what's on disk now. On a miss, we open the
+        # file but don't decode it yet (and we won't cache what we decode
+        # without the lock).
+        key = (self.input_result.wf_module_id, self.input_result.delta_id)
+        self._input_table = dataframecache.cache.get(key)
+        if self._input_table is None:
+            try:
+                self._input_snapshot = parquet.Snapshot(
+                    self.input_result.parquet_path
+                )
+            except FileNotFoundError:
+                self._input_table = ProcessResult().dataframe
+
+    def render(self) -> ProcessResult:
+        if self._input_table is not None:
+            table = self._input_table
+        elif self._input_snapshot is not None:
+            table = self._input_snapshot.read()
+        elif self.input_result is None:
+            table = ProcessResult().dataframe
+        else:
+            # We hold the lock: nobody can replace the file
+            table = self.input_result.result.dataframe
+        self._input_table = None  # let it be garbage-collected
+        return dispatch.module_dispatch_render(self.wf_module, table)
+
+    def close(self) -> None:
+        if self._input_snapshot is not None:
+            self._input_snapshot.close()
+            self._input_snapshot = None
+
+
+def _reuse_cached_result(wf_module: WfModule, delta_id: int,
+                         fingerprint: Optional[str]
+                         ) -> Tuple[Optional[CachedRenderResult], bool]:
+    """
+    Give `wf_module` a result for `delta_id` without rendering, if we can.
+
+    Return the new CachedRenderResult (or None if we must render), and
+    whether we skipped the render through early cutoff or history.
+    """
+    if fingerprint is None:
+        return (None, False)
+
+    if (
+        wf_module.cached_render_result_delta_id is not None
+        and fingerprint == wf_module.cached_render_result_fingerprint
+    ):
+        return (CachedRenderResult.restamp_wf_module(wf_module, delta_id),
+                True)
+
+    cached_result = renderhistory.restore(wf_module, delta_id, fingerprint)
+    if cached_result is not None:
+        return (cached_result, True)
+
+    return (sharedrendercache.restore(fingerprint, wf_module, delta_id),
+            False)
+
+
+def _finish_caching(wf_module: WfModule, cached_result: CachedRenderResult,
+                    on_cache: Optional[Callable[[WfModule], None]],
+                    update_fields: Optional[List[str]]=None) -> None:
+    renderhistory.record(wf_module, cached_result)
+
+    wf_module.save(update_fields=update_fields)
+
+    if on_cache is not None:
+        # Wait for COMMIT: a client that reads the result as soon as it hears
+        # about it must not read the old one.
+        transaction.on_commit(lambda: on_cache(wf_module))
+
+
+def _execute_until_render(wf_modules: List[WfModule], target_index: int,
+                          on_cache: Optional[Callable[[WfModule], None]]
+                          ) -> Tuple[Optional[CachedRenderResult],
+                                     Optional[_RenderStep], int]:
+    """
+    Cache `wf_modules` until `target_index`, stopping before any render.
+
+    We resume from the deepest fresh cached result at or before
+    `target_index`, and we walk forward from there.
+
+    Before rendering a WfModule, we fingerprint its inputs: its input table's
+    hash, its module and parameters and its fetched data. If the fingerprint
+    matches the one its stale cached result was rendered from, the new delta
+    could not have changed its output, so we re-stamp the cached result with
+    the new delta ID instead of rendering ("early cutoff"). Otherwise, if the
+    WfModule's history holds its result at this delta (say, after an undo),
+    or the shared render cache holds an identical render, we link to that
+    result instead of rendering.
+
+    After we write each WfModule's cached result, we call `on_cache(wf_module)`
+    (if it is set) once the write commits.
+
+    Return the target's CachedRenderResult (or None if we must render), the
+    first WfModule we must render (or None if the target is fresh) and the
+    number of renders we skipped through early cutoff or history.
+    """
+    start_index = target_index
+    while start_index >= 0 and not is_cache_fresh(wf_modules[start_index]):
+        start_index -= 1
+
+    if start_index == target_index:
+        # Cache hit: nothing to render
+        return (wf_modules[target_index].get_cached_render_result(), None, 0)
+
+    # We only read the input table if we need to render. When early cutoff
+    # skips every render, we never decode a Parquet file.
+    if start_index >= 0:
+        cached_result = wf_modules[start_index].get_cached_render_result()
+        input_hash = cached_result.hash
+        if not input_hash:
+            # This result was cached before we computed hashes
+            input_hash = hash_table_with_schema(cached_result.result.dataframe)
     else:
-        return None
+        cached_result = None
+        input_hash = hash_table_with_schema(ProcessResult().dataframe)
 
+    n_skipped = 0
+    for wf_module in wf_modules[start_index + 1:target_index + 1]:
+        delta_id = wf_module.last_relevant_delta_id
+        fingerprint = sharedrendercache.fingerprint(wf_module, input_hash)
 
-# Return the output of a particular module. Gets from cache if possible
-def execute_wfmodule(wf_module: WfModule) -> ProcessResult:
+        reused, skipped = _reuse_cached_result(wf_module, delta_id,
+                                               fingerprint)
+        if reused is None:
+            return (None,
+                    _RenderStep(wf_module, delta_id, fingerprint,
+                                cached_result),
+                    n_skipped)
+
+        cached_result = reused
+        input_hash = cached_result.hash
+        if skipped:
+            n_skipped += 1
+
+        _finish_caching(wf_module, cached_result, on_cache)
+
+    return (cached_result, None, n_skipped)
+
+
+def _execute_wfmodules(wf_modules: List[WfModule], target_index: int,
+                       on_cache: Optional[Callable[[WfModule], None]]
+                       ) -> Tuple[CachedRenderResult, int, int]:
     """
-    Process all WfModules until the given one; return its result.
+    Render and cache `wf_modules` until `target_index`.
+
+    See _execute_until_render() for how we avoid renders. We render each
+    WfModule it stops at, then resume.
 
-    By default, this will both read and write each WfModule's cached render
-    result. Pass nocache=True to avoid modifying the cache.
+    Return the target's CachedRenderResult, the number of renders and the
+    number of renders we skipped through early cutoff or history.
+    """
+    n_renders = 0
+    n_skipped = 0
+    while True:
+        cached_result, step, n_step_skipped = _execute_until_render(
+            wf_modules,
+            target_index,
+            on_cache
+        )
+        n_skipped += n_step_skipped
+        if step is None:
+            return (cached_result, n_renders, n_skipped)
+
+        result = step.render()
+        cached_result = step.wf_module.cache_render_result(
+            step.delta_id,
+            result,
+            step.fingerprint or ''
+        )
+        if step.fingerprint is not None:
+            sharedrendercache.store(step.fingerprint, cached_result)
+        n_renders += 1
+
+        _finish_caching(step.wf_module, cached_result, on_cache)
+
+
+def execute_wfmodule_with_report(
+    wf_module: WfModule,
+    on_cache: Optional[Callable[[WfModule], None]]=None
+) -> RenderReport:
+    """
+    Process all WfModules until the given one; report what it took.
+
+    This reads every WfModule (and its parameters) in a constant number of
+    queries, then renders forward from the deepest fresh cached result. Each
+    WfModule we render has its cached render result rewritten; once the
+    caller's transaction commits, we call `on_cache(that_wf_module)`, if
+    `on_cache` is set.
 
     You must call this within a workflow.cooperative_lock().
     """
-    # Do we already have what we need? If so, return quickly.
-    cached_result = _get_render_cache(wf_module)
-    if cached_result:
-        return cached_result.result
+    with _count_queries() as query_counter:
+        wf_modules = _load_wf_modules(wf_module)
+        target_index = wf_modules.index(wf_module)
+        cached_result, n_renders, n_skipped = _execute_wfmodules(
+            wf_modules,
+            target_index,
+            on_cache
+        )
 
-    # Recurse -- ensuring the smallest possible number of renders
-    input_wf_module = wf_module.previous_in_stack()
-    if input_wf_module:
-        input_result = execute_wfmodule(input_wf_module)
-    else:
-        input_result = ProcessResult()
+    report = RenderReport(cached_result, query_counter.n_queries, n_renders,
+                          n_skipped)
+    logger.info('Executed wf_module %d: %d queries, %d renders, %d skipped',
+                wf_module.id, report.n_queries, report.n_renders,
+                report.n_skipped)
+    return report
 
-    result = dispatch.module_dispatch_render(wf_module, input_result.dataframe)
-    wf_module.cache_render_result(wf_module.last_relevant_delta_id, result)
-    wf_module.save()
 
-    return result
+def execute_wfmodule_unlocked(
+    workflow: Workflow,
+    wf_module_id: int,
+    on_cache: Optional[Callable[[WfModule], None]]=None
+) -> Optional[RenderReport]:
+    """
+    Like execute_wfmodule_with_report(), but render with no transaction open.
+
+    Renders can take minutes (think pythoncode), and the workflow's lock
+    blocks every other request on the workflow. So for each render, we:
+
+    1. Snapshot the WfModules and their parameters, within a short
+       cooperative_lock(). (We also re-stamp or link results that need no
+       render, which is quick.)
+    2. Render and write the Parquet file, with no transaction open.
+    3. Within another short cooperative_lock(), link the Parquet file into
+       place -- but only if the WfModule's `last_relevant_delta_id` did not
+       change meanwhile.
+
+    Return a RenderReport; or return None if the workflow changed while we
+    rendered, in which case we discarded the render. (The change's Delta
+    queues its own render.) Raise WfModule.DoesNotExist or
+    Workflow.DoesNotExist if the WfModule or workflow is gone.
+
+    You must _not_ call this within a workflow.cooperative_lock().
+    """
+    n_queries = 0
+    n_renders = 0
+    n_skipped = 0
+    while True:
+        with _count_queries() as query_counter:
+            with workflow.cooperative_lock():
+                wf_module = WfModule.objects.get(id=wf_module_id,
+                                                 workflow_id=workflow.id)
+                wf_modules = _load_wf_modules(wf_module)
+                target_index = wf_modules.index(wf_module)
+                cached_result, step, n_step_skipped = _execute_until_render(
+                    wf_modules,
+                    target_index,
+                    on_cache
+                )
+                if step is not None:
+                    step.snapshot_input()
+        n_queries += query_counter.n_queries
+        n_skipped += n_step_skipped
+
+        if step is None:
+            report = RenderReport(cached_result, n_queries, n_renders,
+                                  n_skipped)
+            logger.info(('Executed wf_module %d unlocked: %d queries, '
+                         '%d renders, %d skipped'),
+                        wf_module_id, report.n_queries, report.n_renders,
+                        report.n_skipped)
+            return report
+
+        # No transaction is open: other requests can read and write.
+        try:
+            result = step.render()
+        finally:
+            step.close()
+        pending_path = CachedRenderResult.write_pending_parquet(
+            step.wf_module,
+            result
+        )
+        result_hash = hash_table_with_schema(result.dataframe)
+
+        try:
+            with _count_queries() as query_counter:
+                with workflow.cooperative_lock():
+                    delta_id = WfModule.objects \
+                        .filter(id=step.wf_module.id,
+                                workflow_id=workflow.id) \
+                        .values_list('last_relevant_delta_id', flat=True) \
+                        .first()
+                    if delta_id != step.delta_id:
+                        logger.info(('Discarded stale render of wf_module %d '
+                                     'at delta %d'),
+                                    step.wf_module.id, step.delta_id)
+                        return None
+
+                    cached_result = \
+                        CachedRenderResult.assign_wf_module_from_file(
+                            step.wf_module,
+                            step.delta_id,
+                            result.error,
+                            result.json,
+                            result_hash,
+                            step.fingerprint or '',
+                            pending_path,
+                            result=result
+                        )
+                    # Other fields may have changed while we rendered: only
+                    # write our own.
+                    _finish_caching(
+                        step.wf_module,
+                        cached_result,
+                        on_cache,
+                        update_fields=CachedRenderResult.WfModuleFields
+                    )
+            n_queries += query_counter.n_queries
+        finally:
+            try:
+                os.remove(pending_path)
+            except FileNotFoundError:
+                pass
+
+        if step.fingerprint is not None:
+            sharedrendercache.store(step.fingerprint, cached_result)
+        n_renders += 1
+
+
+def execute_wfmodule(wf_module: WfModule) -> ProcessResult:
+    """
+    Process all WfModules until the given one; return its result.
+
+    This will both read and write each WfModule's cached render result.
+
+    You must call this within a workflow.cooperative_lock().
+    """
+    return execute_wfmodule_with_report(wf_module).result
@@ -0,0 +1,78 @@
+import os.path
+import tempfile
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+import numpy
+import pandas
+from server import parquet
+
+
+def _build_table(n_rows: int) -> pandas.DataFrame:
+    """Build a table that resembles typical user data."""
+    random = numpy.random.RandomState(0)
+    return pandas.DataFrame({
+        'id': numpy.arange(n_rows),
+        'amount': random.rand(n_rows) * 1000,
+        'category': random.choice(['a', 'bb', 'ccc', 'dddd'], n_rows),
+        'text': pandas.Series(numpy.arange(n_rows)).astype(str) + ' words',
+        'date': pandas.date_range('2018-01-01', periods=n_rows, freq='min'),
+    })
+
+
+def _time(fn, n_runs: int) -> float:
+    """Return the mean duration of `fn()`, in seconds."""
+    start = time.perf_counter()
+    for _ in range(n_runs):
+        fn()
+    return (time.perf_counter() - start) / n_runs
+
+
+class Command(BaseCommand):
+    help = (
+        'Compare Parquet page-read latency and full-read throughput for '
+        'single-row-group files and files with bounded row groups'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+',
+                            default=[100000, 1000000])
+        parser.add_argument('--page-size', type=int, default=300)
+        parser.add_argument('--runs', type=int, default=5)
+
+    def handle(self, *args, **options):
+        layouts = [
+            ('single group', None),
+            (f'{settings.PARQUET_ROW_GROUP_SIZE}-row groups',
+             settings.PARQUET_ROW_GROUP_SIZE),
+        ]
+        page_size = options['page_size']
+        n_runs = options['runs']
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            for n_rows in options['rows']:
+                table = _build_table(n_rows)
+                middle = n_rows // 2
+
+                for name, row_group_size in layouts:
+                    path = os.path.join(tempdir, f'{n_rows}-{name}.dat')
+                    parquet.write(path, table, row_group_size=row_group_size)
+                    size = os.stat(path).st_size
+
+                    def read_page():
+                        parquet_file = parquet.read_header(path)
+                        parquet.read_slice(parquet_file, middle,
+                                           middle + page_size)
+
+                    def read_all():
+                        parquet.read(path)
+
+                    page_seconds = _time(read_page, n_runs)
+                    full_seconds = _time(read_all, n_runs)
+
+                    self.stdout.write(
+                        f'{n_rows} rows, {name}: {size} bytes; '
+                        f'{page_size}-row page in {page_seconds * 1000:.1f}ms; '
+                        f'full read in {full_seconds * 1000:.1f}ms '
+                        f'({n_rows / full_seconds:.0f} rows/s)'
+                    )
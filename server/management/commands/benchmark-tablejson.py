@@ -0,0 +1,72 @@
+import json
+import time
+from django.core.management.base import BaseCommand
+import numpy
+import pandas
+from server import tablejson
+
+
+def _build_table(n_rows: int, n_columns: int) -> pandas.DataFrame:
+    """Build a /render page that resembles typical user data."""
+    random = numpy.random.RandomState(0)
+    columns = {}
+    for i in range(n_columns):
+        if i % 5 == 0:
+            values = numpy.arange(n_rows, dtype='int64')
+        elif i % 5 == 1:
+            values = random.rand(n_rows)
+            values[::7] = numpy.nan
+        elif i % 5 == 2:
+            values = pandas.date_range('2018-01-01', periods=n_rows, freq='H')
+        elif i % 5 == 3:
+            values = pandas.Series([f'value {j}' for j in range(n_rows)])
+            values[::11] = None
+        else:
+            values = pandas.Series(random.choice(['a', 'b', 'c'], n_rows),
+                                   dtype='category')
+        columns[f'column {i}'] = values
+    return pandas.DataFrame(columns)
+
+
+def _to_json_loads_dumps(table: pandas.DataFrame) -> bytes:
+    """Encode the way /render did before tablejson."""
+    rows = json.loads(table.to_json(orient='records', date_format='iso'))
+    return json.dumps({'rows': rows}).encode('utf-8')
+
+
+def _records_json(table: pandas.DataFrame) -> bytes:
+    return ('{"rows":' + tablejson.records_json(table) + '}').encode('utf-8')
+
+
+def _columns_json(table: pandas.DataFrame) -> bytes:
+    return ('{"data":' + tablejson.columns_json(table) + '}').encode('utf-8')
+
+
+def _time(fn, n_runs: int) -> float:
+    """Return the mean duration of `fn()`, in seconds."""
+    start = time.perf_counter()
+    for _ in range(n_runs):
+        fn()
+    return (time.perf_counter() - start) / n_runs
+
+
+class Command(BaseCommand):
+    help = 'Compare the encoders of /render pages: latency and size'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=300)
+        parser.add_argument('--columns', type=int, default=50)
+        parser.add_argument('--runs', type=int, default=20)
+
+    def handle(self, *args, **options):
+        table = _build_table(options['rows'], options['columns'])
+        n_runs = options['runs']
+
+        for name, encode in [
+            ('to_json + loads + dumps', _to_json_loads_dumps),
+            ('tablejson.records_json', _records_json),
+            ('tablejson.columns_json', _columns_json),
+        ]:
+            seconds = _time(lambda: encode(table), n_runs)
+            size = len(encode(table))
+            self.stdout.write(f'{name}: {seconds * 1000:.2f}ms, {size} bytes')
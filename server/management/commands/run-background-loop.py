@@ -1,7 +1,8 @@
 import time
 from django.core.management.base import BaseCommand
+from server import sharedrendercache
 from server.maintenance import delete_expired_anonymous_workflows
-from server.updates import update_wfm_data_scan
+from server.updates import run_queued_fetches, update_wfm_data_scan
 from server.utils import get_console_logger
 
 
@@ -9,10 +10,11 @@ _logger = get_console_logger()
 
 
 _MaxDelay = 60 # seconds
+_FetchPollDelay = 1 # seconds
 
 
 class Command(BaseCommand):
-    help = 'Continually deletes expired anonymous workflows and polls wfmodules for updates'
+    help = 'Continually deletes expired anonymous workflows, runs queued fetches, polls wfmodules for updates and evicts shared render results'
 
     def handle(self, *args, **options):
         while True:
@@ -28,7 +30,19 @@ class Command(BaseCommand):
             except Exception as err:
                 _logger.exception(err)
 
-            time2 = time.time()
-            duration = time2 - time1
-            delay = max(0, _MaxDelay - duration)
-            time.sleep(delay)
+            try:
+                sharedrendercache.evict()
+            except Exception as err:
+                _logger.exception(err)
+
+            # Until the next round, run fetches users ask for. (Run
+            # `run-fetch-worker` processes, too, to fetch more at once.)
+            while time.time() - time1 < _MaxDelay:
+                try:
+                    n_fetches = run_queued_fetches()
+                except Exception as err:
+                    _logger.exception(err)
+                    n_fetches = 0
+
+                if n_fetches == 0:
+                    time.sleep(_FetchPollDelay)
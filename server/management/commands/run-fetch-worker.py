@@ -0,0 +1,31 @@
+import time
+from django.core.management.base import BaseCommand
+from server.updates import run_queued_fetches, update_wfm_data_scan
+from server.utils import get_console_logger
+
+
+_logger = get_console_logger()
+
+
+_PollDelay = 1 # seconds
+
+
+class Command(BaseCommand):
+    help = 'Continually runs queued fetches and scheduled updates. Run as many as you like.'
+
+    def handle(self, *args, **options):
+        while True:
+            n_jobs = 0
+
+            try:
+                n_jobs += run_queued_fetches()
+            except Exception as err:
+                _logger.exception(err)
+
+            try:
+                n_jobs += update_wfm_data_scan()
+            except Exception as err:
+                _logger.exception(err)
+
+            if n_jobs == 0:
+                time.sleep(_PollDelay)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2018-09-04 15:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0121_workflow_in_all_users_workflow_lists'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wfmodule',
+            name='cached_render_result_fingerprint',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+        migrations.AddField(
+            model_name='wfmodule',
+            name='cached_render_result_hash',
+            field=models.CharField(blank=True, max_length=40),
+        ),
+    ]
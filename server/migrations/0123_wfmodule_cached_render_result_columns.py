@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2018-09-06 14:27
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0122_wfmodule_cached_render_result_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wfmodule',
+            name='cached_render_result_columns',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='wfmodule',
+            name='cached_render_result_nrows',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2018-09-07 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0123_wfmodule_cached_render_result_columns'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='storedobject',
+            name='column_hashes',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='storedobject',
+            name='nrows',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
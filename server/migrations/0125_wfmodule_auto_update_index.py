@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2018-09-07 15:40
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0124_storedobject_column_hashes'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='wfmodule',
+            index_together=set([('auto_update_data', 'next_update')]),
+        ),
+    ]
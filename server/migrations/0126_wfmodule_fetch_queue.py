@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11 on 2018-09-08 11:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('server', '0125_wfmodule_auto_update_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wfmodule',
+            name='fetch_claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='wfmodule',
+            name='fetch_queued_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -1,11 +1,19 @@
+import bisect
+from collections import namedtuple
+import hashlib
 import os
 import json
-from typing import Any, Dict, List, Optional
+import shutil
+import sys
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from django.conf import settings
 from django.core.files.storage import default_storage
 import pandas
 from pandas.api.types import is_numeric_dtype, is_datetime64_dtype
 from server.modules.types import Column, ProcessResult
-from server import parquet
+from server import dataframecache, parquet
+from server.pandas_util import hash_table_with_schema
 
 
 def _parquet_path(workflow_id: int, wf_module_id: int):
@@ -14,6 +22,140 @@ def _parquet_path(workflow_id: int, wf_module_id: int):
     return default_storage.path(path)
 
 
+def _value_counts_dir(workflow_id: int, wf_module_id: int) -> str:
+    """Return the directory beside the Parquet file for value counts."""
+    return default_storage.path(
+        f'cached-render-results/wf-{workflow_id}/'
+        f'wfm-{wf_module_id}-value-counts'
+    )
+
+
+def _temp_path(path: str) -> str:
+    """Return a unique path in the same directory as `path`."""
+    return f'{path}.{uuid.uuid4().hex}.tmp'
+
+
+def _remove_if_exists(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+_ValueCountsPaths = namedtuple('_ValueCountsPaths',
+                               ['by_count', 'by_value', 'index'])
+
+
+def _value_counts_paths(prefix: str) -> _ValueCountsPaths:
+    """Return the paths of one column's value-counts sidecars."""
+    return _ValueCountsPaths(prefix + '-by-count.dat',
+                             prefix + '-by-value.dat',
+                             prefix + '-index.json')
+
+
+def _replace_with(path: str, write: Callable[[str], None]) -> None:
+    """Call `write(temp_path)`, then move the result to `path`."""
+    temp_path = _temp_path(path)
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    except BaseException:
+        _remove_if_exists(temp_path)
+        raise
+
+
+def _write_value_counts(series: pandas.Series,
+                        paths: _ValueCountsPaths) -> Dict[str, Any]:
+    """
+    Count values in `series` and write them to sidecars; return the index.
+
+    `paths.by_count` holds `value` and `count` columns, most common first
+    (ties alphabetical, so paging is stable). `paths.by_value` holds the same
+    rows plus `folded` (lowercase `value`), sorted by `folded`. The index,
+    written last, holds `n_values` and `by_value_groups`: the `[folded,
+    start_row]` of each `paths.by_value` row group.
+    """
+    if not (series.dtype == object or hasattr(series, 'cat')):
+        t = series.astype(str)
+        t[series.isna()] = None
+        series = t
+
+    counts = series.value_counts()
+    by_count = sorted(((str(value), int(count))
+                       for value, count in counts.items()),
+                      key=lambda pair: (-pair[1], pair[0]))
+    by_value = sorted((value.lower(), value, count)
+                      for value, count in by_count)
+
+    row_group_size = settings.PARQUET_ROW_GROUP_SIZE or len(by_value)
+    starts = range(0, len(by_value), max(1, row_group_size))
+
+    if by_count:
+        def write_by_count(path):
+            parquet.write(path,
+                          pandas.DataFrame(by_count,
+                                           columns=['value', 'count']),
+                          row_group_size=settings.PARQUET_ROW_GROUP_SIZE)
+
+        def write_by_value(path):
+            # One row group per chunk, so the index knows where each starts
+            for start in starts:
+                chunk = pandas.DataFrame(
+                    by_value[start:start + row_group_size],
+                    columns=['folded', 'value', 'count']
+                )
+                if start == 0:
+                    parquet.write(path, chunk)
+                else:
+                    parquet.append(path, chunk)
+
+        _replace_with(paths.by_count, write_by_count)
+        _replace_with(paths.by_value, write_by_value)
+
+    index = {
+        'n_values': len(by_count),
+        'by_value_groups': [[by_value[start][0], start] for start in starts],
+    }
+
+    def write_index(path):
+        with open(path, 'w') as f:
+            json.dump(index, f)
+
+    _replace_with(paths.index, write_index)
+
+    return index
+
+
+def _prefix_rows(index: Dict[str, Any], prefix: str) -> Tuple[int, int]:
+    """
+    Find rows [start, end) of a by-value sidecar that can start with `prefix`.
+
+    Values that start with `prefix` sort together: at or after `prefix`, and
+    before `prefix` with its last character incremented. We find the row
+    groups that hold them by bisecting the groups' first values.
+    """
+    groups = index['by_value_groups']
+    firsts = [folded for folded, _ in groups]
+
+    # The group before the first one starting at `prefix` may end with it
+    first = max(0, bisect.bisect_left(firsts, prefix) - 1)
+
+    last_char = ord(prefix[-1])
+    if last_char < sys.maxunicode:
+        stop = prefix[:-1] + chr(last_char + 1)
+        last = bisect.bisect_left(firsts, stop)
+    else:
+        last = len(groups)
+
+    end = groups[last][1] if last < len(groups) else index['n_values']
+    return (groups[first][1], end)
+
+
+def _value_count_pairs(dataframe: pandas.DataFrame) -> List[Tuple[str, int]]:
+    return [(value, int(count))
+            for value, count in zip(dataframe['value'], dataframe['count'])]
+
+
 def _dtype_to_column_type(dtype) -> str:
     """Determine if a pandas dtype is 'text', 'number' or 'datetime'."""
     if is_numeric_dtype(dtype):
@@ -26,6 +168,18 @@ def _dtype_to_column_type(dtype) -> str:
         raise ValueError(f'Unknown column type: {dtype}')
 
 
+def _columns_to_bytes(columns: List[Column]) -> bytes:
+    return json.dumps([[c.name, c.type] for c in columns]).encode('utf-8')
+
+
+def _columns_from_bytes(columns_bytes: Optional[bytes]
+                        ) -> Optional[List[Column]]:
+    if columns_bytes is None:
+        return None
+    # BinaryField values are sometimes memoryviews
+    return [Column(n, t) for n, t in json.loads(bytes(columns_bytes))]
+
+
 class CachedRenderResult:
     """
     Result of a ModuleImpl.render() call.
@@ -36,15 +190,46 @@ class CachedRenderResult:
     has no pros, only cons.)
 
     Part of this result is also stored on disk. Read it as `parquet_file`.
+
+    `hash` identifies the output table's contents, so callers can tell whether
+    two results hold the same table without reading either. It is '' for
+    results cached before we computed hashes.
+
+    The output columns and row count are stored in the database, too, so
+    `columns` and `total_rows` don't touch the disk. (For results cached
+    before we stored them, they read the Parquet header.)
     """
 
+    # The WfModule fields that hold a cached render result. The assign_*()
+    # and restamp_*() methods write all of them; callers that save with
+    # `update_fields` must list every one.
+    WfModuleFields = [
+        'cached_render_result_workflow_id',
+        'cached_render_result_delta_id',
+        'cached_render_result_error',
+        'cached_render_result_json',
+        'cached_render_result_hash',
+        'cached_render_result_fingerprint',
+        'cached_render_result_columns',
+        'cached_render_result_nrows',
+    ]
+
     def __init__(self, workflow_id: int, wf_module_id: int,
-                 delta_id: int, error: str, json: Dict[str, Any]):
+                 delta_id: int, error: str, json: Dict[str, Any],
+                 hash: str='', columns: Optional[List[Column]]=None,
+                 nrows: Optional[int]=None):
         self.workflow_id = workflow_id
         self.wf_module_id = wf_module_id
         self.delta_id = delta_id
         self.error = error
         self.json = json
+        self.hash = hash
+        self._columns = columns
+        self._nrows = nrows
+
+    @property
+    def _dataframe_cache_key(self):
+        return (self.wf_module_id, self.delta_id)
 
     @property
     def parquet_path(self):
@@ -81,48 +266,171 @@ class CachedRenderResult:
     @property
     def result(self):
         if not hasattr(self, '_result'):
-            if self.parquet_file:
-                # At this point, we know the file exists. (It may be an empty
-                # DataFrame.)
-                dataframe = self.parquet_file.to_pandas()
-            else:
-                dataframe = pandas.DataFrame()
+            key = self._dataframe_cache_key
+            dataframe = dataframecache.cache.get(key)
+            if dataframe is None:
+                if self.parquet_file:
+                    # At this point, we know the file exists. (It may be an
+                    # empty DataFrame.)
+                    dataframe = self.parquet_file.to_pandas()
+                else:
+                    dataframe = pandas.DataFrame()
+                dataframecache.cache.put(key, dataframe)
 
             self._result = ProcessResult(dataframe, self.error, self.json)
 
         return self._result
 
     @property
-    def column_names(self) -> List[str]:
+    def total_rows(self) -> int:
         """
-        Scan on-disk header for column names.
+        Count rows, from the database or the on-disk footer.
 
         This does not read the entire DataFrame.
         """
-        if self.parquet_file:
-            return self.parquet_file.columns
+        if self._nrows is not None:
+            return self._nrows
+        elif hasattr(self, '_result'):
+            return len(self._result.dataframe)
+        elif self.parquet_file:
+            return parquet.count_rows(self.parquet_file)
+        else:
+            return 0
+
+    def read_dataframe(self, start_row: int, end_row: int,
+                       columns: Optional[List[str]]=None) -> pandas.DataFrame:
+        """
+        Read rows [start_row, end_row) of the result, and maybe fewer columns.
+
+        If the whole result is in memory, we slice it. Otherwise, we only
+        decode the on-disk row groups that hold the requested rows.
+        """
+        if hasattr(self, '_result'):
+            dataframe = self._result.dataframe
+            if columns is not None:
+                dataframe = dataframe[columns]
+            return dataframe[max(0, start_row):end_row]
+
+        dataframe = dataframecache.cache.get_slice(self._dataframe_cache_key,
+                                                   start_row, end_row)
+        if dataframe is not None:
+            if columns is not None:
+                dataframe = dataframe[columns]
+            return dataframe
+        elif self.parquet_file:
+            return parquet.read_slice(self.parquet_file, start_row, end_row,
+                                      columns)
         else:
-            return []
+            return pandas.DataFrame()
 
     @property
-    def column_types(self) -> List[str]:
+    def column_names(self) -> List[str]:
         """
-        Scan on-disk header for column types -- text, number or datetime.
+        List column names.
 
         This does not read the entire DataFrame.
         """
-        if self.parquet_file:
-            dtypes = self.parquet_file.dtypes.values()
-        else:
-            dtypes = []
+        return [c.name for c in self.columns]
 
-        return [_dtype_to_column_type(t) for t in dtypes]
+    @property
+    def column_types(self) -> List[str]:
+        """
+        List column types -- text, number or datetime.
+
+        This does not read the entire DataFrame.
+        """
+        return [c.type for c in self.columns]
 
     @property
-    def columns(self):
-        """Scan on-disk header for columns and their types."""
-        return [Column(n, t)
-                for n, t in zip(self.column_names, self.column_types)]
+    def columns(self) -> List[Column]:
+        """
+        List columns and their types.
+
+        We read them from the database. For results cached before we stored
+        them there, we scan the on-disk header instead.
+        """
+        if self._columns is None:
+            if self.parquet_file:
+                self._columns = [
+                    Column(n, _dtype_to_column_type(t))
+                    for n, t in self.parquet_file.dtypes.items()
+                ]
+            else:
+                self._columns = []
+
+        return self._columns
+
+    def value_counts(self, column: str, prefix: str='', offset: int=0,
+                     limit: Optional[int]=None
+                     ) -> Tuple[List[Tuple[str, int]], int]:
+        """
+        Count each value in `column`, most common first, and return a page.
+
+        Values are strings: we convert other types to str. We omit nulls.
+        `prefix`, if set, selects values that start with it
+        (case-insensitive). `offset` and `limit` select a page of those
+        values; `limit=None` means, "every value from `offset` on."
+
+        Return `(page, n_values)`: `(value, count)` pairs, and the number of
+        distinct values that match `prefix`. Raise KeyError if there is no
+        such column.
+
+        We count once per result and column, and store the counts in sidecars
+        beside the Parquet file. We only decode the one column we count. One
+        sidecar is most common first, so we read just the row groups of the
+        page. The other is sorted by lowercase value and indexed by each row
+        group's first value, so we read just the groups that can match
+        `prefix`.
+        """
+        if column not in self.column_names:
+            raise KeyError(column)
+
+        # Key on the table's contents, so counts survive re-stamps and
+        # restores. Results cached before we computed hashes key on delta.
+        result_key = self.hash or f'delta-{self.delta_id}'
+        column_key = hashlib.sha1(column.encode('utf-8')).hexdigest()
+        dirname = _value_counts_dir(self.workflow_id, self.wf_module_id)
+        paths = _value_counts_paths(
+            os.path.join(dirname, f'{result_key}-{column_key}')
+        )
+
+        try:
+            with open(paths.index, 'rb') as f:
+                index = json.load(f)
+        except FileNotFoundError:
+            os.makedirs(dirname, exist_ok=True)
+            # Nobody will read other results' counts again
+            for name in os.listdir(dirname):
+                if not name.startswith(result_key + '-'):
+                    _remove_if_exists(os.path.join(dirname, name))
+
+            series = self.read_dataframe(0, self.total_rows, [column])[column]
+            index = _write_value_counts(series, paths)
+
+        n_values = index['n_values']
+        if n_values == 0:
+            return ([], 0)
+
+        if not prefix:
+            end = n_values if limit is None else min(offset + limit, n_values)
+            if offset >= end:
+                return ([], n_values)
+            by_count = parquet.read_header(paths.by_count)
+            page = parquet.read_slice(by_count, offset, end)
+            return (_value_count_pairs(page), n_values)
+
+        prefix = prefix.lower()
+        start_row, end_row = _prefix_rows(index, prefix)
+        by_value = parquet.read_header(paths.by_value)
+        dataframe = parquet.read_slice(by_value, start_row, end_row)
+        dataframe = dataframe[dataframe['folded'].str.startswith(prefix)]
+        matches = sorted(_value_count_pairs(dataframe),
+                         key=lambda pair: (-pair[1], pair[0]))
+        if limit is None:
+            page = matches[offset:]
+        else:
+            page = matches[offset:offset + limit]
+        return (page, len(matches))
 
     @staticmethod
     def from_wf_module(wf_module: 'WfModule') -> 'CachedRenderResult':
@@ -158,9 +466,18 @@ class CachedRenderResult:
         else:
             json_dict = None
 
-        ret = CachedRenderResult(workflow_id=workflow_id,
-                                 wf_module_id=wf_module_id, delta_id=delta_id,
-                                 error=error, json=json_dict)
+        ret = CachedRenderResult(
+            workflow_id=workflow_id,
+            wf_module_id=wf_module_id,
+            delta_id=delta_id,
+            error=error,
+            json=json_dict,
+            hash=wf_module.cached_render_result_hash,
+            columns=_columns_from_bytes(
+                wf_module.cached_render_result_columns
+            ),
+            nrows=wf_module.cached_render_result_nrows
+        )
         # Keep in mind: ret.parquet_file has not been loaded yet. That means
         # this result is _not_ a snapshot in time, and you must be careful not
         # to treat it as such.
@@ -174,6 +491,12 @@ class CachedRenderResult:
         wf_module.cached_render_result_delta_id = None
         wf_module.cached_render_result_json = b'null'
         wf_module.cached_render_result_error = ''
+        wf_module.cached_render_result_hash = ''
+        wf_module.cached_render_result_fingerprint = ''
+        wf_module.cached_render_result_columns = None
+        wf_module.cached_render_result_nrows = None
+
+        dataframecache.cache.discard_wf_module(wf_module.id)
 
         if workflow_id is not None:
             # We're setting non-None to None. That means there's probably
@@ -184,14 +507,21 @@ class CachedRenderResult:
             except FileNotFoundError:
                 pass
 
+            shutil.rmtree(_value_counts_dir(workflow_id, wf_module.id),
+                          ignore_errors=True)
+
     @staticmethod
     def assign_wf_module(wf_module: 'WfModule',
                          delta_id: Optional[int],
-                         result: Optional[ProcessResult]
+                         result: Optional[ProcessResult],
+                         fingerprint: str=''
                          ) -> Optional['CachedRenderResult']:
         """
         Write `result` to `wf_module`'s fields and to disk.
 
+        `fingerprint` identifies the inputs that produced `result`. (See
+        execute.py.)
+
         If either argument is None, clear the fields.
         """
         if delta_id is None or result is None:
@@ -213,6 +543,12 @@ class CachedRenderResult:
         wf_module.cached_render_result_delta_id = delta_id
         wf_module.cached_render_result_error = error
         wf_module.cached_render_result_json = json_bytes
+        wf_module.cached_render_result_hash = \
+            hash_table_with_schema(result.dataframe)
+        wf_module.cached_render_result_fingerprint = fingerprint
+        wf_module.cached_render_result_columns = \
+            _columns_to_bytes(result.columns)
+        wf_module.cached_render_result_nrows = len(result.dataframe)
 
         parquet_path = _parquet_path(wf_module.workflow_id, wf_module.id)
 
@@ -225,9 +561,144 @@ class CachedRenderResult:
                 pass
             return None
         else:
-            parquet.write(parquet_path, result.dataframe)
+            # Write to a temporary file and rename it into place. The old file
+            # may be hard-linked elsewhere (see sharedrendercache), so we must
+            # never overwrite its contents.
+            temp_path = _temp_path(parquet_path)
+            try:
+                parquet.write(temp_path, result.dataframe,
+                              row_group_size=settings.PARQUET_ROW_GROUP_SIZE)
+                os.replace(temp_path, parquet_path)
+            except BaseException:
+                _remove_if_exists(temp_path)
+                raise
+
+            # Evict results from earlier deltas: they're gone from disk.
+            dataframecache.cache.discard_wf_module(wf_module.id)
+            dataframecache.cache.put((wf_module.id, delta_id),
+                                     result.dataframe)
+
+            ret = CachedRenderResult(workflow_id=wf_module.workflow_id,
+                                     wf_module_id=wf_module.id,
+                                     delta_id=delta_id,
+                                     error=error, json=json_dict,
+                                     hash=wf_module.cached_render_result_hash,
+                                     columns=result.columns,
+                                     nrows=len(result.dataframe))
+            # We just rendered this result, so there's no need to read it back
+            # from disk.
+            ret._result = result
+            return ret
+
+    @staticmethod
+    def write_pending_parquet(wf_module: 'WfModule',
+                              result: ProcessResult) -> str:
+        """
+        Write `result`'s table to a new file; return its path.
+
+        The file sits beside `wf_module`'s cached Parquet file, so
+        assign_wf_module_from_file() can hard-link it into place. The caller
+        must delete it afterwards.
+
+        This touches no database fields, so it is safe to call outside of a
+        transaction.
+        """
+        if wf_module.workflow_id is None:
+            raise ValueError('Cannot cache render result on orphan WfModule')
+
+        parquet_path = _parquet_path(wf_module.workflow_id, wf_module.id)
+        os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+
+        temp_path = _temp_path(parquet_path)
+        try:
+            parquet.write(temp_path, result.dataframe,
+                          row_group_size=settings.PARQUET_ROW_GROUP_SIZE)
+        except BaseException:
+            _remove_if_exists(temp_path)
+            raise
+        return temp_path
 
-            return CachedRenderResult(workflow_id=wf_module.workflow_id,
-                                      wf_module_id=wf_module.id,
-                                      delta_id=delta_id,
-                                      error=error, json=json_dict)
+    @staticmethod
+    def assign_wf_module_from_file(wf_module: 'WfModule', delta_id: int,
+                                   error: str, json_dict: Dict[str, Any],
+                                   hash: str, fingerprint: str,
+                                   path: str,
+                                   columns: Optional[List[Column]]=None,
+                                   nrows: Optional[int]=None,
+                                   result: Optional[ProcessResult]=None
+                                   ) -> 'CachedRenderResult':
+        """
+        Write a result to `wf_module`'s fields, using an existing Parquet file.
+
+        `hash` must be the hash of the table in `path`, and `columns` and
+        `nrows` should describe it. (If they are None, readers will scan the
+        Parquet header.) If the caller has the result in memory, it may pass
+        it as `result` instead of `columns` and `nrows`, to spare us reading
+        it.
+
+        We hard-link `path` into place rather than copying it. (If we can't
+        hard-link -- say, `path` is on a different filesystem -- we copy.)
+        Raise FileNotFoundError if `path` does not exist.
+        """
+        if wf_module.workflow_id is None:
+            raise ValueError('Cannot cache render result on orphan WfModule')
+
+        parquet_path = _parquet_path(wf_module.workflow_id, wf_module.id)
+        os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+
+        temp_path = _temp_path(parquet_path)
+        try:
+            try:
+                os.link(path, temp_path)
+            except FileNotFoundError:
+                raise
+            except OSError:
+                shutil.copyfile(path, temp_path)
+            os.replace(temp_path, parquet_path)
+        except BaseException:
+            _remove_if_exists(temp_path)
+            raise
+
+        wf_module.cached_render_result_workflow_id = wf_module.workflow_id
+        wf_module.cached_render_result_delta_id = delta_id
+        wf_module.cached_render_result_error = error
+        wf_module.cached_render_result_json = \
+            json.dumps(json_dict).encode('utf-8')
+        if result is not None:
+            columns = result.columns
+            nrows = len(result.dataframe)
+
+        wf_module.cached_render_result_hash = hash
+        wf_module.cached_render_result_fingerprint = fingerprint
+        wf_module.cached_render_result_columns = \
+            None if columns is None else _columns_to_bytes(columns)
+        wf_module.cached_render_result_nrows = nrows
+
+        dataframecache.cache.discard_wf_module(wf_module.id)
+
+        ret = CachedRenderResult(workflow_id=wf_module.workflow_id,
+                                 wf_module_id=wf_module.id,
+                                 delta_id=delta_id, error=error,
+                                 json=json_dict, hash=hash, columns=columns,
+                                 nrows=nrows)
+        if result is not None:
+            dataframecache.cache.put((wf_module.id, delta_id),
+                                     result.dataframe)
+            ret._result = result
+        return ret
+
+    @staticmethod
+    def restamp_wf_module(wf_module: 'WfModule',
+                          delta_id: int) -> 'CachedRenderResult':
+        """
+        Mark `wf_module`'s cached result as the result at `delta_id`.
+
+        Call this when the new delta cannot have changed the result: that is,
+        when the module's inputs are the ones that produced the cached result.
+        This touches no files.
+        """
+        old_delta_id = wf_module.cached_render_result_delta_id
+        wf_module.cached_render_result_delta_id = delta_id
+        dataframecache.cache.rekey((wf_module.id, old_delta_id),
+                                   (wf_module.id, delta_id))
+        return CachedRenderResult.from_wf_module(wf_module)
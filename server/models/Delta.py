@@ -52,12 +52,26 @@ class Delta(PolymorphicModel):
         with self.workflow.cooperative_lock():
             self.forward_impl()
         self.ws_notify()
+        self.schedule_render()
 
     def backward(self):
         """Call backward_impl() with workflow.cooperative_lock()."""
         with self.workflow.cooperative_lock():
             self.backward_impl()
         self.ws_notify()
+        self.schedule_render()
+
+    def schedule_render(self):
+        """
+        Re-render the workflow in the background, if we changed any outputs.
+
+        The render starts once our transaction commits. It renders the
+        selected WfModule first, and it stops if a newer Delta supersedes it.
+        """
+        if hasattr(self, '_changed_wf_module_versions'):
+            # Import here: renderqueue imports models
+            from server import renderqueue
+            renderqueue.request_render_on_commit(self.workflow_id)
 
     def ws_notify(self):
         """
@@ -1,12 +1,16 @@
+import hashlib
+import json
 import os
+from typing import List, Optional
 import uuid
 from shutil import copyfile
+from django.conf import settings
 from django.db import models
 from django.core.files.storage import default_storage
 from django.dispatch import receiver
 from django.utils import timezone
 import pandas as pd
-from server.pandas_util import hash_table
+from server.pandas_util import hash_columns, hash_table
 from server import parquet
 
 # StoredObject is our persistence layer.
@@ -24,6 +28,12 @@ class StoredObject(models.Model):
     metadata = models.CharField(default=None, max_length=255, null=True)
     size = models.IntegerField(default=0)  # file size
 
+    # used only for stored tables: JSON Array of pandas_util.hash_columns(),
+    # plus the row count. We compare these to new tables, so we needn't read
+    # this one. (null for tables stored before we computed them.)
+    column_hashes = models.BinaryField(blank=True, null=True)
+    nrows = models.IntegerField(blank=True, null=True)
+
     # keeping track of whether this version of the data has ever been loaded
     # and delivered to the frontend
     read = models.BooleanField(default=False)
@@ -36,37 +46,129 @@ class StoredObject(models.Model):
         return default_storage.path(fname)
 
     @staticmethod
-    def create_table(wf_module, table, metadata=None):
+    def new_file_path(wf_module) -> str:
+        """
+        Return a new path for a Parquet file, to pass to
+        create_table_from_file_if_different().
+
+        Writers can fill in the file bit by bit, without holding the table.
+        """
+        return StoredObject._storage_filename(wf_module.id)
+
+    @staticmethod
+    def _table_column_hashes(table) -> List[str]:
+        # We store empty tables as DataFrame(), whatever their columns
+        if table is None or table.empty:
+            return []
+        return hash_columns(table)
+
+    @staticmethod
+    def create_table(wf_module, table, metadata=None,
+                     column_hashes: Optional[List[str]]=None):
+        if column_hashes is None:
+            column_hashes = StoredObject._table_column_hashes(table)
+
         if table is None or table.empty:
             return StoredObject.__create_empty_table(wf_module, metadata)
         else:
-            hash = hash_table(table)
-            return StoredObject.__create_table_internal(wf_module, table, metadata, hash)
+            return StoredObject.__create_table_internal(wf_module, table,
+                                                        metadata,
+                                                        column_hashes)
+
+    def _has_table(self, table, column_hashes: List[str]) -> bool:
+        """
+        Return True if this StoredObject holds `table`.
+
+        We compare `column_hashes` to ours, so we don't read our file. Objects
+        stored before we computed column hashes compare whole-table hashes.
+        """
+        if self.column_hashes is None:
+            if table is None or table.empty:
+                return self.size == 0
+            return hash_table(table) == self.hash
+
+        nrows = 0 if table is None else len(table)
+        return self._has_column_hashes(column_hashes, nrows)
+
+    def _has_column_hashes(self, column_hashes: List[str], nrows: int) -> bool:
+        """
+        Return True if this StoredObject holds a table with these hashes.
+
+        Objects stored before we computed column hashes never match.
+        """
+        return (
+            self.column_hashes is not None
+            and nrows == self.nrows
+            and column_hashes == json.loads(bytes(self.column_hashes))
+        )
 
     # Create a new StoredObject if it's going to store different data than the previous one. Otherwise null
-    # Fast; checks hash without loading file contents
+    # Fast; checks hashes without loading file contents
     @staticmethod
     def create_table_if_different(wf_module, old_so, table, metadata=None):
-        if old_so is None:
-            return StoredObject.create_table(wf_module, table, metadata=metadata)
+        column_hashes = StoredObject._table_column_hashes(table)
 
-        hash = hash_table(table)
-        if hash != old_so.hash:
-            return StoredObject.create_table(wf_module, table, metadata=metadata)
-        else:
+        if old_so is not None and old_so._has_table(table, column_hashes):
+            return None
+
+        return StoredObject.create_table(wf_module, table, metadata=metadata,
+                                         column_hashes=column_hashes)
+
+    # True if create_table_if_different() would create a new StoredObject
+    @staticmethod
+    def table_is_different(old_so, table) -> bool:
+        column_hashes = StoredObject._table_column_hashes(table)
+        return old_so is None or not old_so._has_table(table, column_hashes)
+
+    # True if create_table_from_file_if_different() would create a new
+    # StoredObject
+    @staticmethod
+    def table_file_is_different(old_so, column_hashes: List[str],
+                                nrows: int) -> bool:
+        return (
+            old_so is None
+            or not old_so._has_column_hashes(column_hashes, nrows)
+        )
+
+    # Like create_table_if_different(), for a non-empty table written to
+    # `path` (from new_file_path()) already. We delete the file if it's a
+    # duplicate.
+    @staticmethod
+    def create_table_from_file_if_different(wf_module, old_so, path,
+                                            column_hashes: List[str],
+                                            nrows: int, metadata=None):
+        if not StoredObject.table_file_is_different(old_so, column_hashes,
+                                                    nrows):
+            os.remove(path)
             return None
 
+        return StoredObject.__create_table_from_file(wf_module, path,
+                                                     metadata, column_hashes,
+                                                     nrows)
+
     @staticmethod
-    def __create_table_internal(wf_module, table, metadata, hash):
+    def __create_table_internal(wf_module, table, metadata, column_hashes):
         path = StoredObject._storage_filename(wf_module.id)
-        parquet.write(path, table)
+        parquet.write(path, table,
+                      row_group_size=settings.PARQUET_ROW_GROUP_SIZE)
+        return StoredObject.__create_table_from_file(wf_module, path,
+                                                     metadata, column_hashes,
+                                                     len(table))
+
+    @staticmethod
+    def __create_table_from_file(wf_module, path, metadata, column_hashes,
+                                 nrows):
+        column_hashes_bytes = json.dumps(column_hashes).encode('utf-8')
         return StoredObject.objects.create(
             wf_module=wf_module,
             metadata=metadata,
             file=path,
             size=os.stat(path).st_size,
             stored_at=timezone.now(),
-            hash=hash
+            # 32 chars (the column's max_length) of a hash of all columns
+            hash=hashlib.sha1(column_hashes_bytes).hexdigest()[:32],
+            column_hashes=column_hashes_bytes,
+            nrows=nrows
         )
 
     # why store an empty table? so we don't have to re-render to know that the output was empty
@@ -78,7 +180,9 @@ class StoredObject(models.Model):
             file=None,
             size=0,
             stored_at=timezone.now(),
-            hash=0
+            hash=0,
+            column_hashes=b'[]',
+            nrows=0
         )
 
     def get_table(self):
@@ -99,6 +203,8 @@ class StoredObject(models.Model):
         new_so = StoredObject.objects.create(wf_module=to_wf_module,
                                              stored_at=self.stored_at,
                                              hash=self.hash,
+                                             column_hashes=self.column_hashes,
+                                             nrows=self.nrows,
                                              metadata=self.metadata,
                                              file = new_path,
                                              size = self.size)
@@ -35,6 +35,34 @@ class WfModule(models.Model):
     """An instance of a Module in a Workflow."""
     class Meta:
         ordering = ['order']
+        # for updates.update_wfm_data_scan()
+        index_together = [('auto_update_data', 'next_update')]
+
+    # Fields that fetches and the fetch queue write without the workflow's
+    # lock, or from instances other code doesn't hold. Their writers always
+    # pass `update_fields` (or use QuerySet.update()). A plain save() of an
+    # existing WfModule leaves them alone, so a stale instance can't undo a
+    # fetch's status or drop or resurrect a queued fetch.
+    FetchStatusFields = frozenset([
+        'is_busy',
+        'fetch_error',
+        'fetch_queued_at',
+        'fetch_claimed_at',
+    ])
+
+    def save(self, *args, **kwargs):
+        if (
+            not self._state.adding
+            and kwargs.get('update_fields') is None
+            and not kwargs.get('force_insert')
+            and not args
+        ):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in WfModule.FetchStatusFields
+            ]
+        super().save(*args, **kwargs)
 
     def __str__(self):
         if self.workflow is not None:
@@ -43,7 +71,7 @@ class WfModule(models.Model):
             wfstr = ' - deleted from workflow'
         return self.get_module_name() + ' - id: ' + str(self.id) + wfstr
 
-    def create_parameter_dict(self, table):
+    def create_parameter_dict(self, table, column_names=None):
         """Present parameters as a dict, with some inconsistent munging.
 
         A `column` parameter that refers to an invalid column will be renamed
@@ -51,21 +79,40 @@ class WfModule(models.Model):
 
         A `multicolumn` parameter will have its values `strip()`ed and have
         invalid columns removed.
+
+        Only column names matter, so callers that know them (say, from a
+        cached render result) can pass `column_names` and `table=None`.
         """
         pdict = {}
-        for p in self.parameter_vals.all().prefetch_related('parameter_spec'):
+        for p in self._parameter_vals_with_specs():
             type = p.parameter_spec.type
             id_name = p.parameter_spec.id_name
 
             if type == ParameterSpec.COLUMN:
-                pdict[id_name] = _sanitize_column_param(p, table.columns)
+                table_cols = column_names if column_names is not None \
+                        else table.columns
+                pdict[id_name] = _sanitize_column_param(p, table_cols)
             elif type == ParameterSpec.MULTICOLUMN:
-                pdict[id_name] = _sanitize_multicolumn_param(p, table.columns)
+                table_cols = column_names if column_names is not None \
+                        else table.columns
+                pdict[id_name] = _sanitize_multicolumn_param(p, table_cols)
             else:
                 pdict[id_name] = p.get_value()
 
         return pdict
 
+    def _parameter_vals_with_specs(self):
+        """
+        List ParameterVals, with their ParameterSpecs selected.
+
+        If the caller prefetched `parameter_vals` (as execute.py does), this
+        does not query the database.
+        """
+        if 'parameter_vals' in getattr(self, '_prefetched_objects_cache', {}):
+            return self.parameter_vals.all()
+        else:
+            return self.parameter_vals.all().prefetch_related('parameter_spec')
+
     # --- Fields ----
     workflow = models.ForeignKey(
         'Workflow',
@@ -107,6 +154,13 @@ class WfModule(models.Model):
     update_interval = models.IntegerField(default=86400)
     last_update_check = models.DateTimeField(null=True, blank=True)
 
+    # Fetch queue (see updates.queue_fetch()): when did a user ask for a
+    # fetch, and when did a fetch worker start it? Both are null when no fetch
+    # is queued or running.
+    fetch_queued_at = models.DateTimeField(null=True, blank=True,
+                                           db_index=True)
+    fetch_claimed_at = models.DateTimeField(null=True, blank=True)
+
     # true means, 'email owner when output changes'
     notifications = models.BooleanField(default=False)
 
@@ -120,6 +174,17 @@ class WfModule(models.Model):
     cached_render_result_delta_id = models.IntegerField(null=True, blank=True)
     cached_render_result_error = models.TextField(blank=True)
     cached_render_result_json = models.BinaryField(blank=True)
+    # Hash of the cached output table, and of the inputs that produced it.
+    # When a render's inputs match the fingerprint, it would produce the same
+    # output: execute.py skips it.
+    cached_render_result_hash = models.CharField(max_length=40, blank=True)
+    cached_render_result_fingerprint = models.CharField(max_length=40,
+                                                        blank=True)
+    # Output columns (JSON [[name, type], ...]) and row count, so readers
+    # needn't open the Parquet file. NULL for results cached before we
+    # stored them.
+    cached_render_result_columns = models.BinaryField(null=True, blank=True)
+    cached_render_result_nrows = models.IntegerField(null=True, blank=True)
 
     READY = "ready"
     BUSY = "busy"
@@ -209,6 +274,42 @@ class WfModule(models.Model):
                                                              metadata=metadata)
         return new_version.stored_at if new_version else None
 
+    # Like store_fetched_table_if_different(), for a non-empty table written
+    # to `path` (from StoredObject.new_file_path()) already
+    def store_fetched_table_file_if_different(self, path, column_hashes,
+                                              nrows, metadata=''):
+        reference_so = StoredObject.objects.filter(
+            wf_module=self
+        ).order_by('-stored_at').first()
+
+        new_version = StoredObject.create_table_from_file_if_different(
+            self,
+            reference_so,
+            path,
+            column_hashes,
+            nrows,
+            metadata=metadata
+        )
+        return new_version.stored_at if new_version else None
+
+    # True if store_fetched_table_if_different() would store `table`.
+    # Compares hashes: doesn't read the stored table.
+    def fetched_table_is_different(self, table):
+        reference_so = StoredObject.objects.filter(
+            wf_module=self
+        ).order_by('-stored_at').first()
+
+        return StoredObject.table_is_different(reference_so, table)
+
+    # True if store_fetched_table_file_if_different() would store the file
+    def fetched_table_file_is_different(self, column_hashes, nrows):
+        reference_so = StoredObject.objects.filter(
+            wf_module=self
+        ).order_by('-stored_at').first()
+
+        return StoredObject.table_file_is_different(reference_so,
+                                                    column_hashes, nrows)
+
     def retrieve_fetched_table(self):
         if self.stored_data_version:
             return StoredObject.objects.get(
@@ -248,7 +349,25 @@ class WfModule(models.Model):
             pv.init_from_spec()
             pv.save()
 
+    def _get_prefetched_parameter_val(self, name):
+        """Find a prefetched ParameterVal by spec id_name, or None."""
+        for pval in self.parameter_vals.all():
+            if pval.parameter_spec.id_name == name:
+                return pval
+        return None
+
     def get_parameter_val(self, name, expected_type):
+        if 'parameter_vals' in getattr(self, '_prefetched_objects_cache', {}):
+            # No queries: execute.py prefetched ParameterVals and -Specs
+            pval = self._get_prefetched_parameter_val(name)
+            if pval is not None:
+                if pval.parameter_spec.type != expected_type:
+                    raise ValueError(
+                        f'Request for {expected_type} parameter {name} '
+                        f'but actual type is {pval.parameter_spec.type}'
+                    )
+                return pval
+
         try:
             pspec = ParameterSpec.objects.get(
                 id_name=name,
@@ -328,7 +447,8 @@ class WfModule(models.Model):
     # workflow
     def set_busy(self, notify=True):
         self.is_busy = True
-        self.save()
+        # Fetches call this without the workflow lock: write only this field
+        self.save(update_fields=['is_busy'])
         if notify:
             websockets.ws_client_wf_module_status(self, self.status)
 
@@ -337,7 +457,7 @@ class WfModule(models.Model):
     def set_ready(self):
         self.is_busy = False
         self.fetch_error = ''
-        self.save()
+        self.save(update_fields=['is_busy', 'fetch_error'])
 
     # --- Duplicate ---
     # used when duplicating a whole workflow
@@ -378,16 +498,19 @@ class WfModule(models.Model):
         return CachedRenderResult.from_wf_module(self)
 
     def cache_render_result(self, delta_id: Optional[int],
-                            result: ProcessResult) -> CachedRenderResult:
+                            result: ProcessResult,
+                            fingerprint: str='') -> CachedRenderResult:
         """Save the given ProcessResult (or None) for later viewing."""
-        return CachedRenderResult.assign_wf_module(self, delta_id, result)
+        return CachedRenderResult.assign_wf_module(self, delta_id, result,
+                                                   fingerprint)
 
     def get_cached_output_columns(self) -> List[Column]:
         """
         If the cached result is valid, return a list of columns.
 
-        This doesn't instantiate any DataFrames, so it's cheap. (It does read
-        a file header from disk, though.)
+        This reads database fields, not files, so it's cheap. (Results cached
+        before we stored columns are the exception: for those, we read a file
+        header from disk.)
         """
         cached_result = self.get_cached_render_result()
         if not cached_result:
@@ -398,5 +521,10 @@ class WfModule(models.Model):
         return cached_result.columns
 
     def delete(self, *args, **kwargs):
+        workflow_id = self.cached_render_result_workflow_id or self.workflow_id
+        if workflow_id is not None:
+            # Import here: renderhistory imports models
+            from server import renderhistory
+            renderhistory.discard_wf_module(workflow_id, self.id)
         self.cache_render_result(None, None)
         super().delete(*args, **kwargs)
@@ -1,5 +1,5 @@
 from contextlib import contextmanager
-from django.db import models, transaction
+from django.db import connection, models, transaction
 from django.contrib.auth.models import User
 from django.http import HttpRequest
 from django.urls import reverse
@@ -83,6 +83,41 @@ class Workflow(models.Model):
 
             yield
 
+    @contextmanager
+    def snapshot_read(self):
+        """Yields in a read-only database transaction with a consistent view.
+
+        Example:
+
+            with workflow.snapshot_read():
+                data = WorkflowSerializer(workflow).data
+
+        Every query in the block sees the database as it was at the block's
+        first query (REPEATABLE READ), so the Workflow, its WfModules and
+        their ParameterVals all come from the same moment. Unlike
+        cooperative_lock(), this takes no row lock: readers don't wait for
+        each other or for writers, and writers don't wait for them.
+
+        Never write within a snapshot_read(): use cooperative_lock().
+
+        Within another transaction (say, a cooperative_lock()), this just
+        refreshes self: the outer transaction decides what we see.
+        """
+        if connection.in_atomic_block:
+            self.refresh_from_db()
+            yield
+            return
+
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                # Must be the transaction's first query
+                cursor.execute(
+                    'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY'
+                )
+            self.refresh_from_db()
+
+            yield
+
     @property
     def url_id(self) -> int:
         """ID we display in the URL when presenting this Workflow.
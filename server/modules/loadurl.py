@@ -1,10 +1,11 @@
-import io
+from typing import Optional
 from django.core.validators import URLValidator
 from django.core.exceptions import ValidationError
 import requests
+from server.models import StoredObject
 from .moduleimpl import ModuleImpl
 from .types import ProcessResult
-from .utils import parse_bytesio
+from .utils import can_ingest, ingest_chunks, parse_chunks
 
 # ---- LoadURL ----
 
@@ -31,6 +32,25 @@ def guess_mime_type_or_none(content_type: str, url: str) -> str:
     return None
 
 
+def charset_or_none(content_type: str) -> Optional[str]:
+    """Read the charset from a Content-Type header, or return None.
+
+    Unlike `requests.Response.encoding`, we don't default to ISO-8859-1 for
+    text/* types: we'd rather detect the encoding.
+    """
+    for param in content_type.split(';')[1:]:
+        key, _, value = param.partition('=')
+        if key.strip().lower() == 'charset':
+            return value.strip().strip('"\'') or None
+
+    return None
+
+
+# Bytes per read from the network. The first chunk is what we detect the text
+# encoding from, unless the server tells us the charset.
+_DownloadChunkSize = 1024*1024
+
+
 class LoadURL(ModuleImpl):
     # Input table ignored.
     @staticmethod
@@ -51,31 +71,49 @@ class LoadURL(ModuleImpl):
                                             ProcessResult(error='Invalid URL'))
 
         mimetypes = ','.join(_ExtensionMimeTypes.values())
+        table = None  # IngestedTable, if we wrote the response to a file
 
         try:
-            response = requests.get(url, headers={'Accept': mimetypes})
-            if response.status_code == requests.codes.ok:
-                # get content type
-                content_type = response.headers.get('content-type', '') \
-                        .split(';')[0] \
-                        .strip()
-                mime_type = guess_mime_type_or_none(content_type, url)
-
-                if mime_type:
-                    result = parse_bytesio(io.BytesIO(response.content),
-                                           mime_type, response.encoding)
+            # Stream the response, so we never hold the whole body in memory
+            with requests.get(url, headers={'Accept': mimetypes},
+                              stream=True) as response:
+                if response.status_code == requests.codes.ok:
+                    # get content type
+                    content_type_header = response.headers.get('content-type',
+                                                               '')
+                    content_type = content_type_header.split(';')[0].strip()
+                    mime_type = guess_mime_type_or_none(content_type, url)
+
+                    if mime_type and can_ingest(mime_type):
+                        # Write straight to the StoredObject's file
+                        table = ingest_chunks(
+                            response.iter_content(_DownloadChunkSize),
+                            mime_type,
+                            charset_or_none(content_type_header),
+                            StoredObject.new_file_path(wf_module)
+                        )
+                    elif mime_type:
+                        result = parse_chunks(
+                            response.iter_content(_DownloadChunkSize),
+                            mime_type,
+                            charset_or_none(content_type_header)
+                        )
+                    else:
+                        result = ProcessResult(error=(
+                            f'Error fetching {url}: '
+                            f'unknown content type {content_type}'
+                        ))
                 else:
-                    result = ProcessResult(error=(
-                        f'Error fetching {url}: '
-                        f'unknown content type {content_type}'
-                    ))
-            else:
-                result = ProcessResult(
-                    error=f'Error {response.status_code} fetching url'
-                )
+                    result = ProcessResult(
+                        error=f'Error {response.status_code} fetching url'
+                    )
         except requests.exceptions.RequestException as err:
             result = ProcessResult(error=str(err))
 
+        if table is not None:
+            # Commit with the connection closed, like commit_result() below
+            return ModuleImpl.commit_ingested_table(wf_module, table)
+
         result.truncate_in_place_if_too_big()
         result.sanitize_in_place()
 
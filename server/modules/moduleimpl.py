@@ -1,9 +1,9 @@
 from typing import Optional, Dict, Any
-from django.utils import timezone
 from server.models import WfModule
-from server.versions import save_result_if_changed
-from server import websockets
+from server.versions import save_fetch_error, \
+        save_ingested_table_if_changed, save_result_if_changed
 from .types import ProcessResult
+from .utils import IngestedTable
 
 
 # Base class for all modules. Really just a reminder of function signatures
@@ -33,15 +33,31 @@ class ModuleImpl:
         Notify the user.
         """
         if result.dataframe.empty and result.error:
-            with wf_module.workflow.cooperative_lock():
-                wf_module.last_update_check = timezone.now()
-                wf_module.fetch_error = result.error
-                wf_module.is_busy = False
-                wf_module.save()
-            websockets.ws_client_rerender_workflow(wf_module.workflow)
+            save_fetch_error(wf_module, result.error)
         else:
             save_result_if_changed(
                 wf_module,
                 result,
                 stored_object_json=stored_object_json
             )
+
+    @staticmethod
+    def commit_ingested_table(wf_module: WfModule, table: IngestedTable,
+                              stored_object_json: Optional[Dict[str, Any]]=None
+                              ) -> None:
+        """
+        Like commit_result(), for a table ingested to a Parquet file.
+
+        The file becomes the new StoredObject's file, or we delete it.
+        """
+        if table.nrows == 0:
+            # There is no file: only, perhaps, an error
+            ModuleImpl.commit_result(wf_module,
+                                     ProcessResult(error=table.error),
+                                     stored_object_json=stored_object_json)
+        else:
+            save_ingested_table_if_changed(
+                wf_module,
+                table,
+                stored_object_json=stored_object_json
+            )
@@ -53,6 +53,8 @@ class ProcessResult:
         self.dataframe = dataframe
         self.error = error
         self.json = json
+        # The DataFrame sanitize_in_place() last sanitized
+        self._sanitized_dataframe = None
 
     def __repr__(self) -> str:
         return (
@@ -79,6 +81,7 @@ class ProcessResult:
         """Truncate dataframe in-place and add to self.error if truncated."""
         len_before = len(self.dataframe)
         if sanitizedataframe.truncate_table_if_too_big(self.dataframe):
+            self._sanitized_dataframe = None  # the index changed
             warning = _('Truncated output from %d rows to %d') % (len_before, len(self.dataframe))
             if self.error:
                 self.error = f'{self.error}\n{warning}'
@@ -86,8 +89,23 @@ class ProcessResult:
                 self.error = warning
 
     def sanitize_in_place(self):
-        """Coerce dataframe headers to strings and values to simple types."""
+        """
+        Coerce dataframe headers to strings and values to simple types.
+
+        This is a no-op if we sanitized this very DataFrame already. (Fetches
+        are sanitized by the module and then again by dispatch.) Callers that
+        modify `self.dataframe` in place after sanitizing must sanitize a new
+        ProcessResult.
+        """
+        if self._sanitized_dataframe is self.dataframe:
+            return
         sanitizedataframe.sanitize_dataframe(self.dataframe)
+        self._sanitized_dataframe = self.dataframe
+
+    @property
+    def is_sanitized(self) -> bool:
+        """True if sanitize_in_place() ran on `self.dataframe`."""
+        return self._sanitized_dataframe is self.dataframe
 
     @property
     def column_names(self):
@@ -4,7 +4,7 @@ from server.models import ChangeDataVersionCommand
 from django.utils.translation import gettext as _
 from .moduleimpl import ModuleImpl
 from .types import ProcessResult
-from .utils import parse_bytesio
+from .utils import IngestedTable, can_ingest, ingest_bytesio, parse_bytesio
 import pandas as pd
 import os
 import json
@@ -29,15 +29,40 @@ _ExtensionMimeTypes = {
 def upload_to_table(wf_module, uploaded_file):
     ext = '.' + uploaded_file.name.split('.')[-1]
     mime_type = _ExtensionMimeTypes.get(ext, None)
-    if mime_type:
+    stored_object_json = [
+        {'uuid': uploaded_file.uuid, 'name': uploaded_file.name}
+    ]
+
+    if mime_type and can_ingest(mime_type):
+        # Parse in chunks, straight to the StoredObject's file
         uploaded_file.file.open()  # Django FileField weirdness
-        bytesio = uploaded_file.file
         try:
-            result = parse_bytesio(bytesio, mime_type, None)
+            table = ingest_bytesio(uploaded_file.file, mime_type, None,
+                                   StoredObject.new_file_path(wf_module))
         except Exception as e:
+            table = IngestedTable(None, [], 0, e.args[0])
+        finally:
             uploaded_file.file.close()
+
+        if table.nrows == 0 and table.error:
+            # delete uploaded file, we probably can't ever use it
+            uploaded_file.delete()
+
+        ModuleImpl.commit_ingested_table(wf_module, table,
+                                         stored_object_json=stored_object_json)
+        return
+
+    if mime_type:
+        # Parse straight from the file Django stored. Like LoadURL's spooled
+        # download, it's on disk: we never copy the raw bytes into memory.
+        uploaded_file.file.open()  # Django FileField weirdness
+        try:
+            result = parse_bytesio(uploaded_file.file, mime_type, None)
+        except Exception as e:
             result = ProcessResult(error=(
                 e.args[0]))
+        finally:
+            uploaded_file.file.close()
     else:
         result = ProcessResult(error=(
             f'Error parsing {uploaded_file.file.name}: '
@@ -51,9 +76,8 @@ def upload_to_table(wf_module, uploaded_file):
     result.truncate_in_place_if_too_big()
     result.sanitize_in_place()
 
-    ModuleImpl.commit_result(wf_module, result, stored_object_json=[
-        {'uuid': uploaded_file.uuid, 'name': uploaded_file.name}
-    ])
+    ModuleImpl.commit_result(wf_module, result,
+                             stored_object_json=stored_object_json)
 
     # don't delete UploadedFile, so that we can reparse later or allow higher
     # row limit or download original, etc.
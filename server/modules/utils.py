@@ -1,18 +1,24 @@
 import builtins
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
 from contextlib import contextmanager
 import io
 import json
-from typing import Any, Dict, Callable, Optional
+import numpy
+import os
+import tempfile
+from typing import Any, Dict, Callable, Iterable, List, Optional, Tuple
 import xlrd
 import pandas
 from pandas import DataFrame
 import pandas.errors
 from .types import ProcessResult
 import cchardet as chardet
-from server.sanitizedataframe import autocast_dtypes_in_place
+from server import parquet
+from server.pandas_util import ColumnsHasher
+from server.sanitizedataframe import autocast_dtypes_in_place, \
+        autocast_series_dtype, sanitize_dataframe
 from django.conf import settings
-from django.db.models.fields.files import FieldFile
+from django.utils.translation import gettext as _
 
 _TextEncoding = Optional[str]
 
@@ -191,16 +197,14 @@ def _determine_dtype(bytesio: io.BytesIO):
 
         Peculiarities:
 
-        * Unittests pass bytesio as io.BytesIO
-        * Django passes as FieldFile.
-        * Both have different methods to determine buffer size
+        * Callers pass io.BytesIO, Django FieldFile, spooled temporary files
+          and plain files. We measure them all by seeking to the end.
     """
 
-    if type(bytesio) == FieldFile:
-        size = bytesio.size
-    elif type(bytesio) == io.BytesIO:
-        size = bytesio.getbuffer().nbytes
-    else:
+    try:
+        size = bytesio.seek(0, io.SEEK_END)
+        bytesio.seek(0)
+    except (AttributeError, io.UnsupportedOperation):
         return None
 
     if size > settings.CATEGORY_FILE_SIZE_MIN:
@@ -277,3 +281,316 @@ def parse_bytesio(bytesio: io.BytesIO, mime_type: str,
         return _safe_parse(bytesio, parser, text_encoding)
     else:
         return ProcessResult(error=f'Unhandled MIME type "{mime_type}"')
+
+
+class _SpooledTemporaryFile(tempfile.SpooledTemporaryFile):
+    # Python 3.6's SpooledTemporaryFile isn't an io.IOBase, so
+    # io.TextIOWrapper can't wrap it without these.
+    def readable(self):
+        return self._file.readable()
+
+    def seekable(self):
+        return self._file.seekable()
+
+    def writable(self):
+        return self._file.writable()
+
+
+class _FileTooLargeError(Exception):
+    pass
+
+
+@contextmanager
+def _spool(chunks: Iterable[bytes], text_encoding: _TextEncoding):
+    """Spool `chunks` to a temporary file; yield `(file, text_encoding)`.
+
+    The file is in memory up to `settings.SPOOL_MAX_MEMORY_BYTES`, then on
+    disk. So we never hold more than one copy of the raw bytes in memory, and
+    large files never sit in memory at all.
+
+    If `text_encoding` is None, we detect it from the first chunk(s) as they
+    arrive, so we needn't read the spooled file twice.
+
+    Raise _FileTooLargeError after `settings.DOWNLOAD_MAX_BYTES`.
+    """
+    max_bytes = settings.DOWNLOAD_MAX_BYTES
+    detector = None if text_encoding else chardet.UniversalDetector()
+
+    with _SpooledTemporaryFile(
+        max_size=settings.SPOOL_MAX_MEMORY_BYTES
+    ) as spool:
+        n_bytes = 0
+        for chunk in chunks:
+            n_bytes += len(chunk)
+            if n_bytes > max_bytes:
+                raise _FileTooLargeError(
+                    f'File is too large: the limit is {max_bytes} bytes'
+                )
+            spool.write(chunk)
+            if detector is not None and not detector.done:
+                detector.feed(chunk)
+
+        if detector is not None:
+            detector.close()
+            text_encoding = detector.result['encoding'] or 'utf-8'
+
+        spool.seek(0)
+        yield spool, text_encoding
+
+
+def parse_chunks(chunks: Iterable[bytes], mime_type: str,
+                 text_encoding: _TextEncoding=None) -> ProcessResult:
+    """Parse a stream of bytes (say, an HTTP response) to a ProcessResult.
+
+    We spool `chunks` to a temporary file and parse from that. We stop
+    reading after `settings.DOWNLOAD_MAX_BYTES` and return an error.
+
+    Otherwise, this behaves like parse_bytesio().
+    """
+    if mime_type not in _Parsers:
+        return ProcessResult(error=f'Unhandled MIME type "{mime_type}"')
+
+    try:
+        with _spool(chunks, text_encoding) as (spool, text_encoding):
+            return parse_bytesio(spool, mime_type, text_encoding)
+    except _FileTooLargeError as err:
+        return ProcessResult(error=str(err))
+
+
+# --- Ingesting text in chunks ---
+#
+# parse_bytesio() builds a whole DataFrame in memory, then casts it, then
+# truncates it. For CSV, TSV and TXT files, ingest_bytesio() streams instead:
+# it parses `settings.INGEST_CHUNK_SIZE` rows at a time and writes each chunk
+# to a Parquet file (the file a StoredObject will point to) as a row group.
+#
+# Every row group must have the same schema, and we can't know a column's
+# type until we've seen all its values. So we read the file twice: once to
+# decide each column's type, as autocast_series_dtype() would for the whole
+# column, and once to write. We never parse past `settings.MAX_ROWS_PER_TABLE`
+# rows (plus one, to tell whether we truncated).
+#
+# In large files, text columns are categorical, as parse_bytesio() makes
+# them, and every row group gets the same categories. To bound memory, a
+# column stays str if it has more than `settings.INGEST_MAX_CATEGORIES`
+# distinct values, or if it only turned out to be text after its first chunk.
+
+
+# Separator for each MIME type we ingest in chunks. None means, "detect it."
+_TextSeparators = {
+    'text/csv': ',',
+    'text/tab-separated-values': '\t',
+    'text/txt': None,
+}
+
+
+# The table ingest_bytesio() wrote: `nrows` rows at `path`, whose column
+# hashes are `column_hashes` (see StoredObject). If `nrows` is 0, there is no
+# file. `error` is a parse error or a truncation warning.
+IngestedTable = namedtuple('IngestedTable',
+                           ['path', 'column_hashes', 'nrows', 'error'])
+
+
+# What _scan_text_chunks() learns about a file: each column's dtype
+# ('int64', 'float64', 'object' ...); each column's categories (None for
+# numbers and str); the number of rows we'll keep; and whether the file has
+# more rows than that.
+_TextSchema = namedtuple('_TextSchema',
+                         ['dtypes', 'categories', 'nrows', 'truncated'])
+
+
+def can_ingest(mime_type: str) -> bool:
+    """Return True if ingest_bytesio() and ingest_chunks() handle this."""
+    return mime_type in _TextSeparators
+
+
+def _read_text_chunks(textio: io.TextIOWrapper, sep: str,
+                      nrows: Optional[int]=None):
+    """Start reading `textio` as str columns, in chunks."""
+    textio.seek(0)
+    return pandas.read_csv(textio, sep=sep, dtype=str,
+                           chunksize=settings.INGEST_CHUNK_SIZE, nrows=nrows)
+
+
+def _widen_dtype(dtype: Optional[str], series: pandas.Series) -> str:
+    """
+    Return the dtype a column needs, given `dtype` so far and more values.
+
+    `series` holds str (and NaN). autocast_series_dtype() decides its type.
+    """
+    if dtype == 'object':
+        return dtype
+
+    cast = autocast_series_dtype(series)
+    if cast.dtype == object:
+        return 'object'
+    elif dtype is None:
+        return str(cast.dtype)
+    else:
+        # int64 and float64 make float64, for instance
+        return str(numpy.promote_types(dtype, cast.dtype))
+
+
+def _scan_text_chunks(textio: io.TextIOWrapper, sep: str,
+                      as_category: bool) -> _TextSchema:
+    """
+    Read `textio` without writing it, to decide its schema.
+
+    We read `settings.MAX_ROWS_PER_TABLE` rows, plus one to tell whether
+    there are more. If `as_category`, we collect the distinct values of each
+    text column, up to `settings.INGEST_MAX_CATEGORIES` of them.
+    """
+    max_rows = settings.MAX_ROWS_PER_TABLE
+    max_categories = settings.INGEST_MAX_CATEGORIES
+    dtypes = None
+    values = None
+    nrows = 0
+    truncated = False
+
+    reader = _read_text_chunks(textio, sep, nrows=max_rows + 1)
+    try:
+        for chunk in reader:
+            if nrows + len(chunk) > max_rows:
+                truncated = True
+                chunk = chunk.iloc[:max_rows - nrows]
+            nrows += len(chunk)
+
+            if dtypes is None:
+                dtypes = [None] * len(chunk.columns)
+
+            for i in range(len(chunk.columns)):
+                series = chunk.iloc[:, i]
+                dtypes[i] = _widen_dtype(dtypes[i], series)
+
+            if values is None:
+                # Only columns that are text from the start can be categories:
+                # we don't remember earlier chunks' numbers.
+                values = [set() if as_category and dtype == 'object' else None
+                          for dtype in dtypes]
+
+            for i, column_values in enumerate(values):
+                if column_values is not None:
+                    column_values.update(chunk.iloc[:, i].dropna().unique())
+                    if len(column_values) > max_categories:
+                        values[i] = None  # too many: it stays str
+    finally:
+        reader.close()
+
+    if values is None:
+        categories = None
+    else:
+        categories = [None if v is None else sorted(v) for v in values]
+
+    return _TextSchema(dtypes, categories, nrows, truncated)
+
+
+def _write_text_chunks(textio: io.TextIOWrapper, sep: str, path: str,
+                       schema: _TextSchema) -> List[str]:
+    """
+    Parse `textio` in chunks and write them to a Parquet file at `path`.
+
+    Return column hashes.
+    """
+    row_group_size = settings.PARQUET_ROW_GROUP_SIZE
+    hasher = ColumnsHasher()
+    nrows = 0
+
+    reader = _read_text_chunks(textio, sep, nrows=schema.nrows)
+    try:
+        for chunk in reader:
+            if not len(chunk):
+                continue
+
+            columns = OrderedDict()
+            for i, (name, dtype) in enumerate(zip(chunk.columns,
+                                                  schema.dtypes)):
+                series = chunk.iloc[:, i]
+                if dtype != 'object':
+                    series = autocast_series_dtype(series).astype(dtype)
+                columns[name] = series
+
+            # Sanitize names and index. Every chunk has the same header, so
+            # every chunk gets the same names.
+            chunk = sanitize_dataframe(DataFrame(columns))
+
+            if schema.categories is not None:
+                # After sanitizing, which would drop unused categories: every
+                # row group needs the same ones.
+                for name, categories in zip(chunk.columns,
+                                            schema.categories):
+                    if categories is not None:
+                        chunk[name] = pandas.Categorical(chunk[name],
+                                                         categories=categories)
+
+            write = parquet.write if nrows == 0 else parquet.append
+            write(path, chunk, row_group_size=row_group_size)
+            hasher.update(chunk)
+            nrows += len(chunk)
+    finally:
+        reader.close()
+
+    return hasher.hexdigests()
+
+
+def _remove_if_exists(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def ingest_bytesio(bytesio: io.BytesIO, mime_type: str,
+                   text_encoding: _TextEncoding, path: str) -> IngestedTable:
+    """Parse a CSV, TSV or TXT file into a Parquet file at `path`.
+
+    Only `settings.INGEST_CHUNK_SIZE` rows are ever in memory. We keep
+    `settings.MAX_ROWS_PER_TABLE` rows, warn if there are more, and don't
+    parse the rest. Columns are typed as parse_bytesio() would type
+    them, and they are sane, as sanitize_dataframe() would make them.
+
+    `bytesio` must be seekable: we parse it twice.
+    """
+    sep = _TextSeparators[mime_type]
+    if not text_encoding:
+        text_encoding = _detect_encoding(bytesio)
+    as_category = _determine_dtype(bytesio) == 'category'
+
+    with _wrap_text(bytesio, text_encoding) as textio:
+        if sep is None:
+            sep = _detect_separator(textio)
+
+        try:
+            schema = _scan_text_chunks(textio, sep, as_category)
+            if schema.nrows == 0:
+                return IngestedTable(None, [], 0, '')
+
+            column_hashes = _write_text_chunks(textio, sep, path, schema)
+        except pandas.errors.EmptyDataError:
+            # Empty dataset is not an error: it is just an empty dataset
+            return IngestedTable(None, [], 0, '')
+        except pandas.errors.ParserError as err:
+            _remove_if_exists(path)
+            return IngestedTable(None, [], 0, str(err))
+        except BaseException:
+            _remove_if_exists(path)
+            raise
+
+    if schema.truncated:
+        error = _('Truncated output to %d rows') % schema.nrows
+    else:
+        error = ''
+
+    return IngestedTable(path, column_hashes, schema.nrows, error)
+
+
+def ingest_chunks(chunks: Iterable[bytes], mime_type: str,
+                  text_encoding: _TextEncoding, path: str) -> IngestedTable:
+    """Spool a stream of bytes, as parse_chunks() does; then ingest it.
+
+    See ingest_bytesio().
+    """
+    try:
+        with _spool(chunks, text_encoding) as (spool, text_encoding):
+            return ingest_bytesio(spool, mime_type, text_encoding, path)
+    except _FileTooLargeError as err:
+        return IngestedTable(None, [], 0, str(err))
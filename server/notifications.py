@@ -1,18 +1,22 @@
 import datetime
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional
 from allauth.account.utils import user_display
 from django.core.mail import EmailMultiAlternatives
 from django.template.loader import render_to_string
 from django.conf import settings
 from server.utils import get_absolute_url
-from server.modules.types import ProcessResult
 
 
 class OutputDelta:
-    """Description of changes between two versions of WfModule output."""
-    def __init__(self, wf_module: 'WfModule',
-                 old_result: Optional[ProcessResult],
-                 new_result: ProcessResult):
+    """
+    Description of changes between two versions of WfModule output.
+
+    We describe each version by its hash (see
+    `CachedRenderResult.hash`). `old_hash` is None if we don't know the old
+    output.
+    """
+    def __init__(self, wf_module: 'WfModule', old_hash: Optional[str],
+                 new_hash: str):
         workflow = wf_module.workflow
 
         self.user = workflow.owner
@@ -20,72 +24,155 @@ class OutputDelta:
         self.wf_module_id = wf_module.id
         self.module_name = wf_module.get_module_name()
         self.workflow_url = get_absolute_url(workflow.get_absolute_url())
-        self.old_result = old_result
-        self.new_result = new_result
+        self.old_hash = old_hash
+        self.new_hash = new_hash
 
     def __repr__(self):
-        return 'OutputDelta' + repr((self.wf_module_id, self.old_result,
-                                     self.new_result))
+        return 'OutputDelta' + repr((self.wf_module_id, self.old_hash,
+                                     self.new_hash))
 
     def __eq__(self, other):
         return isinstance(other, OutputDelta) \
                 and self.wf_module_id == other.wf_module_id \
-                and self.old_result == other.old_result \
-                and self.new_result == other.new_result
+                and self.old_hash == other.old_hash \
+                and self.new_hash == other.new_hash
 
 
-def find_output_deltas_to_notify_from_fetched_tables(
-        wf_module: 'WfModule', old_result: Optional[ProcessResult],
-        new_result: ProcessResult) -> List[OutputDelta]:
-    """Compute a list of OutputDeltas to email to the owner.
-
-    `wf_module` is the fetch module whose data just changed from `old_table` to
-    `new_table`. (Either may be `None` or empty.)
-
-    Assumes `old_result` and `new_result` are different.
-
-    Must be called within a workflow.cooperative_lock().
-
-    TODO make this easier to unit-test, and then unit-test it.
+def _wf_modules_to_diff(wf_module: 'WfModule') -> List['WfModule']:
     """
-    # Import here, to prevent recursive import
-    from server.dispatch import module_dispatch_render
-
-    output_deltas = []
+    List `wf_module` and the WfModules after it, up to the last one that
+    has notifications enabled.
 
+    Return an empty list if none of them has notifications enabled.
+    """
     all_modules = list(wf_module.workflow.wf_modules.all())
 
     # Truncate all_modules: nix all after the last `.notifications` module
     while all_modules and not all_modules[-1].notifications:
         all_modules.pop()
 
-    # Advance in the list up until one _after_ `wf_module`
+    # Advance in the list up until `wf_module`
     while all_modules and all_modules[0].id != wf_module.id:
         all_modules.pop(0)
-    if all_modules:
-        # remove wf_module itself
-        all_modules.pop(0)
 
-    if wf_module.notifications:
-        # Notify on wf_module itself
-        output_deltas.append(OutputDelta(wf_module, old_result, new_result))
+    return all_modules
+
+
+def render_outputs_to_diff(wf_module: 'WfModule',
+                           is_new_version: Callable[[], bool]) -> None:
+    """
+    Render the outputs snapshot_output_hashes() will read, if they're stale.
+
+    Renders can take minutes, so we render without the workflow's lock. Then
+    snapshot_output_hashes() only reads hashes -- unless someone edited the
+    workflow meanwhile.
+
+    We only need old outputs if the fetch will create a new data version, so
+    we call `is_new_version()` (which compares hashes) before rendering. We
+    don't call it if no module has notifications enabled or the outputs are
+    fresh already.
+
+    Must _not_ be called within a workflow.cooperative_lock(). Call it before
+    the data version changes.
+    """
+    # Import here, to prevent recursive import
+    from server.execute import execute_wfmodule_unlocked, is_cache_fresh
+    from server.models import WfModule, Workflow
+
+    all_modules = _wf_modules_to_diff(wf_module)
+    if all(is_cache_fresh(m) for m in all_modules):
+        return
+
+    if not is_new_version():
+        return  # the fetch won't change anything; nothing to diff
+
+    try:
+        execute_wfmodule_unlocked(wf_module.workflow, all_modules[-1].id)
+    except (WfModule.DoesNotExist, Workflow.DoesNotExist):
+        pass  # the caller will notice it's gone
+
+
+def snapshot_output_hashes(wf_module: 'WfModule') -> Dict[int, Optional[str]]:
+    """
+    Record the output hashes we'll diff after `wf_module`'s data changes.
+
+    Return `{wf_module_id: hash}` for `wf_module` and the WfModules after it
+    that find_output_deltas_to_notify_from_fetched_tables() will compare.
+    Call render_outputs_to_diff() first, so this reads no tables. If a cached
+    render result is stale anyway, we render it here: otherwise we wouldn't
+    know the old output. The hash is None if the cached render result
+    predates hashes.
+
+    Must be called within a workflow.cooperative_lock(), before the data
+    version changes.
+    """
+    # Import here, to prevent recursive import
+    from server.execute import execute_wfmodule, is_cache_fresh
+
+    all_modules = _wf_modules_to_diff(wf_module)
+    if not all(is_cache_fresh(m) for m in all_modules):
+        # Someone edited the workflow after render_outputs_to_diff(). That's
+        # rare enough that we can render while we hold the lock.
+        execute_wfmodule(all_modules[-1])
+        all_modules = _wf_modules_to_diff(wf_module)  # re-read the hashes
 
-    if old_result is None:
-        old_result = ProcessResult()
+    return dict((m.id, m.cached_render_result_hash or None)
+                for m in all_modules)
 
-    # Now iterate through dependent modules: calculate tables and compare
+
+def find_output_deltas_to_notify_from_fetched_tables(
+        wf_module: 'WfModule',
+        old_hashes: Dict[int, Optional[str]]) -> List[OutputDelta]:
+    """Compute a list of OutputDeltas to email to the owner.
+
+    `wf_module` is the fetch module whose data just changed. `old_hashes` is
+    what snapshot_output_hashes() returned before the change.
+
+    We render the new data through the usual path (execute.py), which
+    writes cached render results and skips renders whose inputs did not
+    change. We never render the old data: we compare hashes. As soon as one
+    WfModule's output is unchanged, the outputs after it can't have changed
+    either, so we stop.
+
+    Must _not_ be called within a workflow.cooperative_lock(): we render
+    without it. Call it after the data version changes.
+    """
+    # Import here, to prevent recursive import
+    from server.execute import execute_wfmodule_unlocked
+    from server.models import WfModule, Workflow
+
+    all_modules = _wf_modules_to_diff(wf_module)
+    if not all_modules:
+        return []
+
+    report = None
+    try:
+        while report is None:
+            # None means someone edited the workflow while we rendered. Then
+            # we render again and diff the latest outputs.
+            report = execute_wfmodule_unlocked(wf_module.workflow,
+                                               all_modules[-1].id)
+    except (WfModule.DoesNotExist, Workflow.DoesNotExist):
+        return []  # there's nobody left to notify
+
+    new_hashes = dict(
+        WfModule.objects
+        .filter(id__in=[m.id for m in all_modules])
+        .values_list('id', 'cached_render_result_hash')
+    )
+
+    output_deltas = []
     for wf_module in all_modules:
-        old_result = module_dispatch_render(wf_module, old_result.dataframe)
-        new_result = module_dispatch_render(wf_module, new_result.dataframe)
+        old_hash = old_hashes.get(wf_module.id)
+        new_hash = new_hashes.get(wf_module.id)
 
-        if old_result == new_result:
+        if old_hash is not None and old_hash == new_hash:
             # From this point forward, tables will never diverge so we should
             # never notify the user.
             return output_deltas
 
         if wf_module.notifications:
-            output_deltas.append(OutputDelta(wf_module, old_result,
-                                             new_result))
+            output_deltas.append(OutputDelta(wf_module, old_hash, new_hash))
 
     return output_deltas
 
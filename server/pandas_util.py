@@ -1,3 +1,5 @@
+import hashlib
+from typing import List
 from pandas import DataFrame
 from pandas.util import hash_pandas_object
 
@@ -7,3 +9,62 @@ def hash_table(table: DataFrame) -> str:
     h = hash_pandas_object(table).sum()  # xor would be nice, but whatevs
     h = h if h > 0 else -h               # stay positive (sum often overflows)
     return str(h)
+
+
+def hash_table_with_schema(table: DataFrame) -> str:
+    """
+    Build a hash of a data frame's column names, dtypes and rows, in order.
+
+    Unlike hash_table(), this changes when rows are reordered or columns are
+    renamed. Use it to tell whether a module's output changed.
+    """
+    hasher = hashlib.sha1()
+    for name, dtype in table.dtypes.items():
+        hasher.update(f'{name}\0{dtype}\0'.encode('utf-8'))
+    hasher.update(hash_pandas_object(table).values.tobytes())
+    return hasher.hexdigest()
+
+
+def hash_columns(table: DataFrame) -> List[str]:
+    """
+    Hash each column of a data frame: its name, dtype and values, in order.
+
+    Two tables with the same column hashes and row count hold the same data.
+    Store these hashes beside a table to compare it to others without reading
+    it.
+    """
+    hasher = ColumnsHasher()
+    hasher.update(table)
+    return hasher.hexdigests()
+
+
+class ColumnsHasher:
+    """
+    Compute hash_columns() of a table we see one chunk of rows at a time.
+
+    Every chunk must have the same column names and dtypes. The result is the
+    same as hash_columns() of all the chunks concatenated: we hash each value
+    on its own, so it doesn't matter where chunks split.
+    """
+
+    def __init__(self):
+        self._hashers = None
+
+    def update(self, chunk: DataFrame) -> None:
+        if self._hashers is None:
+            self._hashers = []
+            for name, dtype in zip(chunk.columns, chunk.dtypes):
+                hasher = hashlib.sha1()
+                hasher.update(f'{name}\0{dtype}\0'.encode('utf-8'))
+                self._hashers.append(hasher)
+
+        for i, hasher in enumerate(self._hashers):
+            series = chunk.iloc[:, i]
+            hasher.update(
+                hash_pandas_object(series, index=False).values.tobytes()
+            )
+
+    def hexdigests(self) -> List[str]:
+        if self._hashers is None:
+            return []
+        return [hasher.hexdigest() for hasher in self._hashers]
@@ -1,4 +1,7 @@
+import copy
+import os
 from pathlib import Path
+from typing import Iterator, List, Optional
 import fastparquet
 from fastparquet import ParquetFile
 import pandas
@@ -38,16 +41,166 @@ def read(path: Path) -> pandas.DataFrame:
     return pf.to_pandas()  # no need to close? Weird API
 
 
-def write(path: Path, table: pandas.DataFrame) -> None:
+def count_rows(parquet_file: ParquetFile) -> int:
+    """
+    Count rows in a file, using only its footer.
+    """
+    return sum(rg.num_rows for rg in parquet_file.row_groups)
+
+
+def read_slice(parquet_file: ParquetFile, start_row: int, end_row: int,
+               columns: Optional[List[str]]=None) -> pandas.DataFrame:
+    """
+    Load rows [start_row, end_row) of a file as a Pandas DataFrame.
+
+    We only decode the row groups that hold the requested rows, finding them
+    through the row-group offsets in the file footer. A file written as one
+    giant row group will still be decoded in its entirety.
+
+    `columns`, if set, selects a subset of columns. The returned DataFrame's
+    index starts at `start_row`, as though we sliced the entire table.
+    """
+    start_row = max(0, start_row)
+
+    row_groups = []
+    offset = 0
+    first_offset = start_row  # if there are no row groups, slice [0:0]
+    for rg in parquet_file.row_groups:
+        rg_end = offset + rg.num_rows
+        if offset < end_row and rg_end > start_row:
+            if not row_groups:
+                first_offset = offset
+            row_groups.append(rg)
+        offset = rg_end
+
+    # Shallow-copy the file so to_pandas() only sees the groups we want. It
+    # shares its (read-only) schema with the original.
+    subset = copy.copy(parquet_file)
+    subset.row_groups = row_groups
+    dataframe = subset.to_pandas(columns=columns)
+
+    dataframe = dataframe[start_row - first_offset:end_row - first_offset]
+    dataframe.index = pandas.RangeIndex(start_row, start_row + len(dataframe))
+    return dataframe
+
+
+def write(path: Path, table: pandas.DataFrame,
+          row_group_size: Optional[int]=None) -> None:
     """
     Write a Pandas DataFrame to a file on disk, overwriting if needed.
 
     `path`'s directory must exist, and the user must have permission to write
     to `path`: otherwise, this function raises OSError.
 
+    If `row_group_size` is set, we split the table into row groups of at most
+    that many rows (fastparquet evens them out, so they may be smaller). Each
+    column chunk in each row group gets min/max/null-count statistics in the
+    footer. That lets read_slice() decode just the groups it needs. If
+    `row_group_size` is None, we write the whole table as one row group.
+
     We aim to keep the file format "stable": all future versions of
     parquet.read() should support all files written by today's version of this
     function.
     """
+    kwargs = {}
+    if row_group_size is not None:
+        kwargs['row_group_offsets'] = row_group_size
+
+    fastparquet.write(path, table, compression='SNAPPY',
+                      object_encoding='utf8', **kwargs)
+
+
+def append(path: Path, table: pandas.DataFrame,
+           row_group_size: Optional[int]=None) -> None:
+    """
+    Add rows to a file write() wrote, as new row groups.
+
+    `table` must have the file's column names and dtypes, and a default
+    index (`RangeIndex(len(table))`): otherwise, fastparquet raises
+    ValueError. `row_group_size` means what it means in write().
+
+    This rewrites only the footer, so a caller can write a huge table one
+    chunk at a time and only ever hold one chunk in memory.
+    """
+    kwargs = {}
+    if row_group_size is not None:
+        kwargs['row_group_offsets'] = row_group_size
+
     fastparquet.write(path, table, compression='SNAPPY',
-                      object_encoding='utf8')
+                      object_encoding='utf8', append=True, **kwargs)
+
+
+class Snapshot:
+    """
+    A Parquet file held open, so we can read it even after it is replaced.
+
+    Writers replace cached files with os.replace(). A Snapshot keeps reading
+    the file that was at `path` when we opened it -- for instance, while we
+    stream it to a client with no lock held.
+
+    Raise FileNotFoundError if there is no file. Call close() when done.
+    """
+
+    def __init__(self, path: Path):
+        self._fd = os.open(path, os.O_RDONLY)
+        self._parquet_file = None
+
+        try:
+            self._parquet_file = fastparquet.ParquetFile(
+                str(path),
+                open_with=self._open
+            )
+        except (OSError, IndexError):
+            # The file is empty, or it has zero columns (which fastparquet
+            # can't handle: https://github.com/dask/fastparquet/issues/361).
+            # Either way, our table is empty.
+            pass
+        except BaseException:
+            os.close(self._fd)
+            raise
+
+    def _open(self, path: str, mode: str='rb'):
+        # fastparquet opens a file object for each read. Each gets its own
+        # descriptor of the same (possibly unlinked) file.
+        return os.fdopen(os.dup(self._fd), mode)
+
+    @property
+    def column_names(self) -> List[str]:
+        if self._parquet_file is None:
+            return []
+        return self._parquet_file.columns
+
+    def read(self) -> pandas.DataFrame:
+        """Decode the whole table. An empty table has no columns."""
+        if self._parquet_file is None:
+            return pandas.DataFrame()
+
+        return self._parquet_file.to_pandas()
+
+    def iter_row_groups(self) -> Iterator[pandas.DataFrame]:
+        """
+        Yield the table one row group at a time.
+
+        Only one row group is ever decoded in memory. An empty table yields
+        nothing.
+        """
+        if self._parquet_file is None:
+            return
+
+        for row_group in self._parquet_file.row_groups:
+            subset = copy.copy(self._parquet_file)
+            subset.row_groups = [row_group]
+            yield subset.to_pandas()
+
+    def iter_bytes(self, chunk_size: int=64 * 1024) -> Iterator[bytes]:
+        """Yield the file's raw bytes."""
+        offset = 0
+        while True:
+            chunk = os.pread(self._fd, chunk_size, offset)
+            if not chunk:
+                return
+            offset += len(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        os.close(self._fd)
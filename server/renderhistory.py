@@ -0,0 +1,263 @@
+"""
+Earlier render results of each WfModule, so undo and redo need not render.
+
+A WfModule's cached render result only holds its output at a single delta.
+Undo and redo change `last_relevant_delta_id`, so without history each one
+would re-render the WfModule and everything after it.
+
+We keep each WfModule's last few results, keyed by delta ID, in
+`cached-render-results/wf-{workflow_id}/history/wfm-{wf_module_id}/`. Each
+generation is a hard link to the Parquet file the WfModule wrote, plus a JSON
+sidecar holding `error`, `json`, `hash`, `columns`, `nrows` and
+`fingerprint`. Restoring a generation links it back into place: a pointer
+swap, not a render.
+
+We only restore a generation whose fingerprint matches the WfModule's
+current inputs (see execute.py), so a stale generation can never come back.
+
+We keep at most `settings.RENDER_HISTORY_N_GENERATIONS` generations per
+WfModule, and generations that no current cached result links to may take at
+most `settings.RENDER_HISTORY_MAX_BYTES_PER_WORKFLOW` bytes per workflow. We
+delete least recently used generations first.
+
+The shared render cache may link to the same files. We don't count its links
+as references, and it doesn't count ours (see sharedrendercache.evict()):
+otherwise, a file both link to would never be freed by either budget.
+"""
+
+import json
+import os
+import shutil
+from typing import Any, Dict, List, Optional, Set, Tuple
+import uuid
+from django.conf import settings
+from django.core.files.storage import default_storage
+from server.models import CachedRenderResult, WfModule
+from server.modules.types import Column
+
+
+def _workflow_dir(workflow_id: int) -> str:
+    return default_storage.path(
+        f'cached-render-results/wf-{workflow_id}/history'
+    )
+
+
+def _wf_module_dir(workflow_id: int, wf_module_id: int) -> str:
+    return os.path.join(_workflow_dir(workflow_id), f'wfm-{wf_module_id}')
+
+
+def _generation_paths(workflow_id: int, wf_module_id: int,
+                      delta_id: int) -> Tuple[str, str]:
+    """Return the (Parquet, JSON) paths of a generation."""
+    prefix = os.path.join(_wf_module_dir(workflow_id, wf_module_id),
+                          str(delta_id))
+    return (prefix + '.dat', prefix + '.json')
+
+
+def _metadata_columns(metadata: Dict[str, Any]) -> Optional[List[Column]]:
+    """Read columns from a sidecar; None if it predates storing them."""
+    if 'columns' not in metadata:
+        return None
+    return [Column(name, type) for name, type in metadata['columns']]
+
+
+def _remove_if_exists(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _list_generations(dirname: str) -> List[Tuple[float, int, int, str]]:
+    """
+    List `(mtime, size, inode, path)` of Parquet files in `dirname`.
+
+    Oldest first.
+    """
+    try:
+        names = os.listdir(dirname)
+    except FileNotFoundError:
+        return []
+
+    generations = []
+    for name in names:
+        if not name.endswith('.dat'):
+            continue
+        path = os.path.join(dirname, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        generations.append((stat.st_mtime, stat.st_size, stat.st_ino,
+                            path))
+
+    generations.sort()
+    return generations
+
+
+def _current_inodes(workflow_id: int) -> Set[int]:
+    """
+    Return the inodes of the workflow's WfModules' cached render results.
+    """
+    dirname = os.path.dirname(_workflow_dir(workflow_id))
+    try:
+        names = os.listdir(dirname)
+    except FileNotFoundError:
+        return set()
+
+    inodes = set()
+    for name in names:
+        if name.startswith('wfm-') and name.endswith('.dat'):
+            try:
+                inodes.add(os.stat(os.path.join(dirname, name)).st_ino)
+            except FileNotFoundError:
+                pass
+    return inodes
+
+
+def _remove_generation(parquet_path: str) -> None:
+    _remove_if_exists(parquet_path[:-len('.dat')] + '.json')
+    _remove_if_exists(parquet_path)
+
+
+def record(wf_module: WfModule, cached_result: CachedRenderResult) -> None:
+    """
+    Add `wf_module`'s cached result to its history, then prune history.
+
+    Call this after writing (or re-stamping) a cached render result and
+    before writing the next one.
+    """
+    if cached_result is None or wf_module.workflow_id is None:
+        return
+
+    workflow_id = wf_module.workflow_id
+    parquet_path, json_path = _generation_paths(workflow_id, wf_module.id,
+                                                cached_result.delta_id)
+    os.makedirs(os.path.dirname(parquet_path), exist_ok=True)
+
+    temp_json_path = f'{json_path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_json_path, 'w') as f:
+        json.dump({
+            'error': cached_result.error,
+            'json': cached_result.json,
+            'hash': cached_result.hash,
+            'columns': [[c.name, c.type] for c in cached_result.columns],
+            'nrows': cached_result.total_rows,
+            'fingerprint': wf_module.cached_render_result_fingerprint,
+        }, f)
+    os.replace(temp_json_path, json_path)
+
+    temp_path = f'{parquet_path}.{uuid.uuid4().hex}.tmp'
+    try:
+        try:
+            os.link(cached_result.parquet_path, temp_path)
+        except FileNotFoundError:
+            raise
+        except OSError:
+            shutil.copyfile(cached_result.parquet_path, temp_path)
+        os.replace(temp_path, parquet_path)
+    except FileNotFoundError:
+        # The WfModule's result is gone already
+        _remove_if_exists(temp_path)
+        _remove_if_exists(json_path)
+        return
+
+    os.utime(parquet_path)  # it is the newest generation, even if re-stamped
+
+    prune(workflow_id, wf_module.id)
+
+
+def restore(wf_module: WfModule, delta_id: int,
+            fingerprint: str) -> Optional[CachedRenderResult]:
+    """
+    Make `wf_module`'s cached render result its result from `delta_id`.
+
+    Return the new CachedRenderResult, or None if there is no such
+    generation or it was rendered from inputs other than `fingerprint`. The
+    caller must save `wf_module`.
+    """
+    if wf_module.workflow_id is None:
+        return None
+
+    parquet_path, json_path = _generation_paths(wf_module.workflow_id,
+                                                wf_module.id, delta_id)
+
+    try:
+        with open(json_path, 'rb') as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    if not fingerprint or metadata['fingerprint'] != fingerprint:
+        return None
+
+    try:
+        cached_result = CachedRenderResult.assign_wf_module_from_file(
+            wf_module,
+            delta_id,
+            metadata['error'],
+            metadata['json'],
+            metadata['hash'],
+            fingerprint,
+            parquet_path,
+            columns=_metadata_columns(metadata),
+            nrows=metadata.get('nrows')
+        )
+    except FileNotFoundError:
+        # prune() deleted it just now
+        return None
+
+    try:
+        os.utime(parquet_path)  # for prune(): we used it recently
+    except FileNotFoundError:
+        pass
+
+    return cached_result
+
+
+def prune(workflow_id: int, wf_module_id: int) -> None:
+    """
+    Enforce the per-WfModule and per-workflow history limits.
+
+    Generations that a current cached result links to cost no extra disk
+    space, so they don't count toward the byte budget. Generations that link
+    to one another (say, re-stamps of one result) count once, and we delete
+    them together: deleting only some would free nothing.
+    """
+    generations = _list_generations(_wf_module_dir(workflow_id,
+                                                   wf_module_id))
+    n_extra = len(generations) - settings.RENDER_HISTORY_N_GENERATIONS
+    for _, _, _, path in generations[:max(0, n_extra)]:
+        _remove_generation(path)
+
+    try:
+        dirnames = os.listdir(_workflow_dir(workflow_id))
+    except FileNotFoundError:
+        return
+
+    current_inodes = _current_inodes(workflow_id)
+    files = {}  # inode => (mtime of newest generation, size, paths)
+    for dirname in dirnames:
+        for mtime, size, inode, path in _list_generations(
+            os.path.join(_workflow_dir(workflow_id), dirname)
+        ):
+            if inode in current_inodes:
+                continue
+            newest, _, paths = files.get(inode, (mtime, size, []))
+            paths.append(path)
+            files[inode] = (max(newest, mtime), size, paths)
+    unreferenced = sorted(files.values())
+
+    n_bytes = sum(size for _, size, _ in unreferenced)
+    for _, size, paths in unreferenced:
+        if n_bytes <= settings.RENDER_HISTORY_MAX_BYTES_PER_WORKFLOW:
+            break
+        for path in paths:
+            _remove_generation(path)
+        n_bytes -= size
+
+
+def discard_wf_module(workflow_id: int, wf_module_id: int) -> None:
+    """Delete all of a WfModule's history."""
+    shutil.rmtree(_wf_module_dir(workflow_id, wf_module_id),
+                  ignore_errors=True)
@@ -0,0 +1,277 @@
+"""
+Queue of workflow renders, run by dedicated render workers.
+
+A render job renders every WfModule in a workflow, writing their cached
+render results and telling websocket clients about each new result. Jobs are
+keyed by `(workflow_id, delta_id)`: requests for the same workflow at the
+same delta collapse into a single job.
+
+There are two backends, selected by `settings.RENDER_QUEUE_BACKEND`:
+
+* 'local': an in-memory stand-in. A thread pool in this process runs jobs,
+  and callers can wait for them on a `concurrent.futures.Future`.
+* 'channels': jobs go over the channel layer (Redis, in production) to the
+  'render' channel. Run workers with `./manage.py runworker render`. Callers
+  can't wait on those jobs: they get `None`, and they may poll the database
+  for the result.
+
+Either way, clients hear about new results through
+`websockets.ws_client_send_delta_sync()`.
+"""
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import threading
+import time
+from typing import Any, Dict, Optional, Tuple
+from asgiref.sync import async_to_sync
+from channels.consumer import SyncConsumer
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection, transaction
+from server import execute, websockets
+from server.models import WfModule, Workflow
+from server.utils import get_console_logger
+
+
+_logger = get_console_logger()
+
+
+RenderChannel = 'render'
+
+
+_ResendInterval = 60  # seconds
+
+
+Key = Tuple[int, int]
+
+
+def _client_attributes_that_change_on_render(
+    wf_module: WfModule
+) -> Dict[str, Any]:
+    cached_output_columns = wf_module.get_cached_output_columns()
+    if cached_output_columns is None:
+        output_columns = None
+    else:
+        output_columns = [{'name': c.name, 'type': c.type}
+                          for c in cached_output_columns]
+
+    return {
+        'error_msg': wf_module.error_msg,
+        'status': wf_module.status,
+        'output_columns': output_columns,
+    }
+
+
+def _notify_cached(wf_module: WfModule) -> None:
+    """Tell clients `wf_module` has a new status and output columns."""
+    update = _client_attributes_that_change_on_render(wf_module)
+    websockets.ws_client_send_delta_sync(wf_module.workflow_id, {
+        'updateWfModules': {str(wf_module.id): update}
+    })
+
+
+def render_workflow_and_notify(workflow_id: int,
+                               delta_id: Optional[int]=None) -> None:
+    """
+    Render (and cache) all of a workflow's WfModules; send websocket updates.
+
+    We render the selected WfModule first (along with the ones before it,
+    which it depends on), then each WfModule after it. Each time we cache a
+    WfModule's result, we send clients its new status and output columns.
+
+    We lock the workflow only briefly: we render with no transaction open
+    (see execute.execute_wfmodule_unlocked()), so users can edit the workflow
+    while we render. If `delta_id` is set and the workflow moves past it, we
+    stop between steps: a newer job will render the newer workflow.
+
+    WfModules whose cached results are fresh are not rendered again, so a
+    redundant job is cheap.
+    """
+    try:
+        workflow = Workflow.objects.get(id=workflow_id)
+    except Workflow.DoesNotExist:
+        return  # the workflow was deleted; there's nothing to render
+
+    target_index = None
+    while True:
+        try:
+            with workflow.cooperative_lock():
+                if delta_id is not None and workflow.revision() != delta_id:
+                    _logger.info('Cancelled render of workflow %d at %d',
+                                 workflow_id, delta_id)
+                    return
+
+                wf_module_ids = list(
+                    workflow.wf_modules.values_list('id', flat=True)
+                )
+
+            if target_index is None:
+                # Start with the selected WfModule
+                target_index = max(0, min(
+                    workflow.selected_wf_module or 0,
+                    len(wf_module_ids) - 1
+                ))
+
+            if target_index >= len(wf_module_ids):
+                return  # we rendered them all
+
+            report = execute.execute_wfmodule_unlocked(
+                workflow,
+                wf_module_ids[target_index],
+                on_cache=_notify_cached
+            )
+        except Workflow.DoesNotExist:
+            return  # the workflow was deleted mid-render
+        except WfModule.DoesNotExist:
+            continue  # the WfModule was deleted mid-render; start over
+
+        if report is None:
+            continue  # the workflow changed mid-render; start over
+
+        target_index += 1
+
+
+def _run_job(workflow_id: int, delta_id: int) -> None:
+    try:
+        render_workflow_and_notify(workflow_id, delta_id)
+    finally:
+        # Each worker thread has its own database connection. Don't leave it
+        # dangling between jobs.
+        connection.close()
+
+
+class LocalRenderQueue:
+    """
+    In-memory render queue: a thread pool in this process runs jobs.
+    """
+
+    def __init__(self, max_workers: int):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._in_flight = {}  # Key => Future
+
+    def submit(self, workflow_id: int, delta_id: int) -> Future:
+        """
+        Queue a render job, or return the existing one for the same key.
+        """
+        key = (workflow_id, delta_id)
+
+        with self._lock:
+            try:
+                return self._in_flight[key]
+            except KeyError:
+                pass
+
+            future = self._executor.submit(_run_job, workflow_id, delta_id)
+            self._in_flight[key] = future
+
+        future.add_done_callback(lambda _: self._forget(key, future))
+        return future
+
+    def _forget(self, key: Key, future: Future) -> None:
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+
+class ChannelsRenderQueue:
+    """
+    Render queue on the channel layer: render workers run jobs.
+
+    We can't wait for another process's job, so submit() returns None. To
+    avoid flooding workers, each process sends a given key at most once per
+    `_ResendInterval`. We forget keys sent longer ago than that, so we only
+    remember the workflows we sent in the last `_ResendInterval`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sent = {}  # workflow_id => (delta_id, time sent)
+        self._pruned_at = time.time()
+
+    def submit(self, workflow_id: int, delta_id: int) -> None:
+        now = time.time()
+        with self._lock:
+            self._prune(now)
+            sent_delta_id, sent_at = self._sent.get(workflow_id, (None, 0))
+            if sent_delta_id == delta_id and now - sent_at < _ResendInterval:
+                return None
+            self._sent[workflow_id] = (delta_id, now)
+
+        async_to_sync(get_channel_layer().send)(RenderChannel, {
+            'type': 'render',
+            'workflow_id': workflow_id,
+            'delta_id': delta_id,
+        })
+        return None
+
+    def _prune(self, now: float) -> None:
+        """Forget keys we'd resend anyway. Call with `self._lock` held."""
+        if now - self._pruned_at < _ResendInterval:
+            return  # scan at most once per interval
+
+        self._sent = {workflow_id: (delta_id, sent_at)
+                      for workflow_id, (delta_id, sent_at)
+                      in self._sent.items()
+                      if now - sent_at < _ResendInterval}
+        self._pruned_at = now
+
+
+class RenderConsumer(SyncConsumer):
+    """
+    Render worker for the 'channels' backend.
+    """
+
+    def render(self, message):
+        try:
+            render_workflow_and_notify(message['workflow_id'],
+                                       message['delta_id'])
+        except Exception as err:
+            _logger.exception(err)
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_queue():
+    """Return the render queue configured in settings."""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            if settings.RENDER_QUEUE_BACKEND == 'channels':
+                _queue = ChannelsRenderQueue()
+            else:
+                _queue = LocalRenderQueue(settings.RENDER_QUEUE_N_WORKERS)
+        return _queue
+
+
+def request_render(workflow: Workflow) -> Optional[Future]:
+    """
+    Queue a render of `workflow` at its current delta.
+
+    Return a Future that completes when the render is done (or cancelled), or
+    None if we can't wait for it (in which case the render is "pending").
+    """
+    return get_queue().submit(workflow.id, workflow.revision())
+
+
+def request_render_on_commit(workflow_id: int) -> None:
+    """
+    Queue a render of a workflow once the current transaction commits.
+
+    Deltas call this so WfModules re-render as soon as they change, before
+    anybody asks for them. We read the workflow's revision after the commit,
+    so the job renders the workflow that was committed.
+    """
+    if not settings.RENDER_AFTER_DELTA:
+        return
+
+    def submit():
+        try:
+            workflow = Workflow.objects.get(id=workflow_id)
+        except Workflow.DoesNotExist:
+            return
+        request_render(workflow)
+
+    transaction.on_commit(submit)
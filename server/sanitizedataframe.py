@@ -1,5 +1,5 @@
 # --- Dataframe sanitization and truncation ---
-from typing import Any, Optional
+from typing import Any, List, Optional
 from pandas.api.types import is_numeric_dtype, is_datetime64_dtype
 import numpy as np
 import pandas as pd
@@ -37,34 +37,44 @@ def _colname_to_str(c: Any) -> str:
         return str(c).strip()
 
 
+def _are_colnames_sane(names: List[Any]) -> bool:
+    """Return True if all column names are unique, stripped str."""
+    return (
+        all(isinstance(name, str) and name == name.strip() for name in names)
+        and len(set(names)) == len(names)
+    )
+
+
 def _rename_duplicate_and_nonstr_columns_in_place(table: pd.DataFrame) -> None:
     """
     Modify column names so they are all unique and str.
-    """
-    counts = {}
 
-    def unique_name(ideal_name: str) -> str:
-        """
-        Generate a guaranteed-unique column name, using `counts` as state.
+    Strategy for making 'A' unique:
 
-        Strategy for making 'A' unique:
+    * If 'A' has never been seen before, use it.
+    * If 'A' has been seen before, try 'A_1' or 'A_2' (where 1 and 2 are
+      the number of times 'A' has been seen).
+    * If there is a conflict on 'A_1', try 'A_1_1', and so on.
 
-        * If 'A' has never been seen before, return it.
-        * If 'A' has been seen before, try 'A_1' or 'A_2' (where 1 and 2 are
-          the number of times 'A' has been seen).
-        * If there is a conflict on 'A_1', recurse.
-        """
-        if ideal_name not in counts:
-            counts[ideal_name] = 1
-            return ideal_name
+    This is one pass over the names, with dict lookups. If the names are
+    fine already, we leave `table.columns` alone.
+    """
+    names = list(table.columns)
+    if _are_colnames_sane(names):
+        return
 
-        count = counts[ideal_name]
-        counts[ideal_name] += 1
-        backup_name = f'{ideal_name}_{count}'
-        return unique_name(backup_name)
+    counts = {}
+    unique_names = []
+    for name in names:
+        name = _colname_to_str(name)
+        while name in counts:
+            count = counts[name]
+            counts[name] += 1
+            name = f'{name}_{count}'
+        counts[name] = 1
+        unique_names.append(name)
 
-    table.columns = list([unique_name(_colname_to_str(name))
-                          for name in table.columns])
+    table.columns = unique_names
 
 
 # full type list:
@@ -81,6 +91,38 @@ _AllowedDtypes = {
 }
 
 
+# How many values we check before we check them all (see _is_str_series())
+_InferDtypeSampleSize = 1000
+
+
+def _is_str_series(series: pd.Series) -> bool:
+    """
+    Return True if `series` holds only str and NaN, as sanitize_series() wants.
+
+    A sample fails fast on most non-str columns. Then we check every value:
+    `infer_dtype()` loops in C and copies nothing, unlike `astype(str)`.
+    """
+    if series.dtype != object:
+        return False
+
+    def is_str_dtype(values: pd.Series) -> bool:
+        dtype = pd.api.types.infer_dtype(values, skipna=True)
+        return dtype in ('string', 'empty')  # 'empty' means all-null
+
+    sample = series.iloc[:_InferDtypeSampleSize]
+    if not is_str_dtype(sample):
+        return False
+    if len(series) > len(sample) and not is_str_dtype(series):
+        return False
+
+    # Nulls must be NaN, not None: they hash differently
+    isna = series.isna().values
+    if isna.any():
+        return all(isinstance(v, float) for v in series.values[isna])
+
+    return True
+
+
 def sanitize_series(series: pd.Series) -> pd.Series:
     """
     Build a Series conforming to Workbench data types.
@@ -108,6 +150,8 @@ def sanitize_series(series: pd.Series) -> pd.Series:
         return series
     elif is_datetime64_dtype(series.dtype):
         return series
+    elif _is_str_series(series):
+        return series
     else:
         # convert all non-NA to str
         ret = series.astype(str)
@@ -128,6 +172,8 @@ def sanitize_dataframe(table: Optional[pd.DataFrame]) -> pd.DataFrame:
     * Modify duplicate column names.
     * Reindex so row numbers are contiguous.
     * Convert unsupported dtypes to string.
+
+    Columns that are already sane are left as they are, without copying.
     """
     if table is None:
         return pd.DataFrame()
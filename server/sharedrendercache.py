@@ -0,0 +1,276 @@
+"""
+Render results shared between WfModules in all workflows.
+
+Each result is keyed by a fingerprint of everything that determines it: the
+input table's hash, the module and its code version, the parameter values
+and any fetched data. When a WfModule is about to render and an identical
+render has already happened anywhere (say, in another visitor's copy of an
+example workflow), we reuse that render's Parquet file instead.
+
+(execute.py also compares fingerprints within a single WfModule, to skip
+renders whose inputs did not change.)
+
+On disk, each entry is a Parquet file plus a JSON sidecar holding `error`,
+`json`, `hash`, `columns` and `nrows`. WfModules' cached render results are
+hard links to the same Parquet file, so reusing an entry costs no disk space.
+evict() deletes entries no WfModule's cached result uses, least recently used
+first.
+
+This cache is optional: set `settings.SHARED_RENDER_CACHE = False` to skip it.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from typing import Any, Dict, List, Optional, Tuple
+import uuid
+from django.conf import settings
+from django.core.files.storage import default_storage
+from server import dispatch
+from server.models import CachedRenderResult, StoredObject, WfModule
+from server.modules.types import Column
+from server.utils import get_console_logger
+
+
+_logger = get_console_logger()
+
+
+def _shared_dir() -> str:
+    return default_storage.path('cached-render-results/shared')
+
+
+def _entry_paths(fingerprint: str) -> Tuple[str, str]:
+    """Return the (Parquet, JSON) paths of an entry."""
+    prefix = os.path.join(_shared_dir(), fingerprint)
+    return (prefix + '.dat', prefix + '.json')
+
+
+def _metadata_columns(metadata: Dict[str, Any]) -> Optional[List[Column]]:
+    """Read columns from a sidecar; None if it predates storing them."""
+    if 'columns' not in metadata:
+        return None
+    return [Column(name, type) for name, type in metadata['columns']]
+
+
+def _remove_if_exists(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _fetched_data_hash(wf_module: WfModule) -> Optional[str]:
+    """
+    Hash `wf_module`'s current fetched table.
+
+    Return None if there is no such StoredObject, or if it predates column
+    hashes: then its `hash` ignores row order, so it can't identify the data.
+    """
+    row = StoredObject.objects \
+        .filter(wf_module_id=wf_module.id,
+                stored_at=wf_module.stored_data_version) \
+        .values_list('hash', 'column_hashes') \
+        .first()
+    if row is None:
+        return None
+
+    data_hash, column_hashes = row
+    if column_hashes is None:
+        return None
+    return data_hash
+
+
+def fingerprint(wf_module: WfModule, input_hash: str) -> Optional[str]:
+    """
+    Hash everything that determines what `wf_module` renders.
+
+    `input_hash` is the `hash_table_with_schema()` of the input table: that
+    is, the previous WfModule's `cached_render_result_hash`.
+
+    Return None if `wf_module`'s module is missing, or if we can't hash its
+    fetched data.
+
+    `wf_module.parameter_vals` should be prefetched with their specs, as
+    execute.py does: otherwise, this will query for them.
+    """
+    if wf_module.module_version is None:
+        return None
+
+    if wf_module.stored_data_version is None:
+        fetched_data_hash = None
+    else:
+        fetched_data_hash = _fetched_data_hash(wf_module)
+        if fetched_data_hash is None:
+            return None
+
+    parameters = sorted(
+        (pv.parameter_spec.id_name, pv.value)
+        for pv in wf_module.parameter_vals.all()
+    )
+
+    key = {
+        'input': input_hash,
+        'module': wf_module.module_version.module.id_name,
+        'version': dispatch.module_dispatch_version(wf_module),
+        'parameters': parameters,
+        'fetched_data': fetched_data_hash,
+        'fetch_error': wf_module.fetch_error,
+    }
+    key_bytes = json.dumps(key, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(key_bytes).hexdigest()
+
+
+def restore(fingerprint: str, wf_module: WfModule,
+            delta_id: int) -> Optional[CachedRenderResult]:
+    """
+    Make `wf_module`'s cached render result a link to a shared entry.
+
+    Return the new CachedRenderResult, or None if there is no such entry (or
+    the cache is disabled). The caller must save `wf_module`.
+    """
+    if not settings.SHARED_RENDER_CACHE:
+        return None
+
+    parquet_path, json_path = _entry_paths(fingerprint)
+
+    try:
+        with open(json_path, 'rb') as f:
+            metadata = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    if not metadata.get('hash'):
+        return None  # we wrote this entry before we stored hashes
+
+    try:
+        cached_result = CachedRenderResult.assign_wf_module_from_file(
+            wf_module,
+            delta_id,
+            metadata['error'],
+            metadata['json'],
+            metadata['hash'],
+            fingerprint,
+            parquet_path,
+            columns=_metadata_columns(metadata),
+            nrows=metadata.get('nrows')
+        )
+    except FileNotFoundError:
+        # evict() deleted it just now
+        return None
+
+    try:
+        os.utime(parquet_path)  # for evict(): we used it recently
+    except FileNotFoundError:
+        pass
+
+    return cached_result
+
+
+def store(fingerprint: str, cached_result: CachedRenderResult) -> None:
+    """
+    Share `cached_result`'s Parquet file under `fingerprint`.
+
+    Do nothing if an entry already exists (or the cache is disabled).
+    """
+    if not settings.SHARED_RENDER_CACHE:
+        return
+
+    parquet_path, json_path = _entry_paths(fingerprint)
+    if os.path.exists(parquet_path):
+        return
+
+    os.makedirs(_shared_dir(), exist_ok=True)
+
+    # Write the sidecar first: restore() only finds entries with a sidecar,
+    # and it handles a missing Parquet file.
+    temp_json_path = f'{json_path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_json_path, 'w') as f:
+        json.dump({
+            'error': cached_result.error,
+            'json': cached_result.json,
+            'hash': cached_result.hash,
+            'columns': [[c.name, c.type] for c in cached_result.columns],
+            'nrows': cached_result.total_rows,
+        }, f)
+    os.replace(temp_json_path, json_path)
+
+    try:
+        os.link(cached_result.parquet_path, parquet_path)
+    except FileExistsError:
+        pass  # Another process shared the same result
+    except FileNotFoundError:
+        pass  # The WfModule's result is gone already
+    except OSError:
+        # We can't hard-link, so the WfModule won't share this copy
+        temp_path = f'{parquet_path}.{uuid.uuid4().hex}.tmp'
+        try:
+            shutil.copyfile(cached_result.parquet_path, temp_path)
+            os.replace(temp_path, parquet_path)
+        except FileNotFoundError:
+            _remove_if_exists(temp_path)
+
+
+def evict(max_bytes: Optional[int]=None) -> int:
+    """
+    Delete unreferenced entries until they take at most `max_bytes`.
+
+    Entries that WfModules' cached results still link to cost no extra disk
+    space, so we neither count nor delete them. Render history links to
+    entries, too, but we don't count those links: history has its own budget
+    (see renderhistory.prune()). A file with only history links is
+    unreferenced here.
+
+    We delete least-recently-used entries first. Return the number of entries
+    we deleted.
+    """
+    if max_bytes is None:
+        max_bytes = settings.SHARED_RENDER_CACHE_MAX_BYTES
+
+    try:
+        names = os.listdir(_shared_dir())
+    except FileNotFoundError:
+        return 0
+
+    entries = []
+    for name in names:
+        if not name.endswith('.dat'):
+            continue
+        fingerprint = name[:-len('.dat')]
+        try:
+            stat = os.stat(_entry_paths(fingerprint)[0])
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, stat.st_nlink,
+                        fingerprint))
+
+    # A WfModule uses an entry if its cached result has the entry's
+    # fingerprint. Only linked entries can be in use.
+    linked = [fingerprint for _, _, n_links, fingerprint in entries
+              if n_links > 1]
+    in_use = set(
+        WfModule.objects
+        .filter(cached_render_result_fingerprint__in=linked)
+        .values_list('cached_render_result_fingerprint', flat=True)
+    ) if linked else set()
+
+    unreferenced = sorted((mtime, size, fingerprint)
+                          for mtime, size, _, fingerprint in entries
+                          if fingerprint not in in_use)
+    n_bytes = sum(size for _, size, _ in unreferenced)
+
+    n_evicted = 0
+    for _, size, fingerprint in unreferenced:
+        if n_bytes <= max_bytes:
+            break
+
+        parquet_path, json_path = _entry_paths(fingerprint)
+        _remove_if_exists(parquet_path)
+        _remove_if_exists(json_path)
+        n_bytes -= size
+        n_evicted += 1
+
+    if n_evicted:
+        _logger.info('Evicted %d shared render results', n_evicted)
+
+    return n_evicted
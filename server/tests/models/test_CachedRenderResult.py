@@ -1,7 +1,9 @@
 import os.path
 import datetime
 import pandas
+from django.test import override_settings
 from server.tests.utils import DbTestCase
+from server import dataframecache
 from server.models import Workflow, WfModule
 from server.modules.types import Column, ProcessResult
 
@@ -60,9 +62,10 @@ class CachedRenderResultTests(DbTestCase):
         self.wf_module.cache_render_result(2, result)
         self.wf_module.save()
 
-        cached_result = self.wf_module.get_cached_render_result()
-        cached_result.parquet_file  # read header
+        db_wf_module = WfModule.objects.get(id=self.wf_module.id)
+        cached_result = db_wf_module.get_cached_render_result()
         os.unlink(cached_result.parquet_path)
+        dataframecache.cache.clear()
         self.assertEqual(cached_result.column_names, ['A', 'B', 'C', 'D'])
         self.assertEqual(cached_result.column_types,
                          ['number', 'datetime', 'text', 'text'])
@@ -124,3 +127,103 @@ class CachedRenderResultTests(DbTestCase):
         workflow2 = Workflow.objects.create()
         dup = self.wf_module.duplicate(workflow2)
         self.assertIsNone(dup.get_cached_render_result())
+
+    def test_read_dataframe_slice(self):
+        result = ProcessResult(pandas.DataFrame({'A': [1, 2, 3, 4],
+                                                 'B': ['a', 'b', 'c', 'd']}))
+        self.wf_module.cache_render_result(2, result)
+        self.wf_module.save()
+
+        db_wf_module = WfModule.objects.get(id=self.wf_module.id)
+        cached_result = db_wf_module.get_cached_render_result()
+        self.assertEqual(cached_result.total_rows, 4)
+
+        dataframe = cached_result.read_dataframe(1, 3)
+        self.assertEqual(list(dataframe['A']), [2, 3])
+        self.assertEqual(list(dataframe['B']), ['b', 'c'])
+        self.assertEqual(list(dataframe.index), [1, 2])
+
+    @override_settings(PARQUET_ROW_GROUP_SIZE=2)
+    def test_read_dataframe_slice_across_row_groups(self):
+        result = ProcessResult(pandas.DataFrame({'A': [1, 2, 3, 4, 5]}))
+        self.wf_module.cache_render_result(2, result)
+        self.wf_module.save()
+
+        dataframecache.cache.clear()  # read from disk
+
+        db_wf_module = WfModule.objects.get(id=self.wf_module.id)
+        cached_result = db_wf_module.get_cached_render_result()
+        self.assertGreater(len(cached_result.parquet_file.row_groups), 1)
+        self.assertEqual(cached_result.total_rows, 5)
+
+        dataframe = cached_result.read_dataframe(1, 4)
+        self.assertEqual(list(dataframe['A']), [2, 3, 4])
+        self.assertEqual(list(dataframe.index), [1, 2, 3])
+
+    @override_settings(PARQUET_ROW_GROUP_SIZE=None)
+    def test_read_dataframe_slice_single_row_group(self):
+        # Files written before we split row groups must still be readable
+        result = ProcessResult(pandas.DataFrame({'A': [1, 2, 3, 4, 5]}))
+        self.wf_module.cache_render_result(2, result)
+        self.wf_module.save()
+
+        dataframecache.cache.clear()  # read from disk
+
+        db_wf_module = WfModule.objects.get(id=self.wf_module.id)
+        cached_result = db_wf_module.get_cached_render_result()
+        self.assertEqual(len(cached_result.parquet_file.row_groups), 1)
+
+        dataframe = cached_result.read_dataframe(3, 10)
+        self.assertEqual(list(dataframe['A']), [4, 5])
+        self.assertEqual(list(dataframe.index), [3, 4])
+
+        dataframe = cached_result.read_dataframe(2, 300, columns=['B'])
+        self.assertEqual(list(dataframe.columns), ['B'])
+        self.assertEqual(list(dataframe['B']), ['c', 'd'])
+
+        dataframe = cached_result.read_dataframe(10, 20)
+        self.assertEqual(list(dataframe.columns), ['A', 'B'])
+        self.assertEqual(len(dataframe), 0)
+
+    def test_total_rows_does_not_read_file(self):
+        result = ProcessResult(pandas.DataFrame({'A': [1, 2, 3]}))
+        self.wf_module.cache_render_result(2, result)
+        self.wf_module.save()
+
+        db_wf_module = WfModule.objects.get(id=self.wf_module.id)
+        cached_result = db_wf_module.get_cached_render_result()
+        os.unlink(cached_result.parquet_path)
+        self.assertEqual(cached_result.total_rows, 3)
+
+    def test_columns_from_parquet_header_when_not_in_database(self):
+        # Results cached before we stored columns in the database
+        result = ProcessResult(pandas.DataFrame({'A': [1], 'B': ['x']}))
+        self.wf_module.cache_render_result(2, result)
+        self.wf_module.cached_render_result_columns = None
+        self.wf_module.cached_render_result_nrows = None
+        self.wf_module.save()
+
+        db_wf_module = WfModule.objects.get(id=self.wf_module.id)
+        cached_result = db_wf_module.get_cached_render_result()
+        self.assertEqual(cached_result.columns,
+                         [Column('A', 'number'), Column('B', 'text')])
+        self.assertEqual(cached_result.total_rows, 1)
+
+    def test_result_is_cached_in_memory(self):
+        result = ProcessResult(pandas.DataFrame({'A': [1, 2]}))
+        self.wf_module.cache_render_result(2, result)
+        self.wf_module.save()
+        os.remove(self.wf_module.get_cached_render_result().parquet_path)
+
+        db_wf_module = WfModule.objects.get(id=self.wf_module.id)
+        cached_result = db_wf_module.get_cached_render_result()
+        self.assertEqual(cached_result.result, result)
+
+    def test_cached_result_is_a_copy(self):
+        result = ProcessResult(pandas.DataFrame({'A': [1, 2]}))
+        self.wf_module.cache_render_result(2, result)
+        result.dataframe['A'] = [3, 4]  # as a module's render() might
+
+        db_wf_module = WfModule.objects.get(id=self.wf_module.id)
+        cached_result = db_wf_module.get_cached_render_result()
+        self.assertEqual(list(cached_result.result.dataframe['A']), [1, 2])
@@ -13,6 +13,7 @@ from server.models import ParameterVal
 from server.modules.types import ProcessResult
 from server.tests.utils import LoggedInTestCase, load_and_add_module, \
         mock_xlsx_path
+from server.updates import run_queued_fetches
 
 XLSX_MIME_TYPE = \
         'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
@@ -74,6 +75,7 @@ class LoadFromURLTests(LoggedInTestCase):
     # send fetch event to button to load data
     def press_fetch_button(self):
         self.client.post('/api/parameters/%d/event' % self.fetch_pval.id)
+        run_queued_fetches()  # as a fetch worker would
         self.wfmodule.refresh_from_db()  # last_relevant_delta_id changed
 
     def test_load_csv(self):
@@ -155,6 +157,34 @@ class LoadFromURLTests(LoggedInTestCase):
             result = execute_wfmodule(self.wfmodule)
             self.assertEqual(result, ProcessResult(mock_csv_table))
 
+    def test_load_csv_charset_from_header(self):
+        url = 'http://test.com/the.csv'
+        self.url_pval.set_value(url)
+        self.url_pval.save()
+
+        with patch('requests.get') as get:
+            get.return_value = mock_bytes_response(
+                'A\ncafé'.encode('iso-8859-1'),
+                'text/csv; charset=iso-8859-1'
+            )
+            self.press_fetch_button()
+            result = execute_wfmodule(self.wfmodule)
+            self.assertEqual(result,
+                             ProcessResult(pd.DataFrame({'A': ['café']})))
+
+    @override_settings(DOWNLOAD_MAX_BYTES=10)
+    def test_load_csv_too_large(self):
+        url = 'http://test.com/the.csv'
+        self.url_pval.set_value(url)
+        self.url_pval.save()
+
+        with patch('requests.get') as get:
+            get.return_value = mock_text_response(mock_csv_text, 'text/csv')
+            self.press_fetch_button()
+            self.wfmodule.refresh_from_db()
+            self.assertEqual(self.wfmodule.fetch_error,
+                             'File is too large: the limit is 10 bytes')
+
     def test_load_json(self):
         url = 'http://test.com/the.json'
         self.url_pval.set_value(url)
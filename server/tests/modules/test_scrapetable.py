@@ -2,6 +2,7 @@ from server.tests.utils import LoggedInTestCase, load_and_add_module, \
         get_param_by_id_name, mock_csv_table
 from server.models import ParameterSpec, ParameterVal, WfModule
 from server.execute import execute_wfmodule
+from server.updates import run_queued_fetches
 from django.test import override_settings
 from unittest import mock
 import tempfile
@@ -32,6 +33,7 @@ class ScrapeTableTest(LoggedInTestCase):
     # send fetch event to button to load data
     def press_fetch_button(self):
         self.client.post('/api/parameters/%d/event' % self.fetch_pval.id)
+        run_queued_fetches()  # as a fetch worker would
         self.wfmodule.refresh_from_db()  # new last_relevant_workflow_id
 
     def test_scrape_table(self):
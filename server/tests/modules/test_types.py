@@ -149,6 +149,24 @@ class ProcessResultTests(unittest.TestCase):
         result.sanitize_in_place()
         self.assertEqual(result, expected)
 
+    def test_sanitize_once(self):
+        result = ProcessResult(DataFrame({'foo': [[1], [2]]}))
+        result.sanitize_in_place()
+        self.assertTrue(result.is_sanitized)
+
+        with mock.patch('server.sanitizedataframe.sanitize_dataframe') \
+                as sanitize:
+            result.sanitize_in_place()
+            sanitize.assert_not_called()
+
+    def test_sanitize_new_dataframe(self):
+        result = ProcessResult(DataFrame({'foo': ['a']}))
+        result.sanitize_in_place()
+        result.dataframe = DataFrame({'foo': [[1]]})
+        self.assertFalse(result.is_sanitized)
+        result.sanitize_in_place()
+        self.assertEqual(result, ProcessResult(DataFrame({'foo': ['[1]']})))
+
     def test_columns(self):
         df = DataFrame({
             'A': [1],  # number
@@ -13,6 +13,7 @@ from server.tests.utils import DbTestCase, LoggedInTestCase, \
 from server.modules.types import ProcessResult
 from server.modules.urlscraper import URLScraper, is_valid_url, scrape_urls
 from server.execute import execute_wfmodule
+from server.updates import run_queued_fetches
 
 # --- Some test data ----
 
@@ -188,6 +189,7 @@ class URLScraperTests(LoggedInTestCase):
     def press_fetch_button(self):
         version_id = get_param_by_id_name('version_select').id
         self.client.post(f'/api/parameters/{version_id}/event')
+        run_queued_fetches()  # as a fetch worker would
         self.wfmodule.refresh_from_db()  # new last_relevant_workflow_id
 
     def test_initial_nop(self):
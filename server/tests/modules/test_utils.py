@@ -1,10 +1,16 @@
 import io
+import os.path
+import shutil
+import tempfile
 import unittest
 import numpy
 import pandas
 from django.test import SimpleTestCase, override_settings
+from server import parquet
 from server.modules.types import ProcessResult
-from server.modules.utils import build_globals_for_eval, parse_bytesio
+from server.modules.utils import build_globals_for_eval, parse_bytesio, \
+        parse_chunks, ingest_bytesio, ingest_chunks
+from server.pandas_util import hash_columns
 
 
 class SafeExecTest(unittest.TestCase):
@@ -129,3 +135,166 @@ class ParseBytesIoTest(SimpleTestCase):
                                'text/txt', 'utf-8')
 
         self.assertEqual(result, expected)
+
+
+class ParseChunksTest(SimpleTestCase):
+    def test_parse_chunks(self):
+        result = parse_chunks([b'A,B\n1,', b'2\n3,4'], 'text/csv', 'utf-8')
+        expected = ProcessResult(pandas.DataFrame({'A': [1, 3], 'B': [2, 4]}))
+        self.assertEqual(result, expected)
+
+    @override_settings(SPOOL_MAX_MEMORY_BYTES=2)
+    def test_parse_chunks_spooled_to_disk(self):
+        # \xe9 is ISO-8859-1 so Workbench should auto-detect it
+        result = parse_chunks([b'A\ncaf', b'\xe9'], 'text/csv', None)
+        expected = ProcessResult(
+            pandas.DataFrame({'A': ['café']}).astype('category')
+        )
+        self.assertEqual(result, expected)
+
+    @override_settings(DOWNLOAD_MAX_BYTES=5)
+    def test_parse_chunks_too_large(self):
+        def chunks():
+            yield b'A\nab'
+            yield b'c'
+            raise AssertionError('read past DOWNLOAD_MAX_BYTES')
+
+        result = parse_chunks(chunks(), 'text/csv', None)
+        self.assertEqual(result, ProcessResult(
+            error='File is too large: the limit is 5 bytes'
+        ))
+
+
+class IngestBytesIoTest(SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'table.dat')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+        super().tearDown()
+
+    def _ingest(self, b, mime_type='text/csv', text_encoding='utf-8'):
+        return ingest_bytesio(io.BytesIO(b), mime_type, text_encoding,
+                              self.path)
+
+    @override_settings(INGEST_CHUNK_SIZE=2)
+    def test_write_chunks_as_row_groups(self):
+        table = self._ingest(b'A,B\n1,a\n2,b\n3,c\n4,d\n5,e')
+        self.assertEqual(table.path, self.path)
+        self.assertEqual(table.nrows, 5)
+        self.assertEqual(table.error, '')
+        self.assertEqual(len(parquet.read_header(self.path).row_groups), 3)
+
+        result = parquet.read(self.path)
+        expected = pandas.DataFrame({'A': [1, 2, 3, 4, 5],
+                                     'B': ['a', 'b', 'c', 'd', 'e']})
+        pandas.testing.assert_frame_equal(result, expected)
+        self.assertEqual(table.column_hashes, hash_columns(result))
+
+    @override_settings(INGEST_CHUNK_SIZE=2)
+    def test_widen_int_to_float(self):
+        self._ingest(b'A\n1\n2\n3.5')
+        result = parquet.read(self.path)
+        pandas.testing.assert_frame_equal(
+            result,
+            pandas.DataFrame({'A': [1.0, 2.0, 3.5]})
+        )
+
+    @override_settings(INGEST_CHUNK_SIZE=2)
+    def test_widen_number_to_str(self):
+        table = self._ingest(b'A\n1\n2\n3.5\nx')
+        self.assertEqual(table.nrows, 4)
+        result = parquet.read(self.path)
+        pandas.testing.assert_frame_equal(
+            result,
+            pandas.DataFrame({'A': ['1', '2', '3.5', 'x']})
+        )
+        self.assertEqual(table.column_hashes, hash_columns(result))
+
+    @override_settings(INGEST_CHUNK_SIZE=2, MAX_ROWS_PER_TABLE=3)
+    def test_truncate(self):
+        table = self._ingest(b'A\n1\n2\n3\n4\n5')
+        self.assertEqual(table.nrows, 3)
+        self.assertEqual(table.error, 'Truncated output to 3 rows')
+        pandas.testing.assert_frame_equal(parquet.read(self.path),
+                                          pandas.DataFrame({'A': [1, 2, 3]}))
+
+    @override_settings(INGEST_CHUNK_SIZE=2, MAX_ROWS_PER_TABLE=3)
+    def test_truncate_without_parsing_the_rest(self):
+        table = self._ingest(b'A\n1\n2\n3\n4\n5,6,7')
+        self.assertEqual(table.error, 'Truncated output to 3 rows')
+        pandas.testing.assert_frame_equal(parquet.read(self.path),
+                                          pandas.DataFrame({'A': [1, 2, 3]}))
+
+    @override_settings(INGEST_CHUNK_SIZE=2, CATEGORY_FILE_SIZE_MIN=1)
+    def test_large_file_text_as_category(self):
+        table = self._ingest(b'A,B\n1,b\n2,a\n3,b\n4,c')
+        self.assertEqual(len(parquet.read_header(self.path).row_groups), 2)
+        result = parquet.read(self.path)
+        expected = pandas.DataFrame({
+            'A': [1, 2, 3, 4],
+            'B': pandas.Categorical(['b', 'a', 'b', 'c'],
+                                    categories=['a', 'b', 'c']),
+        })
+        pandas.testing.assert_frame_equal(result, expected)
+        self.assertEqual(table.column_hashes, hash_columns(result))
+
+    @override_settings(INGEST_CHUNK_SIZE=2, CATEGORY_FILE_SIZE_MIN=1,
+                       INGEST_MAX_CATEGORIES=2)
+    def test_large_file_too_many_categories_as_str(self):
+        self._ingest(b'A\na\nb\nc')
+        pandas.testing.assert_frame_equal(
+            parquet.read(self.path),
+            pandas.DataFrame({'A': ['a', 'b', 'c']})
+        )
+
+    @override_settings(INGEST_CHUNK_SIZE=2, CATEGORY_FILE_SIZE_MIN=1)
+    def test_large_file_number_widened_to_text_as_str(self):
+        # We didn't collect the first chunk's values: no categories
+        self._ingest(b'A\n1\n2\nx')
+        pandas.testing.assert_frame_equal(
+            parquet.read(self.path),
+            pandas.DataFrame({'A': ['1', '2', 'x']})
+        )
+
+    def test_tsv(self):
+        self._ingest(b'A\tB\na\tb', 'text/tab-separated-values')
+        pandas.testing.assert_frame_equal(
+            parquet.read(self.path),
+            pandas.DataFrame({'A': ['a'], 'B': ['b']})
+        )
+
+    def test_txt_separator_detection(self):
+        self._ingest(b'A;B\na;b', 'text/txt')
+        pandas.testing.assert_frame_equal(
+            parquet.read(self.path),
+            pandas.DataFrame({'A': ['a'], 'B': ['b']})
+        )
+
+    def test_autodetect_charset(self):
+        # \xe9 is ISO-8859-1 so Workbench should auto-detect it
+        self._ingest(b'A\ncaf\xe9', text_encoding=None)
+        pandas.testing.assert_frame_equal(parquet.read(self.path),
+                                          pandas.DataFrame({'A': ['café']}))
+
+    def test_empty(self):
+        table = self._ingest(b'')
+        self.assertEqual(table, (None, [], 0, ''))
+        self.assertFalse(os.path.exists(self.path))
+
+    @override_settings(INGEST_CHUNK_SIZE=1)
+    def test_parse_error_removes_file(self):
+        table = self._ingest(b'A,B\n1,2\n3,4\n"x')
+        self.assertEqual(table.path, None)
+        self.assertEqual(table.nrows, 0)
+        self.assertTrue(table.error)
+        self.assertFalse(os.path.exists(self.path))
+
+    @override_settings(DOWNLOAD_MAX_BYTES=5)
+    def test_ingest_chunks_too_large(self):
+        table = ingest_chunks([b'A\nab', b'c'], 'text/csv', None, self.path)
+        self.assertEqual(table.error,
+                         'File is too large: the limit is 5 bytes')
+        self.assertFalse(os.path.exists(self.path))
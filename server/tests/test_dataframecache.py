@@ -0,0 +1,76 @@
+from unittest import TestCase
+import pandas as pd
+from pandas.testing import assert_frame_equal
+from server.dataframecache import DataFrameCache, _dataframe_size
+
+
+class DataFrameCacheTest(TestCase):
+    def setUp(self):
+        self.table = pd.DataFrame({'A': [1, 2, 3], 'B': ['x', 'y', 'z']})
+        self.size = _dataframe_size(self.table)
+
+    def test_miss(self):
+        cache = DataFrameCache(self.size)
+        self.assertIsNone(cache.get((1, 2)))
+        self.assertEqual(cache.n_misses, 1)
+        self.assertEqual(cache.n_hits, 0)
+
+    def test_hit(self):
+        cache = DataFrameCache(self.size)
+        cache.put((1, 2), self.table)
+        assert_frame_equal(cache.get((1, 2)), self.table)
+        self.assertEqual(cache.n_hits, 1)
+        self.assertEqual(cache.n_bytes, self.size)
+
+    def test_put_and_get_copy(self):
+        cache = DataFrameCache(self.size)
+        cache.put((1, 2), self.table)
+        self.table['A'] = [4, 5, 6]
+
+        got = cache.get((1, 2))
+        self.assertEqual(list(got['A']), [1, 2, 3])
+        got['A'] = [7, 8, 9]
+        self.assertEqual(list(cache.get((1, 2))['A']), [1, 2, 3])
+
+    def test_get_slice(self):
+        cache = DataFrameCache(self.size)
+        cache.put((1, 2), self.table)
+        got = cache.get_slice((1, 2), 1, 3)
+        self.assertEqual(list(got['B']), ['y', 'z'])
+        self.assertEqual(list(got.index), [1, 2])
+
+    def test_evict_least_recently_used(self):
+        cache = DataFrameCache(self.size * 2)
+        cache.put((1, 1), self.table)
+        cache.put((2, 1), self.table)
+        cache.get((1, 1))  # now (2, 1) is least recently used
+        cache.put((3, 1), self.table)
+
+        self.assertIn((1, 1), cache)
+        self.assertNotIn((2, 1), cache)
+        self.assertIn((3, 1), cache)
+        self.assertEqual(cache.n_evictions, 1)
+        self.assertEqual(cache.n_bytes, self.size * 2)
+
+    def test_skip_dataframe_larger_than_budget(self):
+        cache = DataFrameCache(self.size - 1)
+        cache.put((1, 2), self.table)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.n_bytes, 0)
+
+    def test_replace_key(self):
+        cache = DataFrameCache(self.size * 2)
+        cache.put((1, 2), self.table)
+        cache.put((1, 2), self.table)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.n_bytes, self.size)
+
+    def test_discard_wf_module(self):
+        cache = DataFrameCache(self.size * 3)
+        cache.put((1, 1), self.table)
+        cache.put((1, 2), self.table)
+        cache.put((2, 2), self.table)
+        cache.discard_wf_module(1)
+        self.assertEqual(len(cache), 1)
+        self.assertIn((2, 2), cache)
+        self.assertEqual(cache.n_bytes, self.size)
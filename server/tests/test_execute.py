@@ -1,13 +1,18 @@
 from server.tests.utils import DbTestCase, create_testdata_workflow, \
-        load_and_add_module, get_param_by_id_name
+        load_and_add_module, get_param_by_id_name, mock_ab_csv_text
 from server.models.Commands import ChangeParameterCommand
-from server.execute import execute_wfmodule
-from server.modules.types import ProcessResult
+from server.execute import execute_wfmodule, execute_wfmodule_with_report, \
+        execute_wfmodule_unlocked, _RenderStep
+from server import dataframecache, parquet
+from server.models import WfModule
+from server.modules.types import Column, ProcessResult
+from collections import deque
+import os
+from django.db import connection
 import pandas as pd
 from unittest import mock
 
 
-table_csv = 'A,B\n1,2\n3,4'
 table_dataframe = pd.DataFrame({'A': [1, 3], 'B': [2, 4]})
 
 
@@ -21,14 +26,14 @@ def cached_render_result_revision_list(workflow):
 class ExecuteTests(DbTestCase):
     def test_execute_revision_0(self):
         # Don't crash on a new workflow (rev=0, no caches)
-        workflow = create_testdata_workflow(table_csv)
+        workflow = create_testdata_workflow(mock_ab_csv_text)
         wf_module2 = load_and_add_module('selectcolumns', workflow=workflow)
         result = execute_wfmodule(wf_module2)
         self.assertEqual(result, ProcessResult(table_dataframe))
         self.assertEqual(cached_render_result_revision_list(workflow), [0, 0])
 
     def test_execute_new_revision(self):
-        workflow = create_testdata_workflow(table_csv)
+        workflow = create_testdata_workflow(mock_ab_csv_text)
         wf_module2 = load_and_add_module('selectcolumns', workflow=workflow)
 
         # Add command, modifying revision
@@ -49,7 +54,7 @@ class ExecuteTests(DbTestCase):
         self.assertEqual(cached_render_result_revision_list(workflow), [1, 2])
 
     def test_execute_cache_hit(self):
-        workflow = create_testdata_workflow(table_csv)
+        workflow = create_testdata_workflow(mock_ab_csv_text)
         wf_module2 = load_and_add_module('selectcolumns', workflow=workflow)
         # Execute -- which should cache the result
         expected = execute_wfmodule(wf_module2)
@@ -60,7 +65,7 @@ class ExecuteTests(DbTestCase):
             self.assertEqual(result, expected)
 
     def test_resume_without_rerunning_unneeded_renders(self):
-        workflow = create_testdata_workflow(table_csv)
+        workflow = create_testdata_workflow(mock_ab_csv_text)
         wf_module1 = workflow.wf_modules.first()
         wf_module2 = load_and_add_module('selectcolumns', workflow=workflow,
                                          last_relevant_delta_id=1)
@@ -72,9 +77,242 @@ class ExecuteTests(DbTestCase):
         wf_module2.refresh_from_db()
         wf_module2.last_relevant_delta_id = 2
         wf_module2.save()
+        pval = get_param_by_id_name('colnames', wf_module=wf_module2)
+        pval.set_value('A')
+        pval.save()
 
         with mock.patch('server.dispatch.module_dispatch_render') as mdr:
             mdr.return_value = expected
             result = execute_wfmodule(wf_module2)
             mdr.assert_called_once()
             self.assertEqual(result, expected)
+
+    def test_report_counts_renders(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module2 = load_and_add_module('selectcolumns', workflow=workflow)
+
+        report = execute_wfmodule_with_report(wf_module2)
+        self.assertEqual(report.n_renders, 2)
+        self.assertEqual(report.result, ProcessResult(table_dataframe))
+
+        report = execute_wfmodule_with_report(wf_module2)
+        self.assertEqual(report.n_renders, 0)
+        self.assertEqual(report.result, ProcessResult(table_dataframe))
+
+    def test_on_cache_after_commit(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module = workflow.wf_modules.first()
+        on_cache = mock.Mock()
+
+        with workflow.cooperative_lock():
+            execute_wfmodule_with_report(wf_module, on_cache=on_cache)
+            # A client that heard now could read the old result
+            on_cache.assert_not_called()
+
+        on_cache.assert_called_once_with(wf_module)
+
+    def test_on_cache_each_cached_wf_module(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module1 = workflow.wf_modules.first()
+        wf_module2 = load_and_add_module('selectcolumns', workflow=workflow)
+        on_cache = mock.Mock()
+
+        execute_wfmodule_with_report(wf_module2, on_cache=on_cache)
+        cached = [call[0][0] for call in on_cache.call_args_list]
+        self.assertEqual([wfm.id for wfm in cached],
+                         [wf_module1.id, wf_module2.id])
+        self.assertEqual(
+            cached[1].get_cached_output_columns(),
+            [Column('A', 'number'), Column('B', 'number')]
+        )
+
+    def test_cache_hit_reads_no_files(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module2 = load_and_add_module('selectcolumns', workflow=workflow)
+        execute_wfmodule(wf_module2)
+
+        on_cache = mock.Mock()
+        with mock.patch('server.parquet.read_header') as read_header:
+            report = execute_wfmodule_with_report(wf_module2,
+                                                  on_cache=on_cache)
+            on_cache.assert_not_called()
+            report.cached_result.columns
+            read_header.assert_not_called()
+
+    def test_cache_hit_queries_do_not_grow_with_workflow(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module = load_and_add_module('selectcolumns', workflow=workflow)
+        execute_wfmodule(wf_module)
+        short_report = execute_wfmodule_with_report(wf_module)
+
+        for _ in range(3):
+            wf_module = load_and_add_module('selectcolumns', workflow=workflow)
+        execute_wfmodule(wf_module)
+        long_report = execute_wfmodule_with_report(wf_module)
+
+        self.assertEqual(long_report.n_queries, short_report.n_queries)
+
+    def test_count_queries_without_logging_them(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module = load_and_add_module('selectcolumns', workflow=workflow)
+        execute_wfmodule(wf_module)
+
+        # A full query log (as in a long-lived worker thread) can't grow
+        with mock.patch.object(connection, 'queries_log', deque(maxlen=0)):
+            report = execute_wfmodule_with_report(wf_module)
+        self.assertEqual(report.n_queries, 2)  # WfModules, ParameterVals
+        self.assertFalse(connection.force_debug_cursor)
+
+    def test_skip_render_when_inputs_unchanged(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module2 = load_and_add_module('selectcolumns', workflow=workflow)
+        execute_wfmodule(wf_module2)
+
+        # A delta that touches nothing the modules read (say, a note)
+        for wf_module in workflow.wf_modules.all():
+            wf_module.last_relevant_delta_id = 3
+            wf_module.save()
+        wf_module2.refresh_from_db()
+
+        with mock.patch('server.dispatch.module_dispatch_render') as mdr:
+            report = execute_wfmodule_with_report(wf_module2)
+            mdr.assert_not_called()
+
+        self.assertEqual(report.n_renders, 0)
+        self.assertEqual(report.n_skipped, 2)
+        self.assertEqual(report.result, ProcessResult(table_dataframe))
+        self.assertEqual(cached_render_result_revision_list(workflow), [3, 3])
+
+    def test_skip_downstream_render_when_output_unchanged(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module2 = load_and_add_module('selectcolumns', workflow=workflow,
+                                         last_relevant_delta_id=1)
+        wf_module3 = load_and_add_module('selectcolumns', workflow=workflow,
+                                         last_relevant_delta_id=1)
+        execute_wfmodule(wf_module3)
+
+        # Keeping every column outputs the same table as keeping none
+        pval = get_param_by_id_name('colnames', wf_module=wf_module2)
+        pval.set_value('A,B')
+        pval.save()
+        wf_module2.refresh_from_db()
+        wf_module2.last_relevant_delta_id = 2
+        wf_module2.save()
+        wf_module3.refresh_from_db()
+        wf_module3.last_relevant_delta_id = 2
+        wf_module3.save()
+
+        report = execute_wfmodule_with_report(wf_module3)
+        self.assertEqual(report.n_renders, 1)  # just wf_module2
+        self.assertEqual(report.n_skipped, 1)  # wf_module3
+        self.assertEqual(report.result, ProcessResult(table_dataframe))
+
+    def test_render_downstream_when_output_changes(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module2 = load_and_add_module('selectcolumns', workflow=workflow,
+                                         last_relevant_delta_id=1)
+        wf_module3 = load_and_add_module('selectcolumns', workflow=workflow,
+                                         last_relevant_delta_id=1)
+        execute_wfmodule(wf_module3)
+
+        pval = get_param_by_id_name('colnames', wf_module=wf_module2)
+        pval.set_value('A')
+        pval.save()
+        wf_module2.refresh_from_db()
+        wf_module2.last_relevant_delta_id = 2
+        wf_module2.save()
+        wf_module3.refresh_from_db()
+        wf_module3.last_relevant_delta_id = 2
+        wf_module3.save()
+
+        report = execute_wfmodule_with_report(wf_module3)
+        self.assertEqual(report.n_renders, 2)
+        self.assertEqual(report.n_skipped, 0)
+        self.assertEqual(report.result, ProcessResult(table_dataframe[['A']]))
+
+
+class ExecuteUnlockedTests(DbTestCase):
+    def test_render_and_cache(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module2 = load_and_add_module('selectcolumns', workflow=workflow)
+
+        report = execute_wfmodule_unlocked(workflow, wf_module2.id)
+        self.assertEqual(report.n_renders, 2)
+        self.assertEqual(report.result, ProcessResult(table_dataframe))
+        self.assertEqual(cached_render_result_revision_list(workflow), [0, 0])
+
+        report = execute_wfmodule_unlocked(workflow, wf_module2.id)
+        self.assertEqual(report.n_renders, 0)
+
+    def test_store_columns_and_nrows(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module = workflow.wf_modules.first()
+
+        execute_wfmodule_unlocked(workflow, wf_module.id)
+
+        wf_module = WfModule.objects.get(id=wf_module.id)
+        self.assertEqual(wf_module.cached_render_result_nrows, 2)
+        self.assertEqual(
+            [c.name for c in wf_module.get_cached_output_columns()],
+            ['A', 'B']
+        )
+        self.assertIsNotNone(wf_module.cached_render_result_columns)
+
+    def test_discard_render_when_delta_changes(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module = workflow.wf_modules.first()
+
+        def render_during_edit(wf_module, table):
+            # Another request changes the WfModule while we render
+            WfModule.objects.filter(id=wf_module.id) \
+                .update(last_relevant_delta_id=5)
+            return ProcessResult(table_dataframe)
+
+        with mock.patch('server.dispatch.module_dispatch_render') as mdr:
+            mdr.side_effect = render_during_edit
+            report = execute_wfmodule_unlocked(workflow, wf_module.id)
+
+        self.assertIsNone(report)
+        self.assertEqual(cached_render_result_revision_list(workflow), [None])
+
+    def test_keep_fields_written_during_render(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module = workflow.wf_modules.first()
+
+        def render_during_edit(wf_module, table):
+            WfModule.objects.filter(id=wf_module.id).update(notes='hi')
+            return ProcessResult(table_dataframe)
+
+        with mock.patch('server.dispatch.module_dispatch_render') as mdr:
+            mdr.side_effect = render_during_edit
+            execute_wfmodule_unlocked(workflow, wf_module.id)
+
+        wf_module.refresh_from_db()
+        self.assertEqual(wf_module.notes, 'hi')
+        self.assertEqual(wf_module.cached_render_result_delta_id, 0)
+
+    def test_render_reads_input_as_of_lock(self):
+        workflow = create_testdata_workflow(mock_ab_csv_text)
+        wf_module1 = workflow.wf_modules.first()
+        wf_module2 = load_and_add_module('selectcolumns', workflow=workflow)
+        execute_wfmodule_unlocked(workflow, wf_module1.id)
+        dataframecache.cache.clear()
+        wf_module1.refresh_from_db()
+        input_key = (wf_module1.id, wf_module1.cached_render_result_delta_id)
+        path = wf_module1.get_cached_render_result().parquet_path
+
+        snapshot_input = _RenderStep.snapshot_input
+
+        def snapshot_then_replace(step):
+            snapshot_input(step)
+            # Another render replaces the input after we release the lock
+            parquet.write(path + '.new', pd.DataFrame({'X': ['new']}))
+            os.replace(path + '.new', path)
+
+        with mock.patch.object(_RenderStep, 'snapshot_input',
+                               snapshot_then_replace):
+            report = execute_wfmodule_unlocked(workflow, wf_module2.id)
+
+        self.assertEqual(report.result, ProcessResult(table_dataframe))
+        # We read without the lock, so we must not cache what we read
+        self.assertNotIn(input_key, dataframecache.cache)
@@ -1,170 +1,132 @@
-import unittest
 from unittest.mock import patch
-from pandas import DataFrame
-from server.modules.types import ProcessResult
+from server import dispatch
+from server.execute import execute_wfmodule
 from server.notifications import \
-        OutputDelta, \
+        OutputDelta, render_outputs_to_diff, snapshot_output_hashes, \
         find_output_deltas_to_notify_from_fetched_tables as find_output_deltas
-
-
-class WfModuleList():
-    def __init__(self):
-        self.items = []
-
-    def all(self):
-        return self.items
-
-    def extend(self, items):
-        return self.items.extend(items)
-
-    def __getitem__(self, key):
-        return self.items[key]
-
-    def __iter__(self):
-        for item in self.items:
-            yield item
-
-
-class MockUser:
-    def __init__(self, email):
-        self.email = email
-
-
-class MockWorkflow:
-    def __init__(self):
-        self.wf_modules = WfModuleList()
-        self.name = 'A Workflow'
-        self.owner = MockUser('owner@example.org')
-
-    def get_absolute_url(self):
-        return f'https://example.org/a-workflow'
-
-
-class MockWfModule:
-    def __init__(self, workflow, id, notifications):
-        self.workflow = workflow
-        self.id = id
-        self.notifications = notifications
-
-    def get_module_name(self):
-        return f'Module {self.id}'
-
-
-def build_workflow(param_lists):
-    workflow = MockWorkflow()
-    wf_modules = [MockWfModule(workflow, *params) for params in param_lists]
-    workflow.wf_modules.extend(wf_modules)
-    return workflow
-
-
-class TestFindOutputDeltas(unittest.TestCase):
-    @patch('server.dispatch.module_dispatch_render')
-    def test_noop_when_no_notifications(self, mock_render):
-        workflow = build_workflow([
-            (1, False),
-            (2, False),
-        ])
-        deltas = find_output_deltas(workflow.wf_modules[0],
-                                    ProcessResult(DataFrame({'a': ['b']})),
-                                    ProcessResult(DataFrame({'b': ['c']})))
-        self.assertListEqual(deltas, [])
-        mock_render.assert_not_called()
-
-    @patch('server.dispatch.module_dispatch_render')
-    def test_notify_when_child_outputs_differ(self, mock_render):
-        workflow = build_workflow([
-            (1, False),
-            (2, True),
+from server.tests.utils import DbTestCase, \
+        create_selectcolumns_workflow, get_param_by_id_name, mock_ab_csv_text
+
+
+class TestFindOutputDeltas(DbTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.wf_module2 = create_selectcolumns_workflow('A')
+        self.workflow = self.wf_module2.workflow
+        self.wf_module1 = self.workflow.wf_modules.first()
+
+    def _set_notifications(self, wf_module):
+        wf_module.notifications = True
+        wf_module.save()
+
+    def _change_csv(self, csv):
+        """Change wf_module1's output, as a fetch would."""
+        pval = get_param_by_id_name('csv', wf_module=self.wf_module1)
+        pval.set_value(csv)
+        pval.save()
+        for wf_module in [self.wf_module1, self.wf_module2]:
+            wf_module.refresh_from_db()
+            wf_module.last_relevant_delta_id += 1
+            wf_module.save()
+
+    def _hash(self, wf_module):
+        wf_module.refresh_from_db()
+        return wf_module.cached_render_result_hash
+
+    @patch('server.execute.execute_wfmodule_unlocked')
+    def test_noop_when_no_notifications(self, execute):
+        old_hashes = snapshot_output_hashes(self.wf_module1)
+        self.assertEqual(old_hashes, {})
+
+        deltas = find_output_deltas(self.wf_module1, old_hashes)
+        self.assertEqual(deltas, [])
+        execute.assert_not_called()
+
+    def test_notify_when_child_outputs_differ(self):
+        self._set_notifications(self.wf_module2)
+        execute_wfmodule(self.wf_module2)
+        old_hash = self._hash(self.wf_module2)
+        old_hashes = snapshot_output_hashes(self.wf_module1)
+
+        self._change_csv('A,B\n5,2\n3,4')
+        deltas = find_output_deltas(self.wf_module1, old_hashes)
+
+        self.assertEqual(deltas, [
+            OutputDelta(self.wf_module2, old_hash,
+                        self._hash(self.wf_module2)),
         ])
 
-        def render(wf_module, table):
-            if table.equals(DataFrame({'a': ['b']})):
-                return ProcessResult(DataFrame({'a': ['1']}))
-            elif table.equals(DataFrame({'b': ['c']})):
-                return ProcessResult(DataFrame({'a': ['2']}))
-            else:
-                raise Exception("???")
-        mock_render.side_effect = render
-
-        deltas = find_output_deltas(workflow.wf_modules[0],
-                                    ProcessResult(DataFrame({'a': ['b']})),
-                                    ProcessResult(DataFrame({'b': ['c']})))
-        self.assertEqual(len(deltas), 1)
-        self.assertEqual(
-            deltas[0],
-            OutputDelta(workflow.wf_modules[1],
-                        ProcessResult(DataFrame({'a': ['1']})),
-                        ProcessResult(DataFrame({'a': ['2']})))
-        )
-
-    @patch('server.dispatch.module_dispatch_render')
-    def test_noop_when_parent_outputs_equal(self, mock_render):
-        # Output of module 1 is equal, so we never run module 2 and thus never
-        # notify.
-        workflow = build_workflow([
-            (1, False),
-            (2, True),
-        ])
-
-        def render(wf_module, table):
-            if table.equals(DataFrame({'a': ['b']})):
-                return ProcessResult(DataFrame({'a': ['c']}))
-            elif table.equals(DataFrame({'b': ['c']})):
-                return ProcessResult(DataFrame({'a': ['c']}))
-            else:
-                raise Exception("???")
-        mock_render.side_effect = render
-
-        deltas = find_output_deltas(workflow.wf_modules[0],
-                                    ProcessResult(DataFrame({'a': ['b']})),
-                                    ProcessResult(DataFrame({'b': ['c']})))
-        self.assertListEqual(deltas, [])
+    def test_noop_when_outputs_equal(self):
+        self._set_notifications(self.wf_module2)
+        execute_wfmodule(self.wf_module2)
+        old_hashes = snapshot_output_hashes(self.wf_module1)
+
+        # wf_module2 selects 'A', and 'A' doesn't change
+        self._change_csv('A,B\n1,5\n3,6')
+        deltas = find_output_deltas(self.wf_module1, old_hashes)
+        self.assertEqual(deltas, [])
+
+    def test_stop_when_parent_output_equal(self):
+        self._set_notifications(self.wf_module2)
+        execute_wfmodule(self.wf_module2)
+        old_hashes = snapshot_output_hashes(self.wf_module1)
+
+        # wf_module1's output doesn't change, so wf_module2 never renders
+        self._change_csv(mock_ab_csv_text + '\n')
+        with patch('server.dispatch.module_dispatch_render',
+                   wraps=dispatch.module_dispatch_render) as render:
+            deltas = find_output_deltas(self.wf_module1, old_hashes)
+            self.assertEqual(render.call_count, 1)  # only wf_module1
+        self.assertEqual(deltas, [])
 
     def test_notify_when_fetch_output_differs(self):
-        workflow = build_workflow([
-            (1, True),
-        ])
-        deltas = find_output_deltas(workflow.wf_modules[0],
-                                    ProcessResult(DataFrame({'a': ['b']})),
-                                    ProcessResult(DataFrame({'b': ['c']})))
-        self.assertListEqual(deltas, [
-            OutputDelta(workflow.wf_modules[0],
-                        ProcessResult(DataFrame({'a': ['b']})),
-                        ProcessResult(DataFrame({'b': ['c']}))),
-        ])
+        self._set_notifications(self.wf_module1)
+        execute_wfmodule(self.wf_module1)
+        old_hash = self._hash(self.wf_module1)
+        old_hashes = snapshot_output_hashes(self.wf_module1)
 
-    def test_notify_when_fetch_output_becomes_non_none(self):
-        workflow = build_workflow([
-            (1, True),
-        ])
-        deltas = find_output_deltas(workflow.wf_modules[0], None,
-                                    ProcessResult(DataFrame({'b': ['c']})))
-        self.assertListEqual(deltas, [
-            OutputDelta(workflow.wf_modules[0], None,
-                        ProcessResult(DataFrame({'b': ['c']}))),
-        ])
+        self._change_csv('A,B\n5,6')
+        deltas = find_output_deltas(self.wf_module1, old_hashes)
 
-    @patch('server.dispatch.module_dispatch_render')
-    def test_notify_child_when_fetch_output_becomes_non_none(self,
-                                                             mock_render):
-        workflow = build_workflow([
-            (1, False),
-            (2, True),
+        self.assertEqual(deltas, [
+            OutputDelta(self.wf_module1, old_hash,
+                        self._hash(self.wf_module1)),
         ])
 
-        def render(wf_module, table):
-            if table.empty:
-                return ProcessResult(None)
-            if table.equals(DataFrame({'a': ['b']})):
-                return ProcessResult(DataFrame({'a': ['1']}))
-            else:
-                raise Exception("???")
-        mock_render.side_effect = render
-
-        deltas = find_output_deltas(workflow.wf_modules[0], None,
-                                    ProcessResult(DataFrame({'a': ['b']})))
-        self.assertListEqual(deltas, [
-            OutputDelta(workflow.wf_modules[1],
-                        ProcessResult(None),
-                        ProcessResult(DataFrame({'a': ['1']}))),
+    def test_render_stale_old_output(self):
+        # We never rendered the old version: render it to compare
+        self._set_notifications(self.wf_module2)
+        render_outputs_to_diff(self.wf_module1, lambda: True)
+        with patch('server.execute.execute_wfmodule') as execute:
+            old_hashes = snapshot_output_hashes(self.wf_module1)
+            execute.assert_not_called()  # it's all fresh
+        self.assertEqual(old_hashes, {
+            self.wf_module1.id: self._hash(self.wf_module1),
+            self.wf_module2.id: self._hash(self.wf_module2),
+        })
+
+        # wf_module2 selects 'A', and 'A' doesn't change
+        self._change_csv('A,B\n1,5\n3,6')
+        deltas = find_output_deltas(self.wf_module1, old_hashes)
+        self.assertEqual(deltas, [])
+
+    def test_render_nothing_if_data_unchanged(self):
+        self._set_notifications(self.wf_module2)
+        with patch('server.execute.execute_wfmodule_unlocked') as execute:
+            render_outputs_to_diff(self.wf_module1, lambda: False)
+            execute.assert_not_called()
+
+    def test_snapshot_renders_stale_old_output(self):
+        # Someone edited the workflow after render_outputs_to_diff()
+        self._set_notifications(self.wf_module2)
+        old_hashes = snapshot_output_hashes(self.wf_module1)
+        self.assertNotIn(None, old_hashes.values())
+
+        self._change_csv('A,B\n5,6')
+        deltas = find_output_deltas(self.wf_module1, old_hashes)
+
+        self.assertEqual(deltas, [
+            OutputDelta(self.wf_module2, old_hashes[self.wf_module2.id],
+                        self._hash(self.wf_module2)),
         ])
@@ -0,0 +1,92 @@
+import os
+from django.test import override_settings
+from server import renderhistory
+from server.execute import execute_wfmodule_with_report
+from server.tests.utils import DbTestCase, \
+        create_selectcolumns_workflow, get_param_by_id_name
+
+
+class RenderHistoryTests(DbTestCase):
+    def setUp(self):
+        super().setUp()
+        self.wf_module2 = create_selectcolumns_workflow(
+            last_relevant_delta_id=1
+        )
+        self.workflow = self.wf_module2.workflow
+        self.wf_module1 = self.workflow.wf_modules.first()
+        self.wf_module1.last_relevant_delta_id = 1
+        self.wf_module1.save()
+
+    def _render_with_colnames(self, colnames, delta_id):
+        pval = get_param_by_id_name('colnames', wf_module=self.wf_module2)
+        pval.set_value(colnames)
+        pval.save()
+        self.wf_module2.refresh_from_db()
+        self.wf_module2.last_relevant_delta_id = delta_id
+        self.wf_module2.save()
+        return execute_wfmodule_with_report(self.wf_module2)
+
+    def test_restore_earlier_delta_without_render(self):
+        self._render_with_colnames('A', 2)
+        self._render_with_colnames('B', 3)
+
+        # Undo: back to delta 2's parameters and delta ID
+        report = self._render_with_colnames('A', 2)
+        self.assertEqual(report.n_renders, 0)
+        self.assertEqual(report.n_skipped, 1)
+        self.assertEqual(list(report.result.dataframe.columns), ['A'])
+
+        # Redo
+        report = self._render_with_colnames('B', 3)
+        self.assertEqual(report.n_renders, 0)
+        self.assertEqual(list(report.result.dataframe.columns), ['B'])
+
+    def test_render_when_inputs_differ(self):
+        self._render_with_colnames('A', 2)
+        self._render_with_colnames('B', 3)
+
+        # Same delta ID, different parameters: don't trust the history
+        report = self._render_with_colnames('', 2)
+        self.assertEqual(report.n_renders, 1)
+        self.assertEqual(list(report.result.dataframe.columns), ['A', 'B'])
+
+    @override_settings(RENDER_HISTORY_N_GENERATIONS=2)
+    def test_prune_generations(self):
+        self._render_with_colnames('A', 2)
+        self._render_with_colnames('B', 3)
+        self._render_with_colnames('', 4)
+
+        dirname = renderhistory._wf_module_dir(self.workflow.id,
+                                               self.wf_module2.id)
+        self.assertEqual(sorted(os.listdir(dirname)),
+                         ['3.dat', '3.json', '4.dat', '4.json'])
+
+    @override_settings(RENDER_HISTORY_MAX_BYTES_PER_WORKFLOW=0)
+    def test_prune_unreferenced_over_budget(self):
+        self._render_with_colnames('A', 2)
+        self._render_with_colnames('B', 3)
+
+        # Only delta 3 is still in use, as the cached render result
+        dirname = renderhistory._wf_module_dir(self.workflow.id,
+                                               self.wf_module2.id)
+        self.assertEqual(sorted(os.listdir(dirname)), ['3.dat', '3.json'])
+
+    @override_settings(RENDER_HISTORY_MAX_BYTES_PER_WORKFLOW=0,
+                       SHARED_RENDER_CACHE=True)
+    def test_prune_generations_the_shared_cache_links_to(self):
+        self._render_with_colnames('A', 2)
+        self._render_with_colnames('B', 3)
+
+        # Delta 2's file is in the shared cache, too. That doesn't keep it.
+        dirname = renderhistory._wf_module_dir(self.workflow.id,
+                                               self.wf_module2.id)
+        self.assertEqual(sorted(os.listdir(dirname)), ['3.dat', '3.json'])
+
+    def test_delete_wf_module_deletes_history(self):
+        self._render_with_colnames('A', 2)
+        dirname = renderhistory._wf_module_dir(self.workflow.id,
+                                               self.wf_module2.id)
+        self.assertTrue(os.path.isdir(dirname))
+
+        self.wf_module2.delete()
+        self.assertFalse(os.path.isdir(dirname))
@@ -0,0 +1,165 @@
+import threading
+from unittest.mock import patch
+from django.test import SimpleTestCase, override_settings
+from server.models.Commands import ChangeParameterCommand
+from server.renderqueue import ChannelsRenderQueue, LocalRenderQueue, \
+        render_workflow_and_notify
+from server.tests.utils import DbTestCase, \
+        create_selectcolumns_workflow, get_param_by_id_name
+
+
+class LocalRenderQueueTests(DbTestCase):
+    def setUp(self):
+        super().setUp()
+        self.queue = LocalRenderQueue(2)
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def _blocking_render(self, workflow_id, delta_id):
+        self.started.set()
+        self.release.wait(5)
+
+    @patch('server.renderqueue.render_workflow_and_notify')
+    def test_coalesce_same_key(self, render):
+        render.side_effect = self._blocking_render
+
+        future1 = self.queue.submit(1, 2)
+        self.started.wait(5)
+        future2 = self.queue.submit(1, 2)
+        self.assertIs(future1, future2)
+
+        self.release.set()
+        future1.result(5)
+        render.assert_called_once_with(1, 2)
+
+    @patch('server.renderqueue.render_workflow_and_notify')
+    def test_separate_jobs_for_separate_deltas(self, render):
+        render.side_effect = self._blocking_render
+
+        future1 = self.queue.submit(1, 2)
+        future2 = self.queue.submit(1, 3)
+        self.assertIsNot(future1, future2)
+
+        self.release.set()
+        future1.result(5)
+        future2.result(5)
+        self.assertEqual(render.call_count, 2)
+
+    @patch('server.renderqueue.render_workflow_and_notify')
+    def test_new_job_after_done(self, render):
+        future1 = self.queue.submit(1, 2)
+        future1.result(5)
+        future2 = self.queue.submit(1, 2)
+        future2.result(5)
+        self.assertEqual(render.call_count, 2)
+
+    @patch('server.renderqueue.render_workflow_and_notify')
+    def test_future_raises_render_error(self, render):
+        render.side_effect = RuntimeError('boom')
+        future = self.queue.submit(1, 2)
+        with self.assertRaises(RuntimeError):
+            future.result(5)
+
+
+@patch('server.renderqueue.async_to_sync')
+@patch('server.renderqueue.get_channel_layer')
+@patch('server.renderqueue.time.time')
+class ChannelsRenderQueueTests(SimpleTestCase):
+    def test_send_key_once_per_interval(self, now, get_layer, async_to_sync):
+        now.return_value = 1000.0
+        queue = ChannelsRenderQueue()
+        queue.submit(1, 2)
+        queue.submit(1, 2)
+        self.assertEqual(async_to_sync.return_value.call_count, 1)
+
+        now.return_value = 1061.0
+        queue.submit(1, 2)
+        self.assertEqual(async_to_sync.return_value.call_count, 2)
+
+    def test_forget_old_keys(self, now, get_layer, async_to_sync):
+        now.return_value = 1000.0
+        queue = ChannelsRenderQueue()
+        for workflow_id in range(10):
+            queue.submit(workflow_id, 1)
+
+        now.return_value = 1061.0
+        queue.submit(10, 1)
+        self.assertEqual(list(queue._sent.keys()), [10])
+
+
+class RenderWorkflowAndNotifyTests(DbTestCase):
+    @patch('server.websockets.ws_client_send_delta_sync')
+    def test_render_all_and_notify_each(self, send_delta):
+        wf_module2 = create_selectcolumns_workflow()
+        workflow = wf_module2.workflow
+        wf_module1 = workflow.wf_modules.first()
+
+        render_workflow_and_notify(workflow.id)
+
+        wf_module1.refresh_from_db()
+        wf_module2.refresh_from_db()
+        self.assertEqual(wf_module1.cached_render_result_delta_id, 0)
+        self.assertEqual(wf_module2.cached_render_result_delta_id, 0)
+
+        # One message per WfModule, as soon as each is ready
+        self.assertEqual(
+            [list(call[0][1]['updateWfModules'].keys())
+             for call in send_delta.call_args_list],
+            [[str(wf_module1.id)], [str(wf_module2.id)]]
+        )
+        self.assertEqual(
+            send_delta.call_args_list[1][0][1]['updateWfModules'][
+                str(wf_module2.id)
+            ]['output_columns'],
+            [{'name': 'A', 'type': 'number'}, {'name': 'B', 'type': 'number'}]
+        )
+
+    @patch('server.websockets.ws_client_send_delta_sync')
+    def test_no_notify_when_nothing_changes(self, send_delta):
+        workflow = create_selectcolumns_workflow().workflow
+        render_workflow_and_notify(workflow.id)
+        send_delta.reset_mock()
+
+        render_workflow_and_notify(workflow.id)
+        send_delta.assert_not_called()
+
+    @patch('server.websockets.ws_client_send_delta_sync')
+    def test_cancel_when_superseded(self, send_delta):
+        workflow = create_selectcolumns_workflow().workflow
+        render_workflow_and_notify(workflow.id, workflow.revision() + 1)
+
+        wf_module = workflow.wf_modules.first()
+        self.assertIsNone(wf_module.cached_render_result_delta_id)
+        send_delta.assert_not_called()
+
+    @patch('server.websockets.ws_client_send_delta_sync')
+    def test_missing_workflow(self, send_delta):
+        render_workflow_and_notify(12345)  # does not crash
+        send_delta.assert_not_called()
+
+
+class RenderAfterDeltaTests(DbTestCase):
+    @override_settings(RENDER_AFTER_DELTA=True)
+    @patch('server.websockets.ws_client_send_delta_sync')
+    @patch('server.renderqueue.request_render')
+    def test_request_render_after_change_parameter(self, request_render,
+                                                   send_delta):
+        wf_module = create_selectcolumns_workflow()
+        workflow = wf_module.workflow
+        pval = get_param_by_id_name('colnames', wf_module=wf_module)
+
+        ChangeParameterCommand.create(pval, 'A')
+
+        request_render.assert_called_once()
+        self.assertEqual(request_render.call_args[0][0].id, workflow.id)
+
+    @patch('server.websockets.ws_client_send_delta_sync')
+    @patch('server.renderqueue.request_render')
+    def test_no_render_when_disabled(self, request_render, send_delta):
+        wf_module = create_selectcolumns_workflow()
+        workflow = wf_module.workflow
+        pval = get_param_by_id_name('colnames', wf_module=wf_module)
+
+        ChangeParameterCommand.create(pval, 'A')
+
+        request_render.assert_not_called()
@@ -1,6 +1,7 @@
 import json
 import os
 from unittest import TestCase
+from unittest.mock import patch
 from django.conf import settings
 import numpy as np
 import pandas as pd
@@ -97,6 +98,35 @@ class SantizeDataframeTest(TestCase):
         expected = pd.DataFrame({'A': ['a', 'c'], '3': ["{'a': 'b'}", 'd']})
         assert_frame_equal(result, expected)
 
+    def test_str_column_not_copied(self):
+        table = pd.DataFrame({'A': ['a', np.nan, 'b']})
+        column = table['A']
+        sanitize_dataframe(table)
+        self.assertIs(table['A'], column)
+
+    def test_str_column_with_none(self):
+        table = pd.DataFrame({'A': ['a', None, 'b']})
+        sanitize_dataframe(table)
+        self.assertIsInstance(table['A'][1], float)  # NaN
+
+    @patch('server.sanitizedataframe._InferDtypeSampleSize', 2)
+    def test_nonstr_after_sample(self):
+        table = pd.DataFrame({'A': ['a', 'b', 3]})
+        sanitize_dataframe(table)
+        assert_frame_equal(table, pd.DataFrame({'A': ['a', 'b', '3']}))
+
+    def test_sane_colnames_unchanged(self):
+        table = pd.DataFrame({'A': [1], 'B': [2]})
+        columns = table.columns
+        sanitize_dataframe(table)
+        self.assertIs(table.columns, columns)
+
+    def test_many_duplicate_colnames(self):
+        table = pd.DataFrame([[1] * 1000], columns=['A'] * 1000)
+        sanitize_dataframe(table)
+        self.assertEqual(list(table.columns),
+                         ['A'] + [f'A_{i}' for i in range(1, 1000)])
+
     def test_reset_index(self):
         # should always come out with row numbers contiguous from zero
         table = pd.DataFrame([[1, 'a'], [2, 'b'], [3, 'c']])
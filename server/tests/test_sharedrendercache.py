@@ -0,0 +1,102 @@
+import os
+import shutil
+from unittest.mock import patch
+from django.test import override_settings
+from server import sharedrendercache
+from server.execute import execute_wfmodule_with_report
+from server.models.StoredObject import StoredObject
+from server.tests.utils import DbTestCase, \
+        create_selectcolumns_workflow, get_param_by_id_name, \
+        load_and_add_module, mock_csv_table
+
+
+@override_settings(SHARED_RENDER_CACHE=True)
+class SharedRenderCacheTests(DbTestCase):
+    def setUp(self):
+        super().setUp()
+        shutil.rmtree(sharedrendercache._shared_dir(), ignore_errors=True)
+
+        self.wf_module2 = create_selectcolumns_workflow('A')
+        self.workflow = self.wf_module2.workflow
+
+    def _duplicate_last_wf_module(self):
+        workflow2 = self.workflow.duplicate_anonymous('session-key')
+        return workflow2.wf_modules.last()
+
+    def test_reuse_render_from_other_workflow(self):
+        expected = execute_wfmodule_with_report(self.wf_module2)
+        self.assertEqual(expected.n_renders, 2)
+
+        report = execute_wfmodule_with_report(
+            self._duplicate_last_wf_module()
+        )
+        self.assertEqual(report.n_renders, 0)
+        self.assertEqual(report.result, expected.result)
+
+        # Two WfModules and the shared cache link to the same file
+        self.assertEqual(os.stat(report.cached_result.parquet_path).st_nlink,
+                         3)
+
+    def test_render_when_parameters_differ(self):
+        execute_wfmodule_with_report(self.wf_module2)
+
+        wf_module2 = self._duplicate_last_wf_module()
+        pval = get_param_by_id_name('colnames', wf_module=wf_module2)
+        pval.set_value('B')
+        pval.save()
+        report = execute_wfmodule_with_report(wf_module2)
+        self.assertEqual(report.n_renders, 1)  # just the selectcolumns
+        self.assertEqual(list(report.result.dataframe.columns), ['B'])
+
+    def test_render_when_shared_code_changes(self):
+        execute_wfmodule_with_report(self.wf_module2)
+
+        # Say, a deploy fixed a bug in sanitizedataframe.py
+        with patch('server.dispatch._shared_render_source_hash') as code_hash:
+            code_hash.return_value = 'new-code'
+            report = execute_wfmodule_with_report(
+                self._duplicate_last_wf_module()
+            )
+        self.assertEqual(report.n_renders, 2)
+
+    def test_rewrite_does_not_modify_shared_file(self):
+        report = execute_wfmodule_with_report(self.wf_module2)
+        shared_stat = os.stat(report.cached_result.parquet_path)
+
+        self.wf_module2.cache_render_result(
+            self.wf_module2.last_relevant_delta_id,
+            report.result
+        )
+
+        self.assertNotEqual(
+            os.stat(report.cached_result.parquet_path).st_ino,
+            shared_stat.st_ino
+        )
+
+    def test_evict_only_unreferenced(self):
+        execute_wfmodule_with_report(self.wf_module2)
+        self.assertEqual(sharedrendercache.evict(0), 0)
+
+        for wf_module in self.workflow.wf_modules.all():
+            wf_module.cache_render_result(None, None)
+            wf_module.save()
+        self.assertEqual(sharedrendercache.evict(0), 2)
+
+    @override_settings(SHARED_RENDER_CACHE=False)
+    def test_disabled(self):
+        execute_wfmodule_with_report(self.wf_module2)
+        report = execute_wfmodule_with_report(
+            self._duplicate_last_wf_module()
+        )
+        self.assertEqual(report.n_renders, 2)
+
+    def test_no_fingerprint_for_data_without_column_hashes(self):
+        wf_module = load_and_add_module('loadurl')
+        wf_module.stored_data_version = \
+            wf_module.store_fetched_table(mock_csv_table)
+        wf_module.save()
+        self.assertIsNotNone(sharedrendercache.fingerprint(wf_module, None))
+
+        # Older StoredObjects' hashes ignore row order: don't share renders
+        StoredObject.objects.update(column_hashes=None)
+        self.assertIsNone(sharedrendercache.fingerprint(wf_module, None))
@@ -2,9 +2,12 @@ import io
 import os
 import json
 import tempfile
+from unittest.mock import patch
 import pandas as pd
 from django.conf import settings
 from server.models import StoredObject, WfModule, ModuleVersion
+from server import parquet
+from server.pandas_util import hash_columns, hash_table
 from server.sanitizedataframe import sanitize_dataframe
 from server.tests.utils import DbTestCase, create_testdata_workflow, \
         add_new_wf_module, mock_csv_table, mock_csv_table2
@@ -85,6 +88,68 @@ class StoredObjectTests(DbTestCase):
         self.assertTrue(table3.equals(mock_csv_table2))
 
 
+    def test_create_table_if_different_reads_no_file(self):
+        so1 = StoredObject.create_table(self.wfm1, mock_csv_table)
+        so1 = StoredObject.objects.get(id=so1.id)  # column_hashes from db
+        self.assertEqual(so1.nrows, len(mock_csv_table))
+
+        with patch('server.parquet.read') as read:
+            so2 = StoredObject.create_table_if_different(self.wfm1, so1,
+                                                         mock_csv_table)
+            read.assert_not_called()
+        self.assertIsNone(so2)
+
+    def test_create_table_if_different_column_renamed(self):
+        so1 = StoredObject.create_table(self.wfm1, mock_csv_table)
+        table2 = mock_csv_table.rename(
+            columns={mock_csv_table.columns[0]: 'renamed'}
+        )
+        so2 = StoredObject.create_table_if_different(self.wfm1, so1, table2)
+        self.assertIsNotNone(so2)
+
+    def test_create_table_if_different_empty(self):
+        so1 = StoredObject.create_table(self.wfm1, None)
+        so2 = StoredObject.create_table_if_different(self.wfm1, so1,
+                                                     pd.DataFrame())
+        self.assertIsNone(so2)
+
+    def test_create_table_if_different_without_column_hashes(self):
+        # Tables stored before we computed column hashes
+        so1 = StoredObject.create_table(self.wfm1, mock_csv_table)
+        so1.column_hashes = None
+        so1.nrows = None
+        so1.hash = hash_table(mock_csv_table)
+        so1.save()
+
+        so2 = StoredObject.create_table_if_different(self.wfm1, so1,
+                                                     mock_csv_table)
+        self.assertIsNone(so2)
+        so3 = StoredObject.create_table_if_different(self.wfm1, so1,
+                                                     mock_csv_table2)
+        self.assertIsNotNone(so3)
+
+    def test_create_table_from_file_if_different(self):
+        so1 = StoredObject.create_table(self.wfm1, mock_csv_table)
+
+        path = StoredObject.new_file_path(self.wfm1)
+        parquet.write(path, mock_csv_table)
+        so2 = StoredObject.create_table_from_file_if_different(
+            self.wfm1, so1, path, hash_columns(mock_csv_table),
+            len(mock_csv_table)
+        )
+        self.assertIsNone(so2)
+        self.assertFalse(os.path.exists(path))  # we deleted the duplicate
+
+        path = StoredObject.new_file_path(self.wfm1)
+        parquet.write(path, mock_csv_table2)
+        so3 = StoredObject.create_table_from_file_if_different(
+            self.wfm1, so1, path, hash_columns(mock_csv_table2),
+            len(mock_csv_table2)
+        )
+        self.assertEqual(so3.file.name, path)
+        self.assertEqual(so3.nrows, len(mock_csv_table2))
+        self.assertTrue(so3.get_table().equals(mock_csv_table2))
+
     # Duplicate from one wfm to another, tests the typical WfModule duplication case
     def test_duplicate_table(self):
         so1 = StoredObject.create_table(self.wfm1, mock_csv_table)
@@ -0,0 +1,48 @@
+import datetime
+import json
+from unittest import TestCase
+import numpy as np
+import pandas as pd
+from server.tablejson import columns_json, records_json
+
+
+def _to_json_records(table):
+    return json.loads(table.to_json(orient='records', date_format='iso'))
+
+
+class TableJsonTest(TestCase):
+    def test_like_to_json(self):
+        table = pd.DataFrame({
+            'i': [1, 2, 2**40],
+            'f': [1.5, np.nan, np.inf],
+            's': ['a', None, 'é"\\\n'],
+            'c': pd.Series(['x', 'y', None], dtype='category'),
+            'd': [datetime.datetime(2018, 1, 2, 3, 4, 5, 6000), None,
+                  datetime.datetime(1970, 1, 1)],
+            'b': [True, False, True],
+        })
+        self.assertEqual(json.loads(records_json(table)),
+                         _to_json_records(table))
+
+    def test_empty(self):
+        self.assertEqual(records_json(pd.DataFrame()), '[]')
+        self.assertEqual(columns_json(pd.DataFrame()), '[]')
+        self.assertEqual(records_json(pd.DataFrame({'A': []})), '[]')
+
+    def test_int64_not_float(self):
+        table = pd.DataFrame({'A': [2**62]})
+        self.assertEqual(records_json(table), '[{"A":4611686018427387904}]')
+
+    def test_iso_dates(self):
+        table = pd.DataFrame({'A': [datetime.datetime(2018, 1, 2), None]})
+        self.assertEqual(records_json(table),
+                         '[{"A":"2018-01-02T00:00:00.000Z"},{"A":null}]')
+
+    def test_columns(self):
+        table = pd.DataFrame({'A': [1, 2], 'B': ['x', np.nan]})
+        self.assertEqual(json.loads(columns_json(table)),
+                         [[1, 2], ['x', None]])
+
+    def test_duplicate_column_names(self):
+        table = pd.DataFrame([[1, 'x']], columns=['A', 'A'])
+        self.assertEqual(columns_json(table), '[[1],["x"]]')
@@ -1,11 +1,14 @@
 from server.tests.utils import *
-from server.updates import update_wfm_data_scan
+from server.updates import update_wfm_data_scan, _claim_due_wf_modules, \
+        queue_fetch, run_queued_fetches
 from server import dispatch
 from unittest.mock import MagicMock, patch
 from django.utils import timezone
 from dateutil import parser
 from datetime import timedelta
 import logging
+import threading
+from django.test import override_settings
 
 # Test the scan loop that updates all auto-updating modules
 class UpdatesTests(LoggedInTestCase):
@@ -72,8 +75,12 @@ class UpdatesTests(LoggedInTestCase):
         # When a module throws an exception, it should get updated to the correct time
         # and all others should still be called
 
-        # Mocked return values. First call raises exception.
-        mock_dispatch.side_effect = [Exception('Totes crashed'), None]
+        # wfm1 raises an exception. (Fetches run concurrently, so we can't
+        # rely on call order.)
+        def dispatch(wfm):
+            if wfm.id == self.wfm1.id:
+                raise Exception('Totes crashed')
+        mock_dispatch.side_effect = dispatch
 
         # Ready to update, will crash
         self.wfm1.auto_update_data = True
@@ -106,3 +113,116 @@ class UpdatesTests(LoggedInTestCase):
 
         logging.disable(logging.NOTSET)
 
+    @patch('server.updates.module_dispatch_event')
+    @patch('server.updates.timezone.now')
+    def test_claimed_module_not_claimed_again(self, mock_now, mock_dispatch):
+        mock_now.return_value = self.nowtime
+
+        self.wfm1.auto_update_data = True
+        self.wfm1.next_update = parser.parse('Aug 28 1999 2:34PM UTC')
+        self.wfm1.update_interval = 600
+        self.wfm1.save()
+
+        # Another scheduler claims wfm1
+        self.assertEqual(_claim_due_wf_modules(self.nowtime, 10),
+                         [self.wfm1.id])
+        self.wfm1.refresh_from_db()
+        self.assertTrue(self.wfm1.next_update > self.nowtime)
+
+        update_wfm_data_scan()
+        mock_dispatch.assert_not_called()  # we claimed it already
+
+    @override_settings(FETCH_N_WORKERS=2)
+    @patch('server.updates.module_dispatch_event')
+    @patch('server.updates.timezone.now')
+    def test_slow_fetch_does_not_block_others(self, mock_now, mock_dispatch):
+        mock_now.return_value = self.nowtime
+
+        for wfm in [self.wfm1, self.wfm2, self.wfm3]:
+            wfm.auto_update_data = True
+            wfm.next_update = parser.parse('Aug 28 1999 2:34PM UTC')
+            wfm.update_interval = 600
+            wfm.save()
+
+        # wfm1 blocks until both others are done
+        others_done = threading.Semaphore(0)
+        acquired = []
+
+        def dispatch(wfm):
+            if wfm.id == self.wfm1.id:
+                for _ in range(2):
+                    acquired.append(others_done.acquire(timeout=5))
+            else:
+                others_done.release()
+        mock_dispatch.side_effect = dispatch
+
+        update_wfm_data_scan()
+        self.assertEqual(mock_dispatch.call_count, 3)
+        self.assertEqual(acquired, [True, True])
+
+    @patch('server.updates.module_dispatch_event')
+    def test_queue_fetch_drops_duplicates(self, mock_dispatch):
+        self.assertTrue(queue_fetch(self.wfm1))
+        self.assertFalse(queue_fetch(self.wfm1))  # already queued
+        self.assertTrue(queue_fetch(self.wfm2))
+        mock_dispatch.assert_not_called()  # the fetch worker fetches
+
+        self.assertEqual(run_queued_fetches(), 2)
+        self.assertEqual(
+            set(call[0][0].id for call in mock_dispatch.call_args_list),
+            set([self.wfm1.id, self.wfm2.id])
+        )
+
+        # The queue is empty, so we can queue again
+        self.wfm1.refresh_from_db()
+        self.assertIsNone(self.wfm1.fetch_queued_at)
+        self.assertIsNone(self.wfm1.fetch_claimed_at)
+        self.assertEqual(run_queued_fetches(), 0)
+        self.assertTrue(queue_fetch(self.wfm1))
+
+    @patch('server.updates.module_dispatch_event')
+    def test_queued_fetch_dequeued_after_crash(self, mock_dispatch):
+        mock_dispatch.side_effect = Exception('Totes crashed')
+
+        queue_fetch(self.wfm1)
+        self.assertEqual(run_queued_fetches(), 1)
+
+        self.wfm1.refresh_from_db()
+        self.assertIsNone(self.wfm1.fetch_queued_at)
+
+    def test_stale_save_keeps_fetch_status(self):
+        stale = WfModule.objects.get(id=self.wfm1.id)
+        queue_fetch(self.wfm1)
+        self.wfm1.set_busy(notify=False)
+
+        # Say, a PATCH of `notifications` with an instance from before
+        stale.notifications = True
+        stale.save()
+
+        self.wfm1.refresh_from_db()
+        self.assertTrue(self.wfm1.notifications)
+        self.assertIsNotNone(self.wfm1.fetch_queued_at)
+        self.assertTrue(self.wfm1.is_busy)
+
+    @patch('server.updates.module_dispatch_event')
+    def test_queued_fetch_claimed_by_one_worker(self, mock_dispatch):
+        queue_fetch(self.wfm1)
+
+        # Another worker is fetching wfm1
+        WfModule.objects.filter(id=self.wfm1.id) \
+            .update(fetch_claimed_at=timezone.now())
+
+        self.assertEqual(run_queued_fetches(), 0)
+        mock_dispatch.assert_not_called()
+
+    @override_settings(FETCH_JOB_TIMEOUT=60)
+    @patch('server.updates.module_dispatch_event')
+    def test_reclaim_queued_fetch_of_dead_worker(self, mock_dispatch):
+        queue_fetch(self.wfm1)
+
+        # A worker claimed wfm1, then died
+        WfModule.objects.filter(id=self.wfm1.id) \
+            .update(fetch_claimed_at=timezone.now() - timedelta(seconds=61))
+
+        self.assertEqual(run_queued_fetches(), 1)
+        mock_dispatch.assert_called_once()
@@ -1,5 +1,7 @@
+from unittest.mock import patch
 from django.conf import settings
 from django.test import override_settings
+from server.models import WfModule
 from server.models.StoredObject import StoredObject
 from server.modules.types import ProcessResult
 from server.tests.utils import DbTestCase, load_and_add_module, mock_csv_table
@@ -24,6 +26,30 @@ class VersionTests(DbTestCase):
         save_result_if_changed(self.wfm, ProcessResult(table))
         self.assertEqual(StoredObject.objects.count(), 2)
 
+    def test_store_if_changed_without_notifications_reads_no_table(self):
+        table = mock_csv_table.copy()
+        save_result_if_changed(self.wfm, ProcessResult(table))
+
+        with patch.object(WfModule, 'retrieve_fetched_table') as retrieve:
+            table = table.append(table, ignore_index=True)
+            save_result_if_changed(self.wfm, ProcessResult(table))
+            retrieve.assert_not_called()
+
+        self.assertEqual(StoredObject.objects.count(), 2)
+
+    def test_store_if_unchanged_with_notifications_renders_nothing(self):
+        table = mock_csv_table.copy()
+        save_result_if_changed(self.wfm, ProcessResult(table))
+        self.wfm.notifications = True
+        self.wfm.save()
+
+        # The data didn't change, so there's no old output to diff
+        with patch('server.execute.execute_wfmodule_unlocked') as execute:
+            save_result_if_changed(self.wfm, ProcessResult(table))
+            execute.assert_not_called()
+
+        self.assertEqual(StoredObject.objects.count(), 1)
+
     @override_settings(MAX_STORAGE_PER_MODULE=1000)
     def test_storage_limits(self):
         table = mock_csv_table
@@ -43,3 +69,12 @@ class VersionTests(DbTestCase):
         # one version, eventually.
         # if not, increase table size/loop iterations, or decrease limit
         self.assertEqual(n_objects, 1)
+
+    def test_store_if_changed_wfm_deleted_during_fetch(self):
+        # We fetch without the workflow lock; the user may delete meanwhile
+        WfModule.objects.filter(id=self.wfm.id).delete()
+
+        version = save_result_if_changed(self.wfm,
+                                         ProcessResult(mock_csv_table))
+        self.assertIsNone(version)
+        self.assertEqual(StoredObject.objects.count(), 0)
@@ -1,4 +1,6 @@
+import threading
 from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
 from server.tests.utils import LoggedInTestCase, add_new_wf_module, add_new_module_version, create_testdata_workflow
 from server.models import Workflow
@@ -101,3 +103,20 @@ class WorkflowTests(LoggedInTestCase):
         self.assertFalse(wf.request_authorized_write(MockRequest.logged_in(self.user)))
         self.assertFalse(wf.request_authorized_write(MockRequest.anonymous('session2')))
         self.assertFalse(wf.request_authorized_read(MockRequest.uninitialized()))
+
+    def test_snapshot_read_ignores_concurrent_writes(self):
+        wf = Workflow.objects.create(name='Before', owner=self.user)
+
+        def rename():
+            # Another thread means another database connection
+            Workflow.objects.filter(id=wf.id).update(name='After')
+            connection.close()
+
+        with wf.snapshot_read():
+            self.assertEqual(wf.name, 'Before')
+            thread = threading.Thread(target=rename)
+            thread.start()
+            thread.join()
+            self.assertEqual(Workflow.objects.get(id=wf.id).name, 'Before')
+
+        self.assertEqual(Workflow.objects.get(id=wf.id).name, 'After')
@@ -16,6 +16,7 @@ import pandas as pd
 
 mock_csv_text = 'Month,Amount\nJan,10\nFeb,20'
 mock_csv_table = pd.read_csv(io.StringIO(mock_csv_text))
+mock_ab_csv_text = 'A,B\n1,2\n3,4'
 mock_csv_text2 = 'Month,Amount,Name\nJan,10,Alicia Aliciason\nFeb,666,Fred Frederson'
 mock_csv_table2 = pd.read_csv(io.StringIO(mock_csv_text2))
 
@@ -141,6 +142,22 @@ def create_testdata_workflow(csv_text=mock_csv_text):
     return workflow
 
 
+# setup a workflow that pastes mock_ab_csv_text, then selects `colnames`
+# (all columns, if empty)
+# returns the selectcolumns WfModule
+def create_selectcolumns_workflow(colnames='', last_relevant_delta_id=0):
+    workflow = create_testdata_workflow(mock_ab_csv_text)
+    wf_module = load_and_add_module(
+        'selectcolumns',
+        workflow=workflow,
+        last_relevant_delta_id=last_relevant_delta_id
+    )
+    if colnames:
+        set_param(get_param_by_id_name('colnames', wf_module=wf_module),
+                  colnames)
+    return wf_module
+
+
 # returns the ParameterVal defined by spec with given id_name
 # optionally looks only within a specific WfModule
 # Eerror if more than one ParameterVal matches
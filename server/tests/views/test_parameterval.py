@@ -1,7 +1,8 @@
 from django.contrib.auth.models import User
 from server.tests.test_parameterval import ParameterValTestHelpers
 from server.models import ParameterSpec
-from server.views import parameterval_detail, workflow_detail
+from server.views import parameterval_detail, parameterval_event, \
+        workflow_detail
 from rest_framework.test import APIRequestFactory, force_authenticate
 from rest_framework import status
 from server.tests.utils import LoggedInTestCase, load_and_add_module, \
@@ -33,6 +34,12 @@ class ParameterValTests(LoggedInTestCase, ParameterValTestHelpers):
         self._augment_request(request, user, session_key)
         return request
 
+    def _build_post(self, *args, user: User=None, session_key: str='a-key',
+                    **kwargs):
+        request = self.factory.post(*args, **kwargs)
+        self._augment_request(request, user, session_key)
+        return request
+
     def _build_patch(self, *args, user: User=None, session_key: str='a-key',
                      **kwargs):
         request = self.factory.patch(*args, **kwargs)
@@ -117,3 +124,16 @@ class ParameterValTests(LoggedInTestCase, ParameterValTestHelpers):
         # changing a parameter should change the version
         self.workflow.refresh_from_db()
         self.assertNotEqual(old_rev, self.workflow.revision())
+
+    # test fetch button API
+    @mock.patch('server.updates.module_dispatch_event')
+    def test_parameterval_event_queues_fetch(self, dispatch):
+        request = self._build_post('/api/parameters/%d/event' % self.stringID,
+                                   {}, user=self.user)
+        response = parameterval_event(request, pk=self.stringID)
+        self.assertIs(response.status_code, status.HTTP_204_NO_CONTENT)
+
+        # We queue the fetch; we don't fetch in the request
+        dispatch.assert_not_called()
+        self.wfmodule.refresh_from_db()
+        self.assertIsNotNone(self.wfmodule.fetch_queued_at)
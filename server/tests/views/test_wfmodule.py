@@ -2,13 +2,15 @@ from collections import namedtuple
 import json
 from unittest.mock import patch
 from django.contrib.auth.models import User
+from django.test import override_settings
 import numpy as np
 import pandas as pd
 from rest_framework.test import APIRequestFactory
 from rest_framework import status
 from rest_framework.test import force_authenticate
-from server.models import Module, WfModule, Workflow
+from server.models import CachedRenderResult, Module, WfModule, Workflow
 from server.modules.types import ProcessResult
+from server import dataframecache, parquet
 from server.views.WfModule import wfmodule_detail, wfmodule_dataversion
 from server.tests.test_wfmodule import WfModuleTestsBase
 from server.tests.utils import LoggedInTestCase, mock_csv_table, \
@@ -208,6 +210,29 @@ class WfModuleTests(LoggedInTestCase, WfModuleTestsBase):
         response = self.client.get('/api/wfmodules/%d/render?startrow=0&endrow=frog' % self.wfmodule1.id)
         self.assertIs(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    @override_settings(RENDER_WAIT_TIMEOUT=0)
+    @patch('server.renderqueue.request_render')
+    def test_wf_module_render_pending(self, request_render):
+        request_render.return_value = None  # we can't wait for the render
+
+        response = self.client.get('/api/wfmodules/%d/render' % self.wfmodule1.id)
+        self.assertIs(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(json.loads(response.content), {'pending': True})
+
+    @override_settings(RENDER_WAIT_TIMEOUT=0)
+    @patch('server.views.WfModule.module_get_html_bytes')
+    @patch('server.renderqueue.request_render')
+    def test_wf_module_output_pending_reloads(self, request_render,
+                                              get_html):
+        request_render.return_value = None  # we can't wait for the render
+        get_html.return_value = b'<html><head></head><body></body></html>'
+        self.wfmodule1.last_relevant_delta_id += 1  # stale cache
+        self.wfmodule1.save()
+
+        response = self.client.get('/api/wfmodules/%d/output' % self.wfmodule1.id)
+        self.assertIs(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertIn(b'http-equiv="refresh"', response.content)
+
 
     # can we take one out?
     def test_wf_module_delete(self):
@@ -332,12 +357,19 @@ class WfModuleValueCountsTest(LoggedInTestCase):
         self.wf_module1 = self.workflow.wf_modules.create(order=0)
         self.wf_module2 = self.workflow.wf_modules.create(order=1)
 
-    @patch('server.execute.execute_wfmodule')
-    def test_value_counts_str(self, execute):
-        execute.return_value = ProcessResult(pd.DataFrame({
+    def _cache_result(self, result: ProcessResult) -> None:
+        """Make `result` wf_module2's fresh cached render result."""
+        self.wf_module2.cache_render_result(
+            self.wf_module2.last_relevant_delta_id,
+            result
+        )
+        self.wf_module2.save()
+
+    def test_value_counts_str(self):
+        self._cache_result(ProcessResult(pd.DataFrame({
             'A': ['a', 'b', 'b', 'a', 'c', np.nan],
             'B': ['x', 'x', 'x', 'x', 'x', 'x'],
-        }))
+        })))
 
         response = self.client.get(
             f'/api/wfmodules/{self.wf_module2.id}/value-counts?column=A'
@@ -346,14 +378,13 @@ class WfModuleValueCountsTest(LoggedInTestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(
             json.loads(response.content),
-            {'values': {'a': 2, 'b': 2, 'c': 1}}
+            {'values': {'a': 2, 'b': 2, 'c': 1}, 'n_values': 3}
         )
 
-    @patch('server.execute.execute_wfmodule')
-    def test_value_counts_cast_to_str(self, execute):
-        execute.return_value = ProcessResult(pd.DataFrame({
+    def test_value_counts_cast_to_str(self):
+        self._cache_result(ProcessResult(pd.DataFrame({
             'A': [1, 2, 3, 2, 1],
-        }))
+        })))
 
         response = self.client.get(
             f'/api/wfmodules/{self.wf_module2.id}/value-counts?column=A'
@@ -362,7 +393,7 @@ class WfModuleValueCountsTest(LoggedInTestCase):
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         self.assertEqual(
             json.loads(response.content),
-            {'values': {'1': 2, '2': 2, '3': 1}}
+            {'values': {'1': 2, '2': 2, '3': 1}, 'n_values': 3}
         )
 
     def test_value_counts_param_invalid(self):
@@ -375,12 +406,11 @@ class WfModuleValueCountsTest(LoggedInTestCase):
             'error': 'Missing a "column" parameter',
         })
 
-    @patch('server.execute.execute_wfmodule')
-    def test_value_counts_missing_column(self, execute):
-        execute.return_value = ProcessResult(pd.DataFrame({
+    def test_value_counts_missing_column(self):
+        self._cache_result(ProcessResult(pd.DataFrame({
             'A': ['a', 'b', 'b', 'a', 'c', np.nan],
             'B': ['x', 'x', 'x', 'x', 'x', 'x'],
-        }))
+        })))
 
         response = self.client.get(
             f'/api/wfmodules/{self.wf_module2.id}/value-counts?column=C'
@@ -390,3 +420,330 @@ class WfModuleValueCountsTest(LoggedInTestCase):
         self.assertEqual(json.loads(response.content), {
             'error': 'column "C" not found'
         })
+
+    def test_value_counts_page_most_common_first(self):
+        self._cache_result(ProcessResult(pd.DataFrame({
+            'A': ['a', 'b', 'b', 'c', 'c', 'c', 'd'],
+        })))
+
+        response = self.client.get(
+            f'/api/wfmodules/{self.wf_module2.id}/value-counts'
+            '?column=A&offset=1&limit=2'
+        )
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(response.content)
+        self.assertEqual(data, {'values': {'b': 2, 'a': 1}, 'n_values': 4})
+        self.assertEqual(list(data['values'].keys()), ['b', 'a'])
+
+    def test_value_counts_prefix(self):
+        self._cache_result(ProcessResult(pd.DataFrame({
+            'A': ['apple', 'Apricot', 'banana', 'apple'],
+        })))
+
+        response = self.client.get(
+            f'/api/wfmodules/{self.wf_module2.id}/value-counts'
+            '?column=A&prefix=ap'
+        )
+
+        self.assertEqual(json.loads(response.content), {
+            'values': {'apple': 2, 'Apricot': 1},
+            'n_values': 2,
+        })
+
+    def test_value_counts_invalid_limit(self):
+        response = self.client.get(
+            f'/api/wfmodules/{self.wf_module2.id}/value-counts'
+            '?column=A&limit=-1'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_value_counts_reads_sidecar(self):
+        self._cache_result(ProcessResult(pd.DataFrame({
+            'A': ['a', 'b', 'b'],
+        })))
+        url = f'/api/wfmodules/{self.wf_module2.id}/value-counts?column=A'
+        self.client.get(url)  # writes the sidecar
+
+        with patch.object(CachedRenderResult, 'read_dataframe') as read:
+            dataframecache.cache.clear()
+            response = self.client.get(url)
+            read.assert_not_called()
+
+        self.assertEqual(json.loads(response.content),
+                         {'values': {'b': 2, 'a': 1}, 'n_values': 2})
+
+    @override_settings(PARQUET_ROW_GROUP_SIZE=2)
+    def test_value_counts_page_reads_only_its_row_groups(self):
+        self._cache_result(ProcessResult(pd.DataFrame({
+            'A': ['a', 'b', 'b', 'c', 'c', 'c', 'd', 'e'],
+        })))
+        url = f'/api/wfmodules/{self.wf_module2.id}/value-counts?column=A'
+        self.client.get(url)  # writes the sidecar
+
+        with patch('server.parquet.read_slice',
+                   wraps=parquet.read_slice) as read_slice:
+            response = self.client.get(url + '&offset=1&limit=2')
+            read_slice.assert_called_once()
+            self.assertEqual(read_slice.call_args[0][1:3], (1, 3))
+
+        self.assertEqual(json.loads(response.content),
+                         {'values': {'b': 2, 'a': 1}, 'n_values': 5})
+
+    @override_settings(PARQUET_ROW_GROUP_SIZE=2)
+    def test_value_counts_prefix_reads_only_matching_row_groups(self):
+        self._cache_result(ProcessResult(pd.DataFrame({
+            'A': ['apple', 'Banana', 'banana', 'bandana', 'blue', 'cherry',
+                  'date', 'elderberry', 'fig'],
+        })))
+        url = f'/api/wfmodules/{self.wf_module2.id}/value-counts?column=A'
+        self.client.get(url)  # writes the sidecar
+
+        with patch('server.parquet.read_slice',
+                   wraps=parquet.read_slice) as read_slice:
+            response = self.client.get(url + '&prefix=BAN')
+            start_row, end_row = read_slice.call_args[0][1:3]
+            # 9 distinct values in 5 groups: we read the two that can hold
+            # "ban"
+            self.assertEqual((start_row, end_row), (0, 4))
+
+        self.assertEqual(json.loads(response.content), {
+            'values': {'Banana': 1, 'bandana': 1, 'banana': 1},
+            'n_values': 3,
+        })
+
+
+@override_settings(PARQUET_ROW_GROUP_SIZE=2)
+class WfModulePublicOutputTest(LoggedInTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.workflow = Workflow.objects.create(owner=self.user)
+        self.wf_module = self.workflow.wf_modules.create(order=0)
+        self.wf_module.cache_render_result(
+            self.wf_module.last_relevant_delta_id,
+            ProcessResult(pd.DataFrame({
+                'A': [1, 2, 3],
+                'B': ['x', 'y', 'z'],
+            }))
+        )
+        self.wf_module.save()
+
+    def _get(self, type):
+        response = self.client.get(
+            f'/public/moduledata/live/{self.wf_module.id}.{type}'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.streaming)
+        return response
+
+    def test_csv(self):
+        response = self._get('csv')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(b''.join(response.streaming_content),
+                         b'A,B\n1,x\n2,y\n3,z\n')
+
+    def test_json(self):
+        response = self._get('json')
+        self.assertEqual(json.loads(b''.join(response.streaming_content)), [
+            {'A': 1, 'B': 'x'},
+            {'A': 2, 'B': 'y'},
+            {'A': 3, 'B': 'z'},
+        ])
+
+    def test_ndjson(self):
+        response = self._get('ndjson')
+        lines = b''.join(response.streaming_content).decode('utf-8') \
+            .splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [
+            {'A': 1, 'B': 'x'},
+            {'A': 2, 'B': 'y'},
+            {'A': 3, 'B': 'z'},
+        ])
+
+    def test_parquet_passthrough(self):
+        response = self._get('parquet')
+        cached_result = self.wf_module.get_cached_render_result()
+        with open(cached_result.parquet_path, 'rb') as f:
+            self.assertEqual(b''.join(response.streaming_content), f.read())
+
+    def test_stream_survives_rewrite(self):
+        response = self._get('csv')
+
+        # A render replaces the file while we stream the old one
+        self.wf_module.cache_render_result(
+            self.wf_module.last_relevant_delta_id,
+            ProcessResult(pd.DataFrame({'C': [4]}))
+        )
+        self.wf_module.save()
+
+        self.assertEqual(b''.join(response.streaming_content),
+                         b'A,B\n1,x\n2,y\n3,z\n')
+
+    def test_etag_and_cache_control(self):
+        response = self._get('csv')
+        self.assertTrue(response['ETag'])
+        self.assertIn('private', response['Cache-Control'])
+
+        self.workflow.public = True
+        self.workflow.save()
+        response = self._get('csv')
+        self.assertIn('public', response['Cache-Control'])
+
+    def test_if_none_match_not_modified(self):
+        etag = self._get('csv')['ETag']
+
+        with patch('server.parquet.Snapshot') as snapshot:
+            response = self.client.get(
+                f'/public/moduledata/live/{self.wf_module.id}.csv',
+                HTTP_IF_NONE_MATCH=etag
+            )
+            snapshot.assert_not_called()
+
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_etag_changes_with_delta(self):
+        etag = self._get('csv')['ETag']
+
+        self.wf_module.last_relevant_delta_id += 1
+        self.wf_module.cache_render_result(
+            self.wf_module.last_relevant_delta_id,
+            ProcessResult(pd.DataFrame({'C': [4]}))
+        )
+        self.wf_module.save()
+
+        response = self.client.get(
+            f'/public/moduledata/live/{self.wf_module.id}.csv',
+            HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(RENDER_WAIT_TIMEOUT=0)
+    @patch('server.renderqueue.request_render')
+    def test_unavailable_while_rendering(self, request_render):
+        request_render.return_value = None
+        self.wf_module.last_relevant_delta_id += 1
+        self.wf_module.save()
+
+        response = self.client.get(
+            f'/public/moduledata/live/{self.wf_module.id}.csv'
+        )
+        self.assertEqual(response.status_code,
+                         status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '5')
+
+    @patch('server.renderqueue.request_render')
+    def test_wait_for_render_in_other_process(self, request_render):
+        self.wf_module.last_relevant_delta_id += 1
+        self.wf_module.save()
+
+        def render_elsewhere(workflow):
+            # A render worker renders it; we can't wait on a Future
+            wf_module = WfModule.objects.get(id=self.wf_module.id)
+            wf_module.cache_render_result(
+                wf_module.last_relevant_delta_id,
+                ProcessResult(pd.DataFrame({'C': [4]}))
+            )
+            wf_module.save()
+            return None
+        request_render.side_effect = render_elsewhere
+
+        response = self._get('csv')
+        self.assertEqual(b''.join(response.streaming_content), b'C\n4\n')
+
+
+class WfModuleEmbedDataTest(LoggedInTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.workflow = Workflow.objects.create(owner=self.user)
+        self.wf_module = self.workflow.wf_modules.create(order=0)
+        self.wf_module.cache_render_result(
+            self.wf_module.last_relevant_delta_id,
+            ProcessResult(pd.DataFrame({'A': [1, 2]}), json={'x': [1, 2]})
+        )
+        self.wf_module.save()
+
+    def test_embeddata_reads_no_table(self):
+        dataframecache.cache.clear()
+        with patch('server.parquet.read_header') as read_header:
+            response = self.client.get(
+                f'/api/wfmodules/{self.wf_module.id}/embeddata'
+            )
+            read_header.assert_not_called()
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), {'x': [1, 2]})
+
+    @override_settings(RENDER_WAIT_TIMEOUT=0)
+    @patch('server.renderqueue.request_render')
+    def test_embeddata_unavailable_when_stale(self, request_render):
+        request_render.return_value = None
+        self.wf_module.last_relevant_delta_id += 1
+        self.wf_module.save()
+
+        response = self.client.get(
+            f'/api/wfmodules/{self.wf_module.id}/embeddata'
+        )
+        self.assertEqual(response.status_code,
+                         status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response['Retry-After'], '5')
+
+
+class WfModuleRenderFormatTest(LoggedInTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.workflow = Workflow.objects.create(owner=self.user)
+        self.wf_module = self.workflow.wf_modules.create(order=0)
+        self.wf_module.cache_render_result(
+            self.wf_module.last_relevant_delta_id,
+            ProcessResult(pd.DataFrame({
+                'A': [1, 2],
+                'B': ['x', np.nan],
+            }))
+        )
+        self.wf_module.save()
+
+    def test_orient_columns(self):
+        response = self.client.get(
+            f'/api/wfmodules/{self.wf_module.id}/render?orient=columns'
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(json.loads(response.content), {
+            'total_rows': 2,
+            'start_row': 0,
+            'end_row': 2,
+            'columns': ['A', 'B'],
+            'column_types': ['number', 'text'],
+            'data': [[1, 2], ['x', None]],
+        })
+
+    def test_bad_orient(self):
+        response = self.client.get(
+            f'/api/wfmodules/{self.wf_module.id}/render?orient=split'
+        )
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_gzip(self):
+        self.wf_module.cache_render_result(
+            self.wf_module.last_relevant_delta_id,
+            ProcessResult(pd.DataFrame({'A': list(range(300))}))
+        )
+        self.wf_module.save()
+
+        response = self.client.get(
+            f'/api/wfmodules/{self.wf_module.id}/render',
+            HTTP_ACCEPT_ENCODING='gzip'
+        )
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        etag = response['ETag']
+
+        response = self.client.get(
+            f'/api/wfmodules/{self.wf_module.id}/render',
+            HTTP_ACCEPT_ENCODING='gzip',
+            HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
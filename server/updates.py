@@ -1,41 +1,226 @@
 # Check for updated data
+#
+# Fetches happen in fetch workers, never in web requests. There are two kinds:
+#
+# * Scheduled updates: WfModules with `auto_update_data` whose `next_update`
+#   has passed. See update_wfm_data_scan().
+# * Queued fetches: a user clicked a module's fetch button. See queue_fetch()
+#   and run_queued_fetches(). The queue lives in the database, so it survives
+#   restarts.
+#
+# Run `./manage.py run-fetch-worker` to run both, as many times as you like.
+# `./manage.py run-background-loop` runs them, too.
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
+from typing import Callable, List
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
 from server.models import WfModule
 from server.dispatch import module_dispatch_event
 from server.utils import get_console_logger
-from django.utils import timezone
-from datetime import timedelta
 
 logger = get_console_logger()
 
-# update all modules' data. But only ever one at a time,
-def update_wfm_data_scan():
+
+ClaimFunction = Callable[[datetime, int], List[int]]
+JobFunction = Callable[[int, datetime], None]
+
+
+def _run_claimed_jobs(claim: ClaimFunction, run: JobFunction) -> int:
+    """
+    Run `run(wfm_id, now)` for each WfModule `claim(now, limit)` claims.
+
+    We run up to `settings.FETCH_N_WORKERS` jobs at once, so one slow URL
+    doesn't delay the others. As each job finishes, we claim another. We
+    return when there's nothing left to claim and every job is done.
+
+    Return the number of jobs we ran.
+    """
+    n_workers = settings.FETCH_N_WORKERS
+    in_flight = set()
+    n_jobs = 0
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        while True:
+            now = timezone.now()
+            n_free = n_workers - len(in_flight)
+            for wfm_id in claim(now, n_free):
+                in_flight.add(executor.submit(_run_job, run, wfm_id, now))
+                n_jobs += 1
+
+            if not in_flight:
+                return n_jobs
+
+            _, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+
+
+def _run_job(run: JobFunction, wfm_id: int, now: datetime) -> None:
+    """
+    Run `run(wfm_id, now)` in a worker thread. Log errors; don't raise them.
+    """
+    try:
+        run(wfm_id, now)
+    except Exception:
+        # Log exceptions but keep going
+        logger.exception('Error updating data for module %d', wfm_id)
+    finally:
+        # Each worker thread has its own database connection. Don't leave it
+        # dangling between jobs.
+        connection.close()
+
+
+def update_wfm_data_scan() -> int:
+    """
+    Fetch every WfModule that is due for an update, then return.
+
+    Several processes may call this at once: each WfModule is claimed by
+    only one of them (see _claim_due_wf_modules()).
+
+    Return the number of WfModules we fetched.
+    """
     logger.debug('Scanning for updating modules')
-    # Loop through every workflow module attached to a workflow
-    for wfm in WfModule.objects.filter(workflow__isnull=False):
-        # only check if an interval has been set (i.e. this module can load data)
-        if wfm.auto_update_data and wfm.update_interval>0:
-            check_for_wfm_data_update(wfm)
+    return _run_claimed_jobs(_claim_due_wf_modules, check_for_wfm_data_update)
+
+
+def _claim_due_wf_modules(now: datetime, limit: int) -> List[int]:
+    """
+    Claim up to `limit` WfModules that are due for an update; return IDs.
+
+    We select due WfModules through the (auto_update_data, next_update)
+    index. `SKIP LOCKED` skips WfModules that other schedulers are claiming
+    right now. Claiming schedules the next update, so once we COMMIT, no other
+    scheduler will select the claimed WfModules until they're due again.
+    """
+    if limit <= 0:
+        return []
+
+    with transaction.atomic():
+        due = WfModule.objects \
+            .filter(auto_update_data=True, next_update__lt=now,
+                    update_interval__gt=0, workflow_id__isnull=False) \
+            .order_by('next_update') \
+            .select_for_update(skip_locked=True)
+        wfms = list(due[:limit])
+        for wfm in wfms:
+            update_next_update_time(wfm, now)
+
+    return [wfm.id for wfm in wfms]
 
 
 # schedule next update, skipping missed updates if any
 def update_next_update_time(wfm, now):
     while (wfm.next_update <= now):
         wfm.next_update += timedelta(seconds=wfm.update_interval)
-    wfm.save()
+    wfm.save(update_fields=['next_update'])
+
+
+def _fetch(wfm_id: int) -> bool:
+    """
+    Fetch a claimed WfModule's data; return False if the WfModule is gone.
+
+    The fetch itself notifies websocket clients of the WfModule's status.
 
-# Call this periodically corresponding to smallest possible update cycle (currently every minute)
-def check_for_wfm_data_update(wfm):
+    We don't lock the workflow: a download can take minutes, and users may
+    edit the workflow meanwhile. The fetch takes the lock only to store its
+    result (see versions.save_result_if_changed()).
+    """
+    try:
+        wfm = WfModule.objects.get(id=wfm_id)
+    except WfModule.DoesNotExist:
+        return False  # deleted since we claimed it
+
+    workflow = wfm.workflow
+    if workflow is None:
+        return False  # deleted since we claimed it
+
+    logger.debug('updating wfm ' + str(wfm) + ' - interval ' + str(wfm.update_interval))
+    module_dispatch_event(wfm)
+
+    return True
+
+
+def check_for_wfm_data_update(wfm_id: int, now: datetime) -> None:
+    """
+    Run a scheduled update of a claimed WfModule.
+
+    We scheduled the next update when we claimed the WfModule, so an
+    exception won't make us retry until it's due again.
+    """
+    if _fetch(wfm_id):
+        # It worked, update the checked time. (Update just this column: the
+        # fetch has written others.)
+        WfModule.objects.filter(id=wfm_id).update(last_update_check=now)
+
+
+def queue_fetch(wf_module: WfModule) -> bool:
+    """
+    Ask a fetch worker to fetch `wf_module`'s data.
+
+    Return False if a fetch of `wf_module` is queued or running already: we
+    drop duplicate requests. The fetch worker tells websocket clients the
+    WfModule is busy when it starts, and sends the result when it finishes.
+    """
     now = timezone.now()
-    if now > wfm.next_update:
-        logger.debug('updating wfm ' + str(wfm) + ' - interval ' +  str(wfm.update_interval))
-        with wfm.workflow.cooperative_lock():
-            try:
-                module_dispatch_event(wfm)
-            except Exception as e:
-                # Log exceptions but keep going
-                update_next_update_time(wfm, now)     # Avoid throwing same exception until time for next update
-                logger.exception("Error updating data for module " + str(wfm))
-            else:
-                # It worked, update the checked time
-                wfm.last_update_check = now
-                update_next_update_time(wfm, now)
+    n_queued = WfModule.objects \
+        .filter(id=wf_module.id, fetch_queued_at__isnull=True) \
+        .update(fetch_queued_at=now)
+
+    if n_queued:
+        wf_module.fetch_queued_at = now
+
+    return n_queued > 0
+
+
+def _claim_queued_fetches(now: datetime, limit: int) -> List[int]:
+    """
+    Claim up to `limit` queued fetches; return their WfModule IDs.
+
+    Like _claim_due_wf_modules(), this uses `SKIP LOCKED`, so each fetch is
+    claimed by one worker. We reclaim fetches whose workers seem to have died
+    (claimed more than `settings.FETCH_JOB_TIMEOUT` seconds ago).
+    """
+    if limit <= 0:
+        return []
+
+    timed_out = now - timedelta(seconds=settings.FETCH_JOB_TIMEOUT)
+
+    with transaction.atomic():
+        queued = WfModule.objects \
+            .filter(fetch_queued_at__isnull=False, workflow_id__isnull=False) \
+            .filter(Q(fetch_claimed_at__isnull=True)
+                    | Q(fetch_claimed_at__lt=timed_out)) \
+            .order_by('fetch_queued_at') \
+            .select_for_update(skip_locked=True)
+        wfm_ids = list(queued[:limit].values_list('id', flat=True))
+        WfModule.objects \
+            .filter(id__in=wfm_ids) \
+            .update(fetch_claimed_at=now)
+
+    return wfm_ids
+
+
+def _run_queued_fetch(wfm_id: int, now: datetime) -> None:
+    """
+    Run a claimed queued fetch, then remove it from the queue.
+    """
+    try:
+        _fetch(wfm_id)
+    finally:
+        # Even if the fetch failed: the user can click again
+        WfModule.objects \
+            .filter(id=wfm_id) \
+            .update(fetch_queued_at=None, fetch_claimed_at=None)
+
+
+def run_queued_fetches() -> int:
+    """
+    Run queued fetches until there are none left.
+
+    Several processes may call this at once: each fetch is claimed by only
+    one of them.
+
+    Return the number of fetches we ran.
+    """
+    return _run_claimed_jobs(_claim_queued_fetches, _run_queued_fetch)
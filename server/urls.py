@@ -47,7 +47,7 @@ urlpatterns = [
     url(r'^api/wfmodules/(?P<pk>[0-9]+)/dataversion', views.wfmodule_dataversion),
     url(r'^api/wfmodules/(?P<pk>[0-9]+)/notifications', views.notifications_delete_by_wfmodule),
 
-    url(r'^public/moduledata/live/(?P<pk>[0-9]+)\.(?P<type>(csv|json))?$', views.wfmodule_public_output),
+    url(r'^public/moduledata/live/(?P<pk>[0-9]+)\.(?P<type>(csv|json|ndjson|parquet))?$', views.wfmodule_public_output),
 
     # Parameters
     url(r'^api/parameters/(?P<pk>[0-9]+)/?$', views.parameterval_detail),
@@ -1,14 +1,17 @@
 # Undo, redo, and other version related things
 import datetime
 import json
-from typing import Optional, Dict, Any
+import os
+from typing import Any, Callable, Dict, Optional
 from django.utils import timezone
 from django.conf import settings
 from server.models import Delta, WfModule
 from server.models import ChangeDataVersionCommand, StoredObject
 from server.modules.types import ProcessResult
+from server.modules.utils import IngestedTable
 from server.notifications import \
-        find_output_deltas_to_notify_from_fetched_tables, email_output_delta
+        find_output_deltas_to_notify_from_fetched_tables, \
+        email_output_delta, render_outputs_to_diff, snapshot_output_hashes
 from server import websockets
 
 
@@ -64,45 +67,110 @@ def save_result_if_changed(wfm: WfModule,
 
     Return the timestamp (if changed) or None (if not).
     """
-    with wfm.workflow.cooperative_lock():
-        wfm.last_update_check = timezone.now()
+    def is_new_version():
+        return wfm.fetched_table_is_different(new_result.dataframe)
 
-        # Store this data only if it's different from most recent data
-        old_result = ProcessResult(
-            dataframe=wfm.retrieve_fetched_table(),
-            error=wfm.error_msg
+    def store():
+        return wfm.store_fetched_table_if_different(
+            new_result.dataframe,
+            metadata=json.dumps(stored_object_json)
         )
-        new_table = new_result.dataframe
-        version_added = wfm.store_fetched_table_if_different(
-            new_table,
+
+    return _save_if_changed(wfm, new_result.error, is_new_version, store)
+
+
+def save_ingested_table_if_changed(
+    wfm: WfModule,
+    table: IngestedTable,
+    stored_object_json: Optional[Dict[str, Any]]=None
+) -> datetime.datetime:
+    """
+    Like save_result_if_changed(), for a non-empty table in a Parquet file.
+
+    We use the file as the new StoredObject's file, or delete it if the data
+    did not change.
+    """
+    def is_new_version():
+        return wfm.fetched_table_file_is_different(table.column_hashes,
+                                                   table.nrows)
+
+    def store():
+        return wfm.store_fetched_table_file_if_different(
+            table.path,
+            table.column_hashes,
+            table.nrows,
             metadata=json.dumps(stored_object_json)
         )
 
+    def discard():
+        os.remove(table.path)
+
+    return _save_if_changed(wfm, table.error, is_new_version, store, discard)
+
+
+def save_fetch_error(wfm: WfModule, error: str) -> None:
+    """
+    Like save_result_if_changed(), for a fetch that produced no table.
+    """
+    _save_if_changed(wfm, error, lambda: False, lambda: None)
+
+
+def _save_if_changed(wfm: WfModule, error: str,
+                     is_new_version: Callable[[], bool],
+                     store: Callable[[], Optional[datetime.datetime]],
+                     discard: Callable[[], None]=lambda: None
+                     ) -> datetime.datetime:
+    # If this is new data and someone wants notifications, we'll diff
+    # outputs. Render the old ones now, without the lock.
+    # `is_new_version()` compares hashes, as `store()` will.
+    render_outputs_to_diff(wfm, is_new_version)
+
+    # Fetches run without the workflow lock, so we re-check here: the user
+    # may have deleted the WfModule while we were fetching. Then we
+    # `discard()` what we fetched.
+    with wfm.workflow.cooperative_lock():
+        if not WfModule.objects \
+                .filter(id=wfm.id, workflow_id=wfm.workflow_id) \
+                .exists():
+            discard()
+            return None
+
+        wfm.last_update_check = timezone.now()
+
+        # Store this data only if it's different from most recent data. This
+        # compares hashes: it doesn't read the old table.
+        version_added = store()
+
         if version_added:
+            # Remember outputs at the old data version, to diff them later.
+            # This reads hashes, not tables (usually).
+            old_hashes = snapshot_output_hashes(wfm)
             enforce_storage_limits(wfm)
 
-            output_deltas = \
-                find_output_deltas_to_notify_from_fetched_tables(wfm,
-                                                                 old_result,
-                                                                 new_result)
-        else:
-            output_deltas = []
-
         wfm.is_busy = False
-        wfm.fetch_error = new_result.error
-        wfm.save()
-
-        # Mark has_unseen_notifications via direct SQL
-        WfModule.objects \
-            .filter(id__in=[od.wf_module_id for od in output_deltas]) \
-            .update(has_unseen_notification=True)
+        wfm.fetch_error = error
+        # Write only our fields: the user may have edited others meanwhile
+        wfm.save(update_fields=['last_update_check', 'is_busy',
+                                'fetch_error'])
 
     # un-indent: COMMIT so we notify the client _after_ COMMIT
     if version_added:
         ChangeDataVersionCommand.create(wfm, version_added)  # notifies client
 
-        for output_delta in output_deltas:
-            email_output_delta(output_delta, version_added)
+        if old_hashes:
+            # Renders without the lock
+            output_deltas = find_output_deltas_to_notify_from_fetched_tables(
+                wfm,
+                old_hashes
+            )
+
+            # Mark has_unseen_notifications via direct SQL
+            WfModule.objects \
+                .filter(id__in=[od.wf_module_id for od in output_deltas]) \
+                .update(has_unseen_notification=True)
+
+            for output_delta in output_deltas:
+                email_output_delta(output_delta, version_added)
     else:
         # no new data version, but we still want client to update WfModule
         # status and last update check time
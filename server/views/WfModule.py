@@ -1,74 +1,206 @@
+import concurrent.futures
+from contextlib import contextmanager
 from datetime import timedelta
+import hashlib
 import json
 import re
+import time
+from typing import Iterator, List, Optional
+from django.conf import settings
 from django.core.exceptions import PermissionDenied
 from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, \
-        Http404, HttpResponseNotFound, JsonResponse
+        Http404, HttpResponseNotFound, HttpResponseNotModified, JsonResponse, \
+        StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from django.utils import dateparse, timezone
+from django.utils.cache import patch_cache_control
+from django.utils.http import parse_etags, quote_etag
 from django.views.decorators.clickjacking import xframe_options_exempt
-import numpy as np
+from django.views.decorators.gzip import gzip_page
+import pandas as pd
 from rest_framework import status
 from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
-from server.models import WfModule, StoredObject
+from server.models import CachedRenderResult, WfModule, StoredObject, \
+        Workflow
 from server.serializers import WfModuleSerializer
-from server import execute
+from server import dispatch, execute, parquet, renderqueue, tablejson
 from server.models import DeleteModuleCommand, ChangeDataVersionCommand, \
         ChangeWfModuleNotesCommand, ChangeWfModuleUpdateSettingsCommand
 import server.utils
 from server.utils import units_to_seconds
 from server.dispatch import module_get_html_bytes
 from server.templatetags.json_filters import escape_potential_hack_chars
-from server import websockets
 
 
 _MaxNRowsPerRequest = 300
 
+# While another process renders (the 'channels' render queue), we can't wait
+# on a Future: we poll the database this often instead.
+_RenderPollInterval = 0.25  # seconds
 
-def _client_attributes_that_change_on_render(wf_module):
-    cached_output_columns = wf_module.get_cached_output_columns()
-    if cached_output_columns is None:
-        output_columns = None
-    else:
-        output_columns = [{'name': c.name, 'type': c.type}
-                          for c in cached_output_columns]
+# When a public output is still rendering, we tell HTTP clients to come back
+# after this long.
+_RenderRetryAfter = 5  # seconds
 
-    return {
-        'error_msg': wf_module.error_msg,
-        'status': wf_module.status,
-        'output_columns': output_columns,
-    }
+
+def _render_and_wait(wf_module: WfModule) -> bool:
+    """
+    Make sure `wf_module`'s cached render result is fresh.
+
+    If it is stale, queue a render of its workflow (coalescing with other
+    requests for the same render) and wait for it. If a newer delta cancels
+    that render, queue and wait for the newer one. If a render worker in
+    another process renders it, poll until its result is fresh. Return False
+    if the render is still pending after `settings.RENDER_WAIT_TIMEOUT`.
+
+    Do not call this within a cooperative_lock(): the render needs the lock.
+    """
+    deadline = time.time() + settings.RENDER_WAIT_TIMEOUT
+
+    while not execute.is_cache_fresh(wf_module):
+        timeout = deadline - time.time()
+        if timeout <= 0:
+            return False
+
+        future = renderqueue.request_render(wf_module.workflow)
+        if future is None:
+            time.sleep(min(_RenderPollInterval, timeout))
+        else:
+            try:
+                future.result(timeout=timeout)
+            except concurrent.futures.TimeoutError:
+                return False
+
+        try:
+            wf_module.refresh_from_db()
+            if wf_module.workflow_id is None:
+                raise Http404()  # it was deleted
+            wf_module.workflow.refresh_from_db()
+        except (WfModule.DoesNotExist, Workflow.DoesNotExist):
+            raise Http404()
+
+    return True
+
+
+@contextmanager
+def _locked_render_result(wf_module: WfModule
+                          ) -> Iterator[Optional[CachedRenderResult]]:
+    """
+    Render `wf_module` if needed, then yield its result within a lock.
+
+    Yield None if the render is pending. Otherwise, the yielded
+    CachedRenderResult is the latest one. Read only the rows you need from it
+    within the `with` block: its `.result` decodes the entire table, and
+    nobody will overwrite the file while we hold the lock.
+    """
+    if not _render_and_wait(wf_module):
+        yield None
+        return
+
+    with wf_module.workflow.cooperative_lock():
+        try:
+            wf_module.refresh_from_db()
+        except WfModule.DoesNotExist:
+            raise Http404()
+
+        yield wf_module.get_cached_render_result()
+
+
+def _render_pending_response() -> JsonResponse:
+    """
+    Tell the client we're rendering.
+
+    The client will hear about the result over its websocket.
+    """
+    return JsonResponse({'pending': True}, status=202)
 
 
-def execute_and_notify(wf_module):
+def _render_unavailable_response() -> HttpResponse:
     """
-    Render (and cache) a WfModule; send websocket updates and return result.
+    Tell an HTTP client to download the output later: we're rendering.
+
+    Public outputs go to curl, spreadsheets and embeds, which would save a
+    `{"pending": true}` as data. A 503 is an error they'll retry.
     """
-    workflow = wf_module.workflow
-    with workflow.cooperative_lock():
-        priors = {}
-        for a_wf_module in workflow.wf_modules.all():
-            priors[a_wf_module.id] = \
-                _client_attributes_that_change_on_render(a_wf_module)
+    response = HttpResponse(b'The output is rendering. Please retry.',
+                            content_type='text/plain', status=503)
+    response['Retry-After'] = str(_RenderRetryAfter)
+    return response
 
-        result = execute.execute_wfmodule(wf_module)
 
-        changes = {}
-        for a_wf_module in workflow.wf_modules.all():
-            prior = priors[a_wf_module.id]
-            current = _client_attributes_that_change_on_render(a_wf_module)
+def _output_pending_response() -> HttpResponse:
+    """
+    Tell an output iframe we're rendering.
 
-            if current != prior:
-                changes[str(a_wf_module.id)] = current
+    An iframe can't listen to our websocket, so the page reloads itself
+    until the render is done.
+    """
+    return HttpResponse(
+        b'<!DOCTYPE html><html><head>'
+        b'<meta http-equiv="refresh" content="1">'
+        b'</head><body></body></html>',
+        status=202
+    )
 
-    if changes:
-        websockets.ws_client_send_delta_sync(wf_module.workflow_id, {
-            'updateWfModules': changes
-        })
 
-    return result
+def _output_etag(wf_module: WfModule) -> str:
+    """
+    Identify `wf_module`'s output, without rendering or reading it.
+
+    The output depends only on the WfModule, its last relevant delta (which
+    covers its inputs and parameters) and its module's code. The result is a
+    quoted ETag.
+    """
+    if wf_module.module_version is None:
+        version = ''
+    else:
+        version = dispatch.module_dispatch_version(wf_module)
+    key = f'{wf_module.id}:{wf_module.last_relevant_delta_id}:{version}'
+    return quote_etag(hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+
+def _set_output_cache_headers(response: HttpResponse, wf_module: WfModule,
+                              etag: str) -> HttpResponse:
+    """
+    Stamp `response` with `etag` and let caches keep it.
+
+    Public workflows' outputs may sit in shared caches (CDNs); private ones
+    only in the reader's browser. Either way, caches must revalidate once
+    the response is `settings.RENDER_OUTPUT_MAX_AGE` seconds old.
+    """
+    response['ETag'] = etag
+    if wf_module.workflow.public:
+        patch_cache_control(response, public=True,
+                            max_age=settings.RENDER_OUTPUT_MAX_AGE,
+                            must_revalidate=True)
+    else:
+        patch_cache_control(response, private=True,
+                            max_age=settings.RENDER_OUTPUT_MAX_AGE,
+                            must_revalidate=True)
+    return response
+
+
+def _not_modified_response(request: HttpRequest, wf_module: WfModule,
+                           etag: str) -> Optional[HttpResponse]:
+    """
+    Return a 304 response if the client has the output with `etag` already.
+
+    This needs no transaction, no render and no disk read.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return None
+
+    # Compare weakly: GZipMiddleware weakens the ETags it sends
+    etags = [e[2:] if e.startswith('W/') else e
+             for e in parse_etags(if_none_match)]
+    if etag not in etags and '*' not in etags:
+        return None
+
+    return _set_output_cache_headers(HttpResponseNotModified(), wf_module,
+                                     etag)
 
 
 def _lookup_wf_module(pk: int) -> WfModule:
@@ -98,6 +230,16 @@ def _lookup_wf_module_for_read(pk: int, request: HttpRequest) -> WfModule:
     return wf_module
 
 
+def _refresh_wf_module_or_404(wf_module: WfModule) -> None:
+    """Reload `wf_module`; raise Http404 if it is gone from its workflow."""
+    try:
+        wf_module.refresh_from_db()
+    except WfModule.DoesNotExist:
+        raise Http404()
+    if wf_module.workflow_id is None:
+        raise Http404()
+
+
 def _lookup_wf_module_for_write(pk: int, request: HttpRequest) -> WfModule:
     """Find a WfModule based on pk.
 
@@ -144,7 +286,8 @@ def wfmodule_detail(request, pk, format=None):
         wf_module = _lookup_wf_module_for_write(pk, request)
 
     if request.method == 'GET':
-        with wf_module.workflow.cooperative_lock():
+        with wf_module.workflow.snapshot_read():
+            _refresh_wf_module_or_404(wf_module)
             serializer = WfModuleSerializer(wf_module)
             return Response(serializer.data)
 
@@ -208,10 +351,13 @@ def wfmodule_detail(request, pk, format=None):
 # ---- render / input / livedata ----
 # These endpoints return actual table data
 
-# Helper method that produces json output for a table + start/end row
+# Helper method that reads a page of a table, given start/end row
 # Also silently clips row indices
-def _make_render_dict(result, startrow=None, endrow=None):
-    nrows = len(result.dataframe)
+#
+# We only read the requested rows from the cached result, so a page costs
+# O(page), not O(table).
+def _read_render_page(cached_result, startrow=None, endrow=None):
+    nrows = cached_result.total_rows
     if startrow is None:
         startrow = 0
     if endrow is None:
@@ -220,24 +366,48 @@ def _make_render_dict(result, startrow=None, endrow=None):
     startrow = max(0, startrow)
     endrow = min(nrows, endrow, startrow + _MaxNRowsPerRequest)
 
-    table = result.dataframe[startrow:endrow]
-
-    # In a sane and just world, we could now just do something like
-    #  rows = table.to_dict(orient='records')
-    # Alas, this is not the world we live in. Several problems. First,
-    #  json.dumps(table.to_dict)
-    # does not convert NaN to null. It also fails on int64 columns.
+    table = cached_result.read_dataframe(startrow, endrow)
 
-    # The workaround is to usr table.to_json to get a string, then parse it.
-    rows = json.loads(table.to_json(orient="records", date_format='iso'))
-    return {
+    header = {
         'total_rows': nrows,
         'start_row': startrow,
         'end_row': endrow,
-        'columns': result.column_names,
-        'rows': rows,
-        'column_types': result.column_types,
+        'columns': cached_result.column_names,
+        'column_types': cached_result.column_types,
     }
+    return header, table
+
+
+def _make_render_dict(cached_result, startrow=None, endrow=None):
+    header, table = _read_render_page(cached_result, startrow, endrow)
+    # json.dumps(table.to_dict()) would not convert NaN to null, and it fails
+    # on int64 columns. tablejson handles both.
+    return {**header, 'rows': json.loads(tablejson.records_json(table))}
+
+
+_RenderOrients = {
+    # orient => (key, encoder)
+    'records': ('rows', tablejson.records_json),
+    'columns': ('data', tablejson.columns_json),
+}
+
+
+def _make_render_json_bytes(cached_result, startrow=None, endrow=None,
+                            orient='records') -> bytes:
+    """
+    Encode a page as JSON, like `json.dumps(_make_render_dict(...))`.
+
+    We write the rows straight to JSON, without building Python dicts or
+    re-parsing. With `orient='columns'`, the page holds `data`, a list of
+    column lists, instead of `rows`.
+    """
+    header, table = _read_render_page(cached_result, startrow, endrow)
+    key, encode = _RenderOrients[orient]
+    header_json = json.dumps(header)
+    return ''.join([
+        header_json[:-1],  # nix '}'
+        ',"', key, '":', encode(table), '}'
+    ]).encode('utf-8')
 
 
 def int_or_none(x):
@@ -245,6 +415,10 @@ def int_or_none(x):
 
 
 # /render: return output table of this module
+#
+# `?orient=columns` returns column lists ('data') instead of row objects
+# ('rows'). Responses are gzipped for clients that accept it.
+@gzip_page
 @api_view(['GET'])
 @renderer_classes((JSONRenderer,))
 def wfmodule_render(request, pk, format=None):
@@ -259,9 +433,24 @@ def wfmodule_render(request, pk, format=None):
         return Response({'message': 'bad row number', 'status_code': 400},
                         status=status.HTTP_400_BAD_REQUEST)
 
-    result = execute_and_notify(wf_module)
-    j = _make_render_dict(result, startrow, endrow)
-    return JsonResponse(j)
+    orient = request.GET.get('orient', 'records')
+    if orient not in _RenderOrients:
+        return Response({'message': 'bad orient', 'status_code': 400},
+                        status=status.HTTP_400_BAD_REQUEST)
+
+    etag = _output_etag(wf_module)
+    not_modified = _not_modified_response(request, wf_module, etag)
+    if not_modified is not None:
+        return not_modified
+
+    with _locked_render_result(wf_module) as cached_result:
+        if cached_result is None:
+            return _render_pending_response()
+
+        content = _make_render_json_bytes(cached_result, startrow, endrow,
+                                          orient)
+    response = HttpResponse(content, content_type='application/json')
+    return _set_output_cache_headers(response, wf_module, etag)
 
 
 _html_head_start_re = re.compile(rb'<\s*head[^>]*>', re.IGNORECASE)
@@ -272,19 +461,31 @@ _html_head_start_re = re.compile(rb'<\s*head[^>]*>', re.IGNORECASE)
 def wfmodule_output(request, pk, format=None):
     wf_module = _lookup_wf_module_for_read(pk, request)
 
+    etag = _output_etag(wf_module)
+    not_modified = _not_modified_response(request, wf_module, etag)
+    if not_modified is not None:
+        return not_modified
+
     html = module_get_html_bytes(wf_module)
 
-    result = execute_and_notify(wf_module)
+    with _locked_render_result(wf_module) as cached_result:
+        if cached_result is None:
+            return _output_pending_response()
 
-    # TODO nix params. Use result.json_dict instead.
-    params = wf_module.create_parameter_dict(result.dataframe)
+        # Read only column names and the first page: not the whole table
+        # TODO nix params. Use cached_result.json instead.
+        params = wf_module.create_parameter_dict(
+            None,
+            column_names=cached_result.column_names
+        )
 
-    input_dict = _make_render_dict(result)
+        input_dict = _make_render_dict(cached_result)
+        embeddata = cached_result.json
 
     init_data = {
         'input': input_dict,
         'params': params,
-        'embeddata': result.json,
+        'embeddata': embeddata,
     }
     init_data_bytes = escape_potential_hack_chars(json.dumps(init_data)) \
         .encode('utf-8')
@@ -299,7 +500,8 @@ def wfmodule_output(request, pk, format=None):
         count=1  # so a '<head>' in comments and code won't be replaced
     )
 
-    return HttpResponse(content=html_with_js)
+    return _set_output_cache_headers(HttpResponse(content=html_with_js),
+                                     wf_module, etag)
 
 
 @api_view(['GET'])
@@ -307,14 +509,57 @@ def wfmodule_output(request, pk, format=None):
 def wfmodule_embeddata(request, pk):
     wf_module = _lookup_wf_module_for_read(pk, request)
 
-    result = execute_and_notify(wf_module)
+    etag = _output_etag(wf_module)
+    not_modified = _not_modified_response(request, wf_module, etag)
+    if not_modified is not None:
+        return not_modified
+
+    if execute.is_cache_fresh(wf_module):
+        # Fast path: the JSON is in the row we just read. Send its bytes as
+        # they are, with no lock, no Parquet decode and no re-encoding.
+        json_bytes = bytes(wf_module.cached_render_result_json) or b'{}'
+        response = HttpResponse(json_bytes, content_type='application/json')
+        return _set_output_cache_headers(response, wf_module, etag)
+
+    with _locked_render_result(wf_module) as cached_result:
+        if cached_result is None:
+            return _render_unavailable_response()
+
+        json_dict = cached_result.json or {}
+
+    return _set_output_cache_headers(JsonResponse(json_dict), wf_module,
+                                     etag)
 
-    return JsonResponse(result.json)
+
+def _parse_nonnegative_int(request: HttpRequest, name: str,
+                           default: Optional[int]) -> Optional[int]:
+    """Read an int query parameter; raise ValueError if it is invalid."""
+    value = request.GET.get(name, '')
+    if not value:
+        return default
+
+    ret = int(value)  # or ValueError
+    if ret < 0:
+        raise ValueError(f'"{name}" must not be negative')
+    return ret
 
 
 @api_view(['GET'])
 @renderer_classes((JSONRenderer,))
 def wfmodule_value_counts(request, pk):
+    """
+    Count values in a column, most common first.
+
+    Query parameters:
+
+    * `column` (required): the column to count.
+    * `prefix`: only count values that start with this (case-insensitive).
+    * `offset`, `limit`: return only this page of the values. Omit `limit` to
+      return every value from `offset` on.
+
+    The response holds `values` (value => count, most common first) and
+    `n_values`, the number of distinct values that match `prefix`.
+    """
     wf_module = _lookup_wf_module_for_read(pk, request)
 
     try:
@@ -325,29 +570,90 @@ def wfmodule_value_counts(request, pk):
             status=400
         )
 
+    try:
+        offset = _parse_nonnegative_int(request, 'offset', 0)
+        limit = _parse_nonnegative_int(request, 'limit', None)
+    except ValueError as err:
+        return JsonResponse({'error': f'Invalid paging parameter: {err}'},
+                            status=400)
+    prefix = request.GET.get('prefix', '')
+
     if not column:
         # User has not yet chosen a column. Empty response.
-        return JsonResponse({'values': {}})
+        return JsonResponse({'values': {}, 'n_values': 0})
 
-    with wf_module.workflow.cooperative_lock():
-        result = execute_and_notify(wf_module)
-        table = result.dataframe
+    with _locked_render_result(wf_module) as cached_result:
+        if cached_result is None:
+            return _render_pending_response()
 
         try:
-            series = table[column]
+            page, n_values = cached_result.value_counts(column, prefix,
+                                                        offset, limit)
         except KeyError:
             return JsonResponse({'error': f'column "{column}" not found'},
                                 status=404)
 
-        # We only handle string. If it's not string, convert to string.
-        if not (series.dtype == object or hasattr(series, 'cat')):
-            t = series.astype(str)
-            t[series.isna()] = np.nan
-            series = t
+    return JsonResponse({
+        'values': dict(page),
+        'n_values': n_values,
+    })
+
+
+def _iter_csv(column_names: List[str],
+              frames: Iterator[pd.DataFrame]) -> Iterator[str]:
+    yield pd.DataFrame(columns=column_names).to_csv(index=False)
+    for frame in frames:
+        yield frame.to_csv(index=False, header=False)
+
+
+def _iter_json(frames: Iterator[pd.DataFrame]) -> Iterator[str]:
+    """Yield a JSON Array of records, like DataFrame.to_json()."""
+    yield '['
+    first = True
+    for frame in frames:
+        if frame.empty:
+            continue
+        records = frame.to_json(orient='records')[1:-1]  # nix '[' and ']'
+        if not first:
+            yield ','
+        first = False
+        yield records
+    yield ']'
+
+
+def _iter_ndjson(frames: Iterator[pd.DataFrame]) -> Iterator[str]:
+    """Yield one JSON record per line."""
+    for frame in frames:
+        if frame.empty:
+            continue
+        yield frame.to_json(orient='records', lines=True).rstrip('\n')
+        yield '\n'
+
+
+def _iter_table(type: str, column_names: List[str],
+                frames: Iterator[pd.DataFrame]) -> Iterator[str]:
+    if type == 'csv':
+        return _iter_csv(column_names, frames)
+    elif type == 'json':
+        return _iter_json(frames)
+    else:
+        return _iter_ndjson(frames)
+
+
+def _closing(iterator: Iterator, snapshot: parquet.Snapshot) -> Iterator:
+    """Yield from `iterator`, then close `snapshot` (even on disconnect)."""
+    try:
+        yield from iterator
+    finally:
+        snapshot.close()
 
-        value_counts = series.value_counts().to_dict()
 
-    return JsonResponse({'values': value_counts})
+_StreamContentTypes = {
+    'csv': 'text/csv',
+    'json': 'application/json',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/octet-stream',
+}
 
 
 # Public access to wfmodule output. Basically just /render with different auth
@@ -356,18 +662,48 @@ def wfmodule_value_counts(request, pk):
 @api_view(['GET'])
 @renderer_classes((JSONRenderer,))
 def wfmodule_public_output(request, pk, type, format=None):
+    """
+    Stream a WfModule's output as CSV, JSON, NDJSON or Parquet.
+
+    We open the cached Parquet file while holding the workflow lock, then
+    stream it without the lock, decoding one row group at a time. Memory use
+    is bounded by the row group size, not the table size. 'parquet' streams
+    the cached file as-is.
+    """
+    if type not in _StreamContentTypes:
+        raise Http404()
+
     wf_module = _lookup_wf_module_for_read(pk, request)
 
-    result = execute_and_notify(wf_module)
+    etag = _output_etag(wf_module)
+    not_modified = _not_modified_response(request, wf_module, etag)
+    if not_modified is not None:
+        return not_modified
+
+    with _locked_render_result(wf_module) as cached_result:
+        if cached_result is None:
+            return _render_unavailable_response()
 
-    if type == 'json':
-        d = result.dataframe.to_json(orient='records')
-        return HttpResponse(d, content_type="application/json")
-    elif type == 'csv':
-        d = result.dataframe.to_csv(index=False)
-        return HttpResponse(d, content_type="text/csv")
+        try:
+            snapshot = parquet.Snapshot(cached_result.parquet_path)
+        except FileNotFoundError:
+            snapshot = None
+
+    if snapshot is None:
+        # Nothing on disk: the output is an empty table
+        if type == 'parquet':
+            raise Http404()
+        content = _iter_table(type, [], iter([]))
+    elif type == 'parquet':
+        content = _closing(snapshot.iter_bytes(), snapshot)
     else:
-        raise Http404()
+        content = _closing(_iter_table(type, snapshot.column_names,
+                                       snapshot.iter_row_groups()),
+                           snapshot)
+
+    response = StreamingHttpResponse(content,
+                                     content_type=_StreamContentTypes[type])
+    return _set_output_cache_headers(response, wf_module, etag)
 
 
 # Get list of data versions, or set current data version
@@ -377,7 +713,8 @@ def wfmodule_dataversion(request, pk, format=None):
     if request.method == 'GET':
         wf_module = _lookup_wf_module_for_read(pk, request)
 
-        with wf_module.workflow.cooperative_lock():
+        with wf_module.workflow.snapshot_read():
+            _refresh_wf_module_or_404(wf_module)
             versions = wf_module.list_fetched_data_versions()
             current_version = wf_module.get_fetched_data_version()
             response = {'versions': versions, 'selected': current_version}
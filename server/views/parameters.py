@@ -10,8 +10,8 @@ from rest_framework.response import Response
 from rest_framework.renderers import JSONRenderer
 from ..models import ParameterSpec, ParameterVal, ChangeParameterCommand
 from ..serializers import ParameterValSerializer
-from ..dispatch import module_dispatch_event
 from .. import triggerrender
+from .. import updates
 from .. import oauth
 
 
@@ -63,7 +63,10 @@ def parameterval_detail(request, pk, format=None):
 
 
 # Handle a parameter event (like someone clicking the fetch button)
-# Get or set parameter value
+#
+# We don't fetch here: we queue the fetch for a fetch worker and return right
+# away. The worker sends the fetch's progress and result over websockets. If a
+# fetch of this WfModule is queued or running already, we drop this one.
 @api_view(['POST'])
 @renderer_classes((JSONRenderer,))
 def parameterval_event(request, pk, format=None):
@@ -71,12 +74,7 @@ def parameterval_event(request, pk, format=None):
     if isinstance(param, HttpResponse):
         return param
 
-    # change parameter value
-    data = request.data
-    dispatch_response = module_dispatch_event(param.wf_module, parameter=param,
-                                              event=data, request=request)
-    if dispatch_response:
-        return dispatch_response
+    updates.queue_fetch(param.wf_module)
 
     return Response(status=status.HTTP_204_NO_CONTENT)
 
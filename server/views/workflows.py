@@ -194,7 +194,7 @@ def render_workflow(request, pk=None):
 def workflow_detail(request, pk, format=None):
     if request.method == 'GET':
         workflow = _lookup_workflow_for_read(pk, request)
-        with workflow.cooperative_lock():
+        with workflow.snapshot_read():
             data = make_init_state(request, workflow)
             return Response({
                 'workflow': data['workflow'],